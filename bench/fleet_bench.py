@@ -0,0 +1,528 @@
+#!/usr/bin/env python3
+"""
+Fleet load generator: one real gateway, thousands of simulated robots, offline.
+
+Runs a stand-in central server (manifest, artifacts, telemetry ingest) in this
+process and gateway/server.py as a subprocess with a mock cosign, then drives
+the gateway with N async robots that POST /metrics, watch (or poll) /manifest
+and download every new artifact. Once all robots run, a new version is
+published centrally. Prints a JSON report to diff between releases:
+
+  ingest   POST /metrics latency (client side and the gateway's /db/stats)
+  flush    rows/s reaching the central server, backlog and drain time
+  ota      gateway sync time and publish -> robot-has-artifact fan-out
+  gateway  peak/final RSS and CPU time of the gateway processes
+
+  python bench/fleet_bench.py --robots 2000 --duration 60 --artifact-mb 16 --out before.json
+
+Gateway settings (INGEST_MODE, FLUSH_*, ARTIFACT_*, ...) come from the environment;
+GATEWAY_WORKERS=4 runs the gateway as four worker processes.
+"""
+import os
+import sys
+import json
+import time
+import gzip
+import random
+import socket
+import shutil
+import asyncio
+import hashlib
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import collections
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import FileResponse
+from common.manifest_watch import ManifestWatch
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def raise_fd_limit():
+    """Every simulated robot holds connections; lift the soft fd limit (inherited by the gateway)."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def summary(values):
+    """count/p50/p99/max of a list of milliseconds (or seconds), rounded."""
+    if not values:
+        return {"count": 0, "p50": None, "p99": None, "max": None}
+    values = sorted(values)
+
+    def q(p):
+        return round(values[min(len(values) - 1, int(p * len(values)))], 3)
+
+    return {"count": len(values), "p50": q(0.50), "p99": q(0.99), "max": round(values[-1], 3)}
+
+
+def revision():
+    try:
+        return subprocess.check_output(["git", "-C", ROOT, "describe", "--always", "--dirty"],
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# -----------------------------
+# Stand-in central server
+# -----------------------------
+class Central:
+    """Serves /ota (manifest with ETag/watch, artifacts) and counts rows arriving on /ingest[/batch]."""
+
+    def __init__(self, workdir):
+        self.ota = os.path.join(workdir, "ota")
+        os.makedirs(self.ota, exist_ok=True)
+        self.manifest = ManifestWatch(os.path.join(self.ota, "manifest.json"))
+        self.rows = 0
+        self.app = self._app()
+
+    def build(self, version, size_mb):
+        """Write a random artifact + bundle; returns the manifest (not yet published)."""
+        name = f"app-v{version}.tar.gz"
+        h = hashlib.sha256()
+        left = int(size_mb * 1024 * 1024)
+        with open(os.path.join(self.ota, name), "wb") as f:
+            while left:
+                chunk = os.urandom(min(left, 1024 * 1024))
+                h.update(chunk)
+                f.write(chunk)
+                left -= len(chunk)
+        with open(os.path.join(self.ota, name + ".bundle"), "w") as f:
+            f.write("{}")   # the mock cosign accepts anything
+        return {
+            "version": version,
+            "artifact": name,
+            "bundle": name + ".bundle",
+            "sha256": h.hexdigest(),
+            "size": os.path.getsize(os.path.join(self.ota, name)),
+        }
+
+    def publish(self, manifest):
+        tmp = self.manifest.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp, self.manifest.path)
+        self.manifest.refresh()   # wakes the gateway's long-poll
+
+    def _app(self):
+        app = FastAPI()
+
+        @app.get("/ota/manifest.json")
+        def manifest(request: Request):
+            return self.manifest.response(request)
+
+        @app.get("/ota/manifest/watch")
+        async def watch(request: Request, timeout: float = None):
+            return await self.manifest.watch(request, timeout)
+
+        @app.api_route("/ota/{name}", methods=["GET", "HEAD"])
+        def artifact(name: str):
+            path = os.path.join(self.ota, os.path.basename(name))
+            if not os.path.isfile(path):
+                raise HTTPException(404)
+            return FileResponse(path)
+
+        @app.post("/ingest/batch")
+        async def ingest_batch(request: Request):
+            body = await request.body()
+            if request.headers.get("content-encoding", "").lower() == "gzip":
+                body = gzip.decompress(body)
+            if "ndjson" in request.headers.get("content-type", ""):
+                n = sum(1 for line in body.splitlines() if line.strip())
+            else:
+                n = len(json.loads(body))
+            self.rows += n
+            return {"ok": True, "accepted": n, "count": self.rows}
+
+        @app.post("/ingest")
+        async def ingest(request: Request):
+            await request.json()
+            self.rows += 1
+            return {"ok": True, "count": self.rows}
+
+        return app
+
+
+# -----------------------------
+# Gateway under test
+# -----------------------------
+class Gateway:
+    def __init__(self, workdir, central_url, log_path):
+        self.workdir = workdir
+        self.central_url = central_url
+        self.log_path = log_path
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.proc = None
+
+    def start(self):
+        bin_dir = os.path.join(self.workdir, "bin")
+        os.makedirs(bin_dir, exist_ok=True)
+        cosign = os.path.join(bin_dir, "cosign")
+        with open(cosign, "w") as f:
+            f.write("#!/bin/sh\nexit 0\n")
+        os.chmod(cosign, 0o755)
+        pub = os.path.join(self.workdir, "cosign.pub")
+        with open(pub, "w") as f:
+            f.write("bench key\n")
+
+        env = dict(os.environ)
+        for key, value in {
+            "AUTO_FLUSH": "true",
+            "ROLLOUT_ENABLED": "false",   # measure raw fan-out, not the canary schedule
+            "OTA_POLL_SECONDS": "1",
+            "DELTA_ENABLED": "false",
+            "OTA_WATCH_SECONDS": "5",     # a publish still wakes it at once; keeps the stand-in's shutdown short
+        }.items():
+            env.setdefault(key, value)
+        env.update({
+            "CACHE_DIR": os.path.join(self.workdir, "cache"),
+            "DATA_DIR": os.path.join(self.workdir, "data"),
+            "COSIGN_PUB": pub,
+            "OTA_SOURCE_URL": f"{self.central_url}/ota",
+            "DASHBOARD_URL": self.central_url,
+            "PATH": bin_dir + os.pathsep + env.get("PATH", ""),
+            "PYTHONPATH": ROOT,
+        })
+        os.makedirs(env["CACHE_DIR"], exist_ok=True)
+        os.makedirs(env["DATA_DIR"], exist_ok=True)
+        self.log = open(self.log_path, "w")
+        self.proc = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1", "--port", str(self.port),
+             "--log-level", "warning", "--no-access-log", "--workers", env.get("GATEWAY_WORKERS", "1"),
+             "--timeout-graceful-shutdown", "2"],   # robots' long-polls would hold shutdown open
+            cwd=os.path.join(ROOT, "gateway"), env=env, stdout=self.log, stderr=subprocess.STDOUT,
+        )
+
+    def _pids(self):
+        """The gateway process and its descendants (uvicorn workers)."""
+        pids, todo = [], [self.proc.pid]
+        while todo:
+            pid = todo.pop()
+            pids.append(pid)
+            try:
+                for tid in os.listdir(f"/proc/{pid}/task"):
+                    with open(f"/proc/{pid}/task/{tid}/children") as f:
+                        todo.extend(int(c) for c in f.read().split())
+            except OSError:
+                pass
+        return pids
+
+    def rss_mb(self):
+        total = 0
+        for pid in self._pids():
+            try:
+                with open(f"/proc/{pid}/status") as f:
+                    for line in f:
+                        if line.startswith("VmRSS:"):
+                            total += int(line.split()[1])
+            except OSError:
+                pass
+        return round(total / 1024, 1)
+
+    def cpu_seconds(self):
+        total = 0
+        for pid in self._pids():
+            try:
+                with open(f"/proc/{pid}/stat") as f:
+                    fields = f.read().rpartition(")")[2].split()
+                total += int(fields[11]) + int(fields[12])   # utime + stime
+            except OSError:
+                pass
+        return round(total / os.sysconf("SC_CLK_TCK"), 2)
+
+    def stop(self):
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+        self.log.close()
+
+
+# -----------------------------
+# Simulated robots
+# -----------------------------
+class Fleet:
+    def __init__(self, args, gateway_url, version):
+        self.args = args
+        self.gw = gateway_url
+        self.initial_version = version
+        self.ingest_ms = []
+        self.accepted = 0
+        self.manifest_requests = 0
+        self.artifact_bytes = 0
+        self.errors = collections.Counter()
+        self.metrics_on = True
+        self.target = None        # (version, publish time)
+        self.fanout = {}          # robot -> seconds from publish to artifact on disk
+
+    async def metrics_loop(self, client, rid):
+        interval = self.args.metrics_interval
+        next_at = time.perf_counter() + random.uniform(0, interval)
+        payload = {"robot_id": rid, "version": self.initial_version, "cpu": 0.0, "mem": 0.0, "healthy": True}
+        while self.metrics_on:
+            await asyncio.sleep(max(0.0, next_at - time.perf_counter()))
+            next_at += interval   # fixed rate, independent of response time
+            payload["cpu"], payload["mem"] = round(random.random() * 100, 2), round(random.random() * 100, 2)
+            started = time.perf_counter()
+            try:
+                r = await client.post(f"{self.gw}/metrics", json=payload, headers={"X-Robot-Id": rid})
+            except httpx.HTTPError as e:
+                self.errors[f"metrics_{type(e).__name__}"] += 1
+                continue
+            if r.status_code == 200:
+                self.accepted += 1
+                self.ingest_ms.append(1000 * (time.perf_counter() - started))
+            else:
+                self.errors[f"metrics_http_{r.status_code}"] += 1
+                if r.status_code == 429:   # back off like the robot agent
+                    next_at = time.perf_counter() + float(r.headers.get("retry-after", "30")) * random.uniform(0.8, 1.2)
+
+    async def ota_loop(self, client, rid):
+        headers = {"X-Robot-Id": rid}
+        version = self.initial_version
+        watch = self.args.manifest == "watch"
+        while True:
+            try:
+                if watch:
+                    r = await client.get(f"{self.gw}/manifest/watch", params={"timeout": 30},
+                                         headers=headers, timeout=45)
+                else:
+                    r = await client.get(f"{self.gw}/manifest", headers=headers)
+                self.manifest_requests += 1
+                if r.status_code == 200:
+                    m = r.json()
+                    if m["version"] != version:
+                        await asyncio.sleep(random.uniform(0, self.args.spread))
+                        await self.download(client, rid, m)
+                        version = m["version"]
+                        if self.target and version == self.target[0]:
+                            self.fanout[rid] = time.perf_counter() - self.target[1]
+                    headers["If-None-Match"] = r.headers.get("etag", "")   # only once handled
+                elif r.status_code != 304:
+                    self.errors[f"manifest_http_{r.status_code}"] += 1
+            except (httpx.HTTPError, RuntimeError) as e:
+                self.errors[f"ota_{type(e).__name__}"] += 1
+                await asyncio.sleep(1)
+            if not watch:
+                await asyncio.sleep(self.args.poll_interval)
+
+    async def download(self, client, rid, m):
+        if m.get("content_addressed"):
+            url = f"{self.gw}/blobs/sha256/{m['sha256']}"
+        else:
+            url = f"{self.gw}/artifact/{m['artifact']}"
+        while True:
+            async with client.stream("GET", url, headers={"X-Robot-Id": rid}, timeout=300) as r:
+                if r.status_code == 503:
+                    self.errors["artifact_http_503"] += 1
+                    retry = float(r.headers.get("retry-after", "5"))
+                else:
+                    r.raise_for_status()
+                    n = 0
+                    async for chunk in r.aiter_raw():
+                        n += len(chunk)
+                    if n != m["size"]:
+                        raise RuntimeError(f"artifact short: {n} of {m['size']} bytes")
+                    self.artifact_bytes += n
+                    return
+            await asyncio.sleep(retry * random.uniform(0.5, 1.5))
+
+
+async def wait_until(predicate, timeout, interval=0.2):
+    """Poll `predicate` (plain or async) until true; False on timeout."""
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        ok = predicate()
+        if asyncio.iscoroutine(ok):
+            ok = await ok
+        if ok:
+            return True
+        await asyncio.sleep(interval)
+    return False
+
+
+async def run(args):
+    fd_limit = raise_fd_limit()
+    workdir = tempfile.mkdtemp(prefix="fleet-bench-")
+    central = Central(workdir)
+    central_port = free_port()
+    server = uvicorn.Server(uvicorn.Config(central.app, host="127.0.0.1", port=central_port,
+                                           log_level="warning", access_log=False))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+
+    central.publish(await asyncio.to_thread(central.build, "1.0.0", args.artifact_mb))
+    gateway = Gateway(workdir, f"http://127.0.0.1:{central_port}", args.gateway_log or os.path.join(workdir, "gateway.log"))
+    gateway.start()
+    tasks = []
+    report = {}
+    limits = httpx.Limits(max_connections=2 * args.robots + 50, max_keepalive_connections=2 * args.robots + 50)
+    try:
+        async with httpx.AsyncClient(timeout=30, limits=limits) as client:
+            async def synced(version):
+                try:
+                    r = await client.get(f"{gateway.url}/ota/status")
+                    return r.status_code == 200 and r.json().get("cached_version") == version
+                except httpx.HTTPError:
+                    return False
+
+            if not await wait_until(lambda: synced("1.0.0"), 60):
+                raise RuntimeError(f"gateway did not sync the initial version; see {gateway.log_path}")
+
+            rss = {"peak": gateway.rss_mb()}
+
+            async def sample_rss():
+                while True:
+                    rss["peak"] = max(rss["peak"], gateway.rss_mb())
+                    await asyncio.sleep(0.5)
+
+            tasks.append(asyncio.create_task(sample_rss()))
+
+            # Ramp up the fleet
+            fleet = Fleet(args, gateway.url, "1.0.0")
+            for i in range(args.robots):
+                rid = f"bench-{i:05d}"
+                tasks.append(asyncio.create_task(fleet.metrics_loop(client, rid)))
+                tasks.append(asyncio.create_task(fleet.ota_loop(client, rid)))
+                await asyncio.sleep(args.ramp / args.robots)
+            cpu_start = gateway.cpu_seconds()
+            rows_start, accepted_start = central.rows, fleet.accepted
+
+            # Publish the next version while the telemetry load runs
+            next_manifest = await asyncio.to_thread(central.build, "1.0.1", args.artifact_mb)
+            load_started = published = time.perf_counter()
+            fleet.target = ("1.0.1", published)
+            central.publish(next_manifest)
+            sync = {}
+
+            async def time_sync():
+                if await wait_until(lambda: synced("1.0.1"), args.fanout_timeout):
+                    sync["seconds"] = time.perf_counter() - published
+
+            sync_task = asyncio.create_task(time_sync())
+
+            await asyncio.sleep(args.duration)
+            fleet.metrics_on = False
+            load_seconds = time.perf_counter() - load_started
+            rows_in_load = central.rows - rows_start
+            accepted_in_load = fleet.accepted - accepted_start
+            cpu_load = gateway.cpu_seconds() - cpu_start
+
+            # Fan-out completes (or times out); then the buffered telemetry drains
+            remaining = args.fanout_timeout - (time.perf_counter() - published)
+            await wait_until(lambda: len(fleet.fanout) >= args.robots, max(0.0, remaining))
+            await sync_task
+            await asyncio.sleep(args.metrics_interval)   # requests still in flight
+            backlog = fleet.accepted - central.rows
+            drain_started = time.perf_counter()
+            drained = await wait_until(lambda: central.rows >= fleet.accepted, args.drain_timeout)
+
+            server_stats = {}
+            try:
+                server_stats = (await client.get(f"{gateway.url}/db/stats")).json().get("http_metrics", {})
+            except (httpx.HTTPError, ValueError):
+                pass
+            ingest = summary(fleet.ingest_ms)
+            fanout = summary(list(fleet.fanout.values()))
+            report = {
+                "revision": revision(),
+                "started": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "host": {"python": platform.python_version(), "cpus": os.cpu_count(), "fd_limit": fd_limit},
+                "config": {
+                    **{k: v for k, v in vars(args).items() if k not in ("out", "gateway_log")},
+                    "env": {k: v for k, v in os.environ.items()
+                            if k.startswith(("INGEST_", "FLUSH_", "ARTIFACT_", "DB_", "GATEWAY_", "AUTO_FLUSH"))},
+                },
+                "ingest": {
+                    "requests": fleet.accepted,
+                    "rps": round(accepted_in_load / load_seconds, 1),
+                    "p50_ms": ingest["p50"],
+                    "p99_ms": ingest["p99"],
+                    "max_ms": ingest["max"],
+                    "gateway_p50_ms": server_stats.get("p50_ms"),
+                    "gateway_p99_ms": server_stats.get("p99_ms"),
+                },
+                "flush": {
+                    "rows_per_second": round(rows_in_load / load_seconds, 1),
+                    "backlog_rows": max(0, backlog),
+                    "drain_seconds": round(time.perf_counter() - drain_started, 2) if drained else None,
+                    "rows_received": central.rows,
+                },
+                "ota": {
+                    "artifact_mb": args.artifact_mb,
+                    "gateway_sync_seconds": round(sync["seconds"], 2) if "seconds" in sync else None,
+                    "robots_updated": len(fleet.fanout),
+                    "fanout_p50_seconds": fanout["p50"],
+                    "fanout_p99_seconds": fanout["p99"],
+                    "fanout_max_seconds": fanout["max"],
+                    "served_mb": round(fleet.artifact_bytes / (1024 * 1024), 1),
+                    "manifest_requests": fleet.manifest_requests,
+                },
+                "gateway": {
+                    "rss_peak_mb": rss["peak"],
+                    "rss_end_mb": gateway.rss_mb(),
+                    "cpu_seconds_during_load": round(cpu_load, 2),
+                },
+                "errors": dict(fleet.errors),
+            }
+    finally:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        gateway.stop()
+        server.should_exit = True
+        await server_task
+        if args.keep:
+            print(f"[bench] work directory kept at {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return report
+
+
+def main():
+    p = argparse.ArgumentParser(description="Simulate a robot fleet against one gateway and report JSON.")
+    p.add_argument("--robots", type=int, default=500)
+    p.add_argument("--duration", type=float, default=30, help="seconds of telemetry load after ramp-up")
+    p.add_argument("--ramp", type=float, default=5, help="seconds to start all robots")
+    p.add_argument("--metrics-interval", type=float, default=1.0, help="seconds between samples per robot")
+    p.add_argument("--manifest", choices=("watch", "poll"), default="watch")
+    p.add_argument("--poll-interval", type=float, default=30, help="manifest poll interval (--manifest poll)")
+    p.add_argument("--spread", type=float, default=10, help="max random delay before a robot downloads (OTA_WATCH_SPREAD)")
+    p.add_argument("--artifact-mb", type=float, default=8)
+    p.add_argument("--fanout-timeout", type=float, default=300, help="seconds after publish to wait for every robot")
+    p.add_argument("--drain-timeout", type=float, default=120)
+    p.add_argument("--out", help="also write the JSON report here")
+    p.add_argument("--gateway-log", help="gateway output (default: inside the temporary work directory)")
+    p.add_argument("--keep", action="store_true", help="keep the work directory (cache, SQLite, logs)")
+    args = p.parse_args()
+
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
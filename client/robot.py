@@ -1,9 +1,19 @@
-import os, time, json, hashlib, tarfile, subprocess
+import os, time, glob, shutil, tarfile, hashlib, subprocess
+import asyncio
+import contextlib
 import httpx
 import random
-from common.downloader import download_with_resume
+from concurrent.futures import ThreadPoolExecutor
+from common.downloader import async_download_with_resume, hash_prefix
+from common.verify_cache import VerifyCache, already_verified, SIGNATURES_VERIFIED, COSIGN_SECONDS
+from common import prom
 
 GATEWAY = os.getenv("GATEWAY_URL", "http://gateway:8081")
+# Product line and channel this robot follows; unset = the gateway's default
+OTA_PRODUCT = os.getenv("OTA_PRODUCT", "")
+OTA_CHANNEL = os.getenv("OTA_CHANNEL", "stable")
+OTA_BASE = f"{GATEWAY}/ns/{OTA_PRODUCT}/{OTA_CHANNEL}" if OTA_PRODUCT else GATEWAY
+ROBOT_ID = os.getenv("ROBOT_ID", "robot-1")
 
 STATE = "/app/state"
 COSIGN_PUB = os.getenv("COSIGN_PUB", "/app/cosign.pub")
@@ -17,21 +27,53 @@ os.makedirs(STATE, exist_ok=True)
 
 OTA_POLL_SECONDS = int(os.getenv("OTA_POLL_SECONDS", "30"))
 METRICS_SECONDS = int(os.getenv("METRICS_SECONDS", "10"))
+HEALTH_SECONDS = int(os.getenv("HEALTH_SECONDS", "30"))
+POLL_JITTER = float(os.getenv("POLL_JITTER", "0.2"))        # +/- share of each interval
+BACKOFF_MAX_SECONDS = float(os.getenv("BACKOFF_MAX_SECONDS", "60"))
+# Long-poll GET /manifest/watch instead of polling every OTA_POLL_SECONDS
+OTA_WATCH = os.getenv("OTA_WATCH", "true").lower() == "true"
+OTA_WATCH_SECONDS = float(os.getenv("OTA_WATCH_SECONDS", "30"))
+OTA_WATCH_SPREAD = float(os.getenv("OTA_WATCH_SPREAD", "10"))   # random delay before a pushed update
+EXTRACT_BUFFER = 1024 * 1024
+# Prometheus textfile (node_exporter --collector.textfile.directory), e.g. /app/state/robot.prom;
+# off by default, as it rewrites a file on the robot's flash every METRICS_SECONDS
+METRICS_TEXTFILE = os.getenv("METRICS_TEXTFILE", "")
+
+verify_cache = VerifyCache(f"{STATE}/verify-cache.json", COSIGN_PUB)
 
 # Track versions that triggered a rollback during this session
 FAILED_VERSIONS = set()
 
+# Shared between the agent tasks; only the OTA task changes version/installing
+AGENT = {"version": None, "healthy": True, "installing": False, "manifest_etag": None, "watch": OTA_WATCH}
+
+INSTALL_PHASES = ("download", "stage", "verify", "extract", "activate", "self_test")
+PHASE_SECONDS = {name: prom.histogram("robot_install_phase_seconds", "Install phase duration", prom.DURATION_BUCKETS,
+                                      phase=name)
+                 for name in INSTALL_PHASES}
+UPDATE_SECONDS = prom.histogram("robot_update_seconds", "Update duration, download to self-test", prom.DURATION_BUCKETS)
+UPDATES = {result: prom.counter("robot_updates_total", "Update attempts", result=result)
+           for result in ("success", "failure")}
+prom.gauge("robot_healthy", "1 if the last self-test passed", fn=lambda: int(AGENT["healthy"]))
+prom.gauge("robot_installing", "1 while an update is being installed", fn=lambda: int(AGENT["installing"]))
+prom.gauge("robot_failed_versions", "Versions rolled back this session", fn=lambda: len(FAILED_VERSIONS))
+
 
 def log(msg: str) -> None:
     print(msg, flush=True)
 
 
-def sha256_file(path: str) -> str:
-    h = hashlib.sha256()
-    with open(path, "rb") as f:
-        for chunk in iter(lambda: f.read(8192), b""):
-            h.update(chunk)
-    return h.hexdigest()
+@contextlib.contextmanager
+def phase(timings: dict, name: str):
+    """Record the wall time of an install phase in timings[name]."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        timings[name] = round(elapsed, 3)
+        if name in PHASE_SECONDS:
+            PHASE_SECONDS[name].observe(elapsed)
 
 
 def current_version() -> str:
@@ -46,53 +88,125 @@ def write_current_version(v: str) -> None:
     open(os.path.join(CUR, "version.txt"), "w", encoding="utf-8").write(v)
 
 
-def verify_blob(artifact_path: str, bundle_path: str) -> None:
+def verify_blob(artifact_path: str, bundle_path: str, artifact_sha256: str = None) -> None:
+    # A retry of an already-verified (artifact, bundle, key) skips cosign
+    if artifact_sha256:
+        how = already_verified(verify_cache, COSIGN_PUB, artifact_sha256, bundle_path)
+        if how:
+            log(f"Signature verified ({how})")
+            return
+
     # Requires cosign installed in robot container
-    subprocess.check_call(
-        [
-            "cosign",
-            "verify-blob",
-            "--key",
-            COSIGN_PUB,
-            "--bundle",
-            bundle_path,
-            artifact_path,
-        ]
-    )
+    started = time.perf_counter()
+    try:
+        subprocess.check_call(
+            [
+                "cosign",
+                "verify-blob",
+                "--key",
+                COSIGN_PUB,
+                "--bundle",
+                bundle_path,
+                artifact_path,
+            ]
+        )
+    finally:
+        COSIGN_SECONDS.observe(time.perf_counter() - started)
+    SIGNATURES_VERIFIED["cosign"].inc()
+    if artifact_sha256:
+        verify_cache.record(artifact_sha256, bundle_path)
 
 
 def safe_rmtree(path: str) -> None:
-    if os.path.exists(path):
-        subprocess.call(["rm", "-rf", path])
+    if os.path.lexists(path):
+        shutil.rmtree(path, ignore_errors=True)
 
 
-def install_tarball(tgz_path: str) -> None:
-    # 1. Prepare NEW directory
+class HashingReader:
+    """Read-only file wrapper that feeds every byte read through sha256."""
+
+    def __init__(self, f):
+        self.f = f
+        self.h = hashlib.sha256()
+
+    def read(self, n: int = -1) -> bytes:
+        data = self.f.read(n)
+        self.h.update(data)
+        return data
+
+    def hexdigest_to_end(self) -> str:
+        # tarfile stops at the end-of-archive marker; hash any trailing bytes
+        for chunk in iter(lambda: self.f.read(EXTRACT_BUFFER), b""):
+            self.h.update(chunk)
+        return self.h.hexdigest()
+
+
+def stage_tarball(tgz_path: str, expected_sha256: str = None) -> str:
+    """
+    Decompress, extract into NEW and hash the tarball in a single streaming
+    pass. NEW is removed again if the digest does not match.
+    """
     safe_rmtree(NEW)
     os.makedirs(NEW, exist_ok=True)
 
+    with open(tgz_path, "rb") as f:
+        src = HashingReader(f)
+        with tarfile.open(fileobj=src, mode="r|gz", bufsize=EXTRACT_BUFFER) as t:
+            # filter='data' rejects absolute paths, links out of NEW and device files
+            t.extractall(NEW, filter="data")
+        digest = src.hexdigest_to_end()
+
+    if expected_sha256 and digest != expected_sha256:
+        safe_rmtree(NEW)
+        raise RuntimeError(f"checksum mismatch while extracting {os.path.basename(tgz_path)}")
+    return digest
+
+
+def install_tarball(tgz_path: str, bundle_path: str = None, expected_sha256: str = None,
+                    timings: dict = None, version: str = None) -> None:
+    timings = {} if timings is None else timings
+
+    # 1. Stage into NEW while the signature is checked in parallel; nothing is
+    #    activated unless both the digest and the signature check out
     log(f"DEBUG: Extracting {tgz_path}...")
-    with tarfile.open(tgz_path, "r:gz") as t:
-        # filter='data' stops the crash/loop at line 35
-        t.extractall(NEW, filter='data') 
+    with phase(timings, "stage"), ThreadPoolExecutor(max_workers=1) as pool:
+        verified = None
+        if bundle_path is not None:
+            def _verify():
+                with phase(timings, "verify"):
+                    verify_blob(tgz_path, bundle_path, expected_sha256)
+            verified = pool.submit(_verify)
+        try:
+            with phase(timings, "extract"):
+                stage_tarball(tgz_path, expected_sha256)
+        finally:
+            if verified is not None:
+                try:
+                    verified.result()
+                except Exception:
+                    safe_rmtree(NEW)
+                    raise
 
     # 2. ACTIVATE (Move to CURRENT so we have an OLD to roll back to)
     log("DEBUG: Activating version (Moving NEW -> CURRENT)...")
-    safe_rmtree(OLD)
-    if os.path.exists(CUR):
-        os.rename(CUR, OLD)
-    os.rename(NEW, CUR)
+    with phase(timings, "activate"):
+        safe_rmtree(OLD)
+        if os.path.exists(CUR):
+            os.rename(CUR, OLD)
+        os.rename(NEW, CUR)
 
     # 3. THE LIVE TEST (This is what you just ran manually)
     app_sh_cur = os.path.join(CUR, "app.sh")
     try:
         log(f"DEBUG: Running self-test at {app_sh_cur}")
         # MUST use check_call to trigger the 'except' block on failure
-        subprocess.check_call(["bash", app_sh_cur, "--self-test"], timeout=10)
+        with phase(timings, "self_test"):
+            subprocess.check_call(["bash", app_sh_cur, "--self-test"], timeout=10)
         log("SUCCESS: Healthcheck passed.")
     except subprocess.CalledProcessError:
         # 4. PERFORM ROLLBACK
-        FAILED_VERSIONS.add(httpx.get(f"{GATEWAY}/manifest", timeout=MANIFEST_TIMEOUT).json()["version"])
+        if version is not None:
+            FAILED_VERSIONS.add(version)
         log("CRITICAL: Self-test failed! TRIGGERING ROLLBACK...")
         if os.path.exists(OLD):
             safe_rmtree(CUR)
@@ -112,92 +226,291 @@ def rollback_to_old() -> bool:
     return True
 
 
-def try_update(client: httpx.Client) -> str:
-    m = client.get(f"{GATEWAY}/manifest", timeout=MANIFEST_TIMEOUT).json()
+def file_url(m: dict, name: str, digest: str = None) -> str:
+    """Where to fetch a manifest file: by digest when the gateway has a blob store, else by name."""
+    if digest and m.get("content_addressed"):
+        return f"{GATEWAY}/blobs/sha256/{digest}"
+    return f"{OTA_BASE}/artifact/{name}"
+
+
+async def try_delta(client: httpx.AsyncClient, m: dict, art_path: str) -> bool:
+    """Rebuild the new artifact from the installed version's tarball plus a patch."""
+    cur = current_version()
+    product = m["artifact"].rsplit("-v", 1)[0]
+    base = f"{STATE}/{product}-v{cur}.tar.gz"
+    entry = next((d for d in m.get("deltas", []) if d.get("from") == cur), None)
+    if entry is None or not os.path.exists(base) or shutil.which("zstd") is None:
+        return False
+
+    patch_path = f"{STATE}/{entry['patch']}"
+    rebuilt = art_path + ".delta"
+    try:
+        await async_download_with_resume(
+            file_url(m, entry["patch"], entry["sha256"]),
+            patch_path,
+            timeout=DOWNLOAD_TIMEOUT,
+            expected_size=entry.get("size"),
+            expected_sha256=entry["sha256"],
+            client=client,
+        )
+        proc = await asyncio.create_subprocess_exec(
+            "zstd", "-q", "-f", "-d", "--long=30", f"--patch-from={base}", patch_path, "-o", rebuilt
+        )
+        if await proc.wait() != 0:
+            raise RuntimeError("zstd --patch-from failed")
+        if (await asyncio.to_thread(hash_prefix, rebuilt)).hexdigest() != m["sha256"]:
+            raise RuntimeError("rebuilt artifact checksum mismatch")
+        os.replace(rebuilt, art_path)
+        log(f"Rebuilt {m['artifact']} from {cur} using a {entry.get('size')} byte delta")
+        return True
+    except Exception as e:
+        log(f"Delta update failed, falling back to full artifact: {e}")
+        return False
+    finally:
+        for p in (patch_path, rebuilt):
+            if os.path.exists(p):
+                os.remove(p)
+
+
+def prune_artifacts(keep: set) -> None:
+    """Drop downloaded tarballs/bundles other than the installed version's (the next delta base)."""
+    for p in glob.glob(f"{STATE}/*-v*.tar.gz*"):
+        if os.path.basename(p) not in keep:
+            os.remove(p)
+
+
+def watch_unsupported(r: httpx.Response) -> bool:
+    """405, or the router's 404; a 404 "manifest not found" only means the gateway has nothing synced yet."""
+    if r.status_code == 405:
+        return True
+    if r.status_code != 404:
+        return False
+    try:
+        body = r.json()
+    except ValueError:
+        return True
+    return not isinstance(body, dict) or body.get("detail") != "manifest not found"
+
+
+async def fetch_manifest(client: httpx.AsyncClient):
+    """(manifest, etag), or None when it is unchanged since the last handled one (304)."""
+    headers = {"If-None-Match": AGENT["manifest_etag"]} if AGENT["manifest_etag"] else {}
+    if AGENT["watch"]:
+        r = await client.get(
+            f"{OTA_BASE}/manifest/watch",
+            params={"timeout": OTA_WATCH_SECONDS},
+            headers=headers,
+            timeout=OTA_WATCH_SECONDS + MANIFEST_TIMEOUT,
+        )
+        if watch_unsupported(r):
+            log("Gateway has no manifest watch; polling instead")
+            AGENT["watch"] = False
+    if not AGENT["watch"]:
+        r = await client.get(f"{OTA_BASE}/manifest", headers=headers, timeout=MANIFEST_TIMEOUT)
+    if r.status_code == 304:
+        return None
+    r.raise_for_status()
+    return r.json(), r.headers.get("etag")
+
+
+async def try_update(client: httpx.AsyncClient) -> str:
+    fetched = await fetch_manifest(client)
+    if fetched is None:
+        return current_version()
+    m, etag = fetched
 
     version = m["version"]
-    if version == current_version():
-        return version
-    
-    if version in FAILED_VERSIONS:
-        # Skip the update silently to avoid log spam
+    if version == current_version() or version in FAILED_VERSIONS:
+        # Nothing to do (failed versions are skipped silently to avoid log spam)
+        AGENT["manifest_etag"] = etag
         return current_version()
 
+    if AGENT["watch"] and AGENT["manifest_etag"]:
+        # Every robot on the gateway wakes at once; spread the downloads
+        await asyncio.sleep(random.uniform(0, OTA_WATCH_SPREAD))
+
     artifact = m["artifact"]
     bundle = m["bundle"]
     expected_sha = m["sha256"]
 
     art_path = f"{STATE}/{artifact}"
     bun_path = f"{STATE}/{bundle}"
+    timings = {}
+    started = time.perf_counter()
 
-    # download artifact + bundle
-    download_with_resume(f"{GATEWAY}/artifact/{artifact}", art_path, timeout=30)
-    download_with_resume(f"{GATEWAY}/artifact/{bundle}", bun_path, timeout=30)
-
-    # checksum and signature
-    if sha256_file(art_path) != expected_sha:
-        raise RuntimeError("checksum mismatch")
-
-    verify_blob(art_path, bun_path)
-
-    # This call now handles directory swapping and rollback internally
-    install_tarball(art_path)
+    try:
+        # download artifact (or patch + rebuild) and bundle; the checksum is
+        # verified while downloading
+        with phase(timings, "download"):
+            if not await try_delta(client, m, art_path):
+                await async_download_with_resume(
+                    file_url(m, artifact, expected_sha),
+                    art_path,
+                    timeout=DOWNLOAD_TIMEOUT,
+                    expected_size=m.get("size"),
+                    expected_sha256=expected_sha,
+                    client=client,
+                )
+            await async_download_with_resume(
+                file_url(m, bundle, m.get("bundle_sha256")),
+                bun_path,
+                timeout=DOWNLOAD_TIMEOUT,
+                expected_sha256=m.get("bundle_sha256"),
+                client=client,
+            )
+
+        # Verifies the signature, re-checks the digest while extracting, then
+        # handles directory swapping and rollback internally. It runs in a
+        # worker thread so metrics keep flowing during the install.
+        AGENT["installing"] = True
+        try:
+            await asyncio.to_thread(install_tarball, art_path, bun_path, expected_sha, timings, version)
+        except Exception:
+            if not os.path.exists(CUR) and rollback_to_old():
+                log("Emergency manual rollback applied.")
+            raise
+        finally:
+            AGENT["installing"] = False
+    except Exception:
+        UPDATES["failure"].inc()
+        raise
+    finally:
+        log("INSTALL TIMINGS: " + " ".join(f"{k}={v:.3f}s" for k, v in timings.items()))
 
     # persist version only after successful install
+    UPDATES["success"].inc()
+    UPDATE_SECONDS.observe(time.perf_counter() - started)
     write_current_version(version)
+    prune_artifacts({artifact, bundle})
+    AGENT["manifest_etag"] = etag
     log(f"UPDATED TO {version}")
 
     return version
 
 
-# ---- main loop ----
-version = current_version()
-last_ota = 0.0
-last_metrics = 0.0
-backoff = 2
-max_backoff = 60
+# -----------------------------
+# Agent tasks
+# -----------------------------
+def jittered(seconds: float) -> float:
+    """Spread polls by +/- POLL_JITTER so a fleet does not hit the gateway in lockstep."""
+    return seconds * random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
 
-client = httpx.Client()
-installing = False
 
-while True:
-    now = time.time()
+class Backoff:
+    """Exponential backoff with full jitter, reset after a success."""
 
-    if now - last_ota >= OTA_POLL_SECONDS:
-        last_ota = now
+    def __init__(self, base: float = 2, cap: float = None):
+        self.base = base
+        self.cap = BACKOFF_MAX_SECONDS if cap is None else cap
+        self.current = base
+
+    def reset(self) -> None:
+        self.current = self.base
+
+    def next(self) -> float:
+        delay = random.uniform(self.base / 2, self.current)
+        self.current = min(self.cap, self.current * 2)
+        return delay
+
+
+class RetryLater(Exception):
+    """The gateway asked us to come back later (429 + Retry-After)."""
+
+    def __init__(self, seconds: float):
+        super().__init__(f"asked to retry in {seconds:.0f}s")
+        self.seconds = seconds
+
+
+def raise_for_retry_after(r: httpx.Response) -> None:
+    if r.status_code == 429:
         try:
-            newv = None
-            newv = try_update(client)
-            if newv != version:
-                installing = True
-                try:
-                    version = newv
-                    backoff = 2
-                finally:
-                    installing = False
-        except Exception as e:
-            if newv is not None:
-                FAILED_VERSIONS.add(newv)
-                if rollback_to_old():
-                    version = current_version()
-                    log("Emergency manual rollback applied.")
-            
-            time.sleep(backoff)
-            backoff = min(max_backoff, backoff * 2)
-
-    if now - last_metrics >= METRICS_SECONDS:
-        last_metrics = now
-        payload = {
-            "robot_id": "robot-1",
-            "version": version,
-            "cpu": round(random.random() * 100, 2),
-            "mem": round(random.random() * 100, 2),
-            "healthy": True,
-        }
+            seconds = float(r.headers.get("retry-after", ""))
+        except ValueError:
+            seconds = BACKOFF_MAX_SECONDS
+        raise RetryLater(seconds)
+
+
+async def run_every(name: str, interval, fn) -> None:
+    """
+    Run fn() every ~interval seconds (a number or a callable returning one);
+    failures back off without affecting other tasks, and RetryLater waits as
+    long as the gateway asked.
+    """
+    backoff = Backoff()
+    seconds = interval() if callable(interval) else interval
+    await asyncio.sleep(random.uniform(0, seconds))   # desynchronise robots started together
+    while True:
         try:
-            r = client.post(f"{GATEWAY}/metrics", json=payload, timeout=2)
-            log(f"metrics sent: {r.status_code} {payload}")
+            await fn()
+            backoff.reset()
+            delay = jittered(interval() if callable(interval) else interval)
+        except RetryLater as e:
+            # Jittered so a fleet turned away together does not come back together
+            delay = jittered(max(e.seconds, interval() if callable(interval) else interval))
+            log(f"{name}: gateway busy; retrying in {delay:.1f}s")
         except Exception as e:
-            log(f"metrics failed: {e}")
-
-    time.sleep(0.2)
+            delay = backoff.next()
+            log(f"{name} failed: {e}; retrying in {delay:.1f}s")
+        await asyncio.sleep(delay)
+
+
+async def ota_once(client: httpx.AsyncClient) -> None:
+    AGENT["version"] = await try_update(client)
+
+
+async def metrics_once(client: httpx.AsyncClient) -> None:
+    payload = {
+        "robot_id": ROBOT_ID,
+        "version": AGENT["version"],
+        "cpu": round(random.random() * 100, 2),
+        "mem": round(random.random() * 100, 2),
+        "healthy": AGENT["healthy"],
+        "failed_versions": sorted(FAILED_VERSIONS),   # lets the gateway's rollout count failures
+    }
+    if OTA_PRODUCT:
+        payload.update(product=OTA_PRODUCT, channel=OTA_CHANNEL)
+    r = await client.post(f"{GATEWAY}/metrics", json=payload, timeout=2)
+    log(f"metrics sent: {r.status_code} {payload}")
+    raise_for_retry_after(r)   # telemetry buffer full: this sample is dropped
+    r.raise_for_status()
+
+
+async def textfile_once() -> None:
+    await asyncio.to_thread(prom.REGISTRY.write_textfile, METRICS_TEXTFILE)
+
+
+async def health_once(client: httpx.AsyncClient) -> None:
+    app_sh = os.path.join(CUR, "app.sh")
+    if AGENT["installing"] or not os.path.exists(app_sh):
+        return  # the install runs its own self-test
+    proc = await asyncio.create_subprocess_exec(
+        "bash", app_sh, "--self-test", stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        rc = await asyncio.wait_for(proc.wait(), timeout=10)
+    except asyncio.TimeoutError:
+        proc.kill()
+        rc = -1
+    healthy = rc == 0
+    if healthy != AGENT["healthy"]:
+        log(f"health changed: {'healthy' if healthy else 'UNHEALTHY'}")
+    AGENT["healthy"] = healthy
+
+
+async def main() -> None:
+    AGENT["version"] = current_version()
+    limits = httpx.Limits(max_connections=8, max_keepalive_connections=4)
+    async with httpx.AsyncClient(
+        timeout=DOWNLOAD_TIMEOUT, limits=limits, follow_redirects=True, headers={"X-Robot-Id": ROBOT_ID}
+    ) as client:
+        await asyncio.gather(
+            # a long-poll paces itself; plain polling waits OTA_POLL_SECONDS
+            run_every("ota", lambda: 0 if AGENT["watch"] else OTA_POLL_SECONDS, lambda: ota_once(client)),
+            run_every("metrics", METRICS_SECONDS, lambda: metrics_once(client)),
+            run_every("health", HEALTH_SECONDS, lambda: health_once(client)),
+            *([run_every("textfile", METRICS_SECONDS, textfile_once)] if METRICS_TEXTFILE else []),
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,13 +1,141 @@
 import os
+import json
+import time
+import asyncio
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import httpx
+from common import prom
 
+# ---- Segmented (multi-connection) downloads ----
+DOWNLOAD_SEGMENTS = int(os.getenv("DOWNLOAD_SEGMENTS", "4"))
+DOWNLOAD_MIN_SEGMENT_BYTES = int(os.getenv("DOWNLOAD_MIN_SEGMENT_BYTES", str(4 * 1024 * 1024)))
+# fsync + persist segment progress after this many new bytes
+DOWNLOAD_CHECKPOINT_BYTES = int(os.getenv("DOWNLOAD_CHECKPOINT_BYTES", str(8 * 1024 * 1024)))
 
-def download_with_resume(url: str, dest: str, timeout: int = 30):
+
+DOWNLOADS = prom.counter("ota_downloads_total", "Completed downloads")
+DOWNLOAD_RESUMES = prom.counter("ota_download_resumes_total", "Completed downloads that continued a partial file")
+DOWNLOAD_FAILURES = prom.counter("ota_download_verification_failures_total", "Downloads discarded for a size/sha256 mismatch")
+DOWNLOAD_BYTES = prom.counter("ota_download_bytes_total", "Bytes transferred by completed downloads")
+DOWNLOAD_SECONDS = prom.histogram("ota_download_seconds", "Download duration", prom.DURATION_BUCKETS)
+DOWNLOAD_THROUGHPUT = prom.histogram("ota_download_bytes_per_second", "Download throughput", prom.THROUGHPUT_BUCKETS)
+SHA256_SECONDS = prom.histogram("sha256_file_seconds", "Time to hash a file (or file prefix) on disk")
+
+
+class RangeNotSupported(Exception):
+    """Server did not honor a ranged request for a segmented download."""
+
+
+class DownloadVerificationError(RuntimeError):
+    """Downloaded size or digest does not match what the caller expected."""
+
+
+def download_with_resume(url: str, dest: str, timeout: int = 30, segments: int = None,
+                         expected_size: int = None, expected_sha256: str = None):
+    """
+    Download url to dest via dest.part, resuming where a previous attempt stopped.
+
+    When the server honors byte ranges and the file is large enough, the
+    file is split into up to `segments` ranges fetched concurrently, with
+    per-range progress in dest.part.json. Otherwise (or if ranges turn out not
+    to work) it falls back to a single resumable stream.
+
+    The SHA-256 is computed while bytes arrive (a resume only re-reads the
+    prefix already on disk). Returns (sha256_hex, size). Raises
+    DownloadVerificationError before transferring anything if the server's
+    size differs from expected_size, and discards the file if the final
+    digest differs from expected_sha256.
+    """
     os.makedirs(os.path.dirname(dest) or ".", exist_ok=True)
+    segments = DOWNLOAD_SEGMENTS if segments is None else segments
 
     tmp = dest + ".part"
+    state_path = tmp + ".json"
+    result = None
+    started, prefix = time.perf_counter(), _bytes_on_disk(tmp, state_path)
+
+    if segments > 1 and (os.path.exists(state_path) or not os.path.exists(tmp)):
+        with httpx.Client(timeout=timeout, follow_redirects=True) as client:
+            plan = _load_plan(state_path, tmp, url)
+            if plan is not None and expected_size is not None and plan["size"] != expected_size:
+                _discard(tmp, state_path)  # partial file belongs to different content
+                plan = None
+            plan = plan or _probe(client, url, segments)
+            if plan is not None:
+                _check_size(plan["size"], expected_size)
+                try:
+                    result = _download_segments(client, url, tmp, state_path, plan)
+                except RangeNotSupported as e:
+                    print(f"[download] {e}; falling back to single stream", flush=True)
+                    _discard(tmp, state_path)
+
+    if result is None:
+        result = _download_stream(url, tmp, timeout, expected_size)
+
+    digest, size = result
+    if expected_sha256 and digest != expected_sha256:
+        _discard(tmp, state_path)
+        DOWNLOAD_FAILURES.inc()
+        raise DownloadVerificationError(f"sha256 mismatch for {url}: got {digest}")
+
+    os.replace(tmp, dest)
+    _discard(state_path)
+    _record(started, prefix, size)
+    print(f"[download] Completed: {dest}", flush=True)
+    return digest, size
+
+
+def _bytes_on_disk(tmp, state_path):
+    """Bytes a previous attempt left for this download (0 for a fresh one)."""
+    try:
+        if os.path.exists(state_path):
+            with open(state_path) as f:
+                return sum(d for _, _, d in json.load(f)["segments"])
+        return os.path.getsize(tmp)
+    except (OSError, ValueError, KeyError):
+        return 0
+
+
+def _record(started, prefix, size):
+    elapsed = time.perf_counter() - started
+    transferred = max(0, size - prefix)
+    DOWNLOADS.inc()
+    if prefix:
+        DOWNLOAD_RESUMES.inc()
+    DOWNLOAD_BYTES.inc(transferred)
+    DOWNLOAD_SECONDS.observe(elapsed)
+    if elapsed > 0:
+        DOWNLOAD_THROUGHPUT.observe(transferred / elapsed)
+
+
+def _check_size(size, expected_size):
+    if expected_size is not None and size is not None and size != expected_size:
+        DOWNLOAD_FAILURES.inc()
+        raise DownloadVerificationError(f"size mismatch: server has {size} bytes, expected {expected_size}")
+
+
+def hash_prefix(path, length=None, h=None):
+    """sha256 object over the first `length` bytes of path (whole file if None)."""
+    started = time.perf_counter()
+    h = h or hashlib.sha256()
+    remaining = os.path.getsize(path) if length is None else length
+    with open(path, "rb") as f:
+        while remaining > 0:
+            chunk = f.read(min(1024 * 1024, remaining))
+            if not chunk:
+                break
+            h.update(chunk)
+            remaining -= len(chunk)
+    SHA256_SECONDS.observe(time.perf_counter() - started)
+    return h
+
+
+def _download_stream(url, tmp, timeout, expected_size=None):
     headers = {}
     mode = "wb"
+    h = hashlib.sha256()
 
     if os.path.exists(tmp):
         start = os.path.getsize(tmp)
@@ -15,9 +143,14 @@ def download_with_resume(url: str, dest: str, timeout: int = 30):
         mode = "ab"
         print(f"[download] Resuming from {start} bytes", flush=True)
     else:
+        start = 0
         print("[download] Starting fresh download", flush=True)
 
     with httpx.stream("GET", url, headers=headers, timeout=timeout) as r:
+        if r.status_code == 416 and start and expected_size == start:
+            # Previous attempt already fetched everything
+            return hash_prefix(tmp).hexdigest(), start
+
         r.raise_for_status()
 
         if r.status_code not in (200, 206):
@@ -26,22 +159,429 @@ def download_with_resume(url: str, dest: str, timeout: int = 30):
         # Range requested but not honored → restart cleanly
         if "Range" in headers and r.status_code == 200:
             mode = "wb"
+            start = 0
             print("[download] Server ignored Range; restarting download", flush=True)
 
+        if r.status_code == 206:
+            total = _content_range_total(r)
+        else:
+            total = int(r.headers["content-length"]) if "content-length" in r.headers else None
+        _check_size(total, expected_size)
+
+        if start:
+            hash_prefix(tmp, start, h)
+
+        size = start
         with open(tmp, mode) as f:
             for chunk in r.iter_bytes():
                 if chunk:
                     f.write(chunk)
+                    h.update(chunk)
+                    size += len(chunk)
+                    if expected_size is not None and size > expected_size:
+                        raise DownloadVerificationError(f"received more than {expected_size} bytes")
             f.flush()
             os.fsync(f.fileno())
 
+    return h.hexdigest(), size
+
+
+# -----------------------------
+# Segmented download helpers
+# -----------------------------
+# A one-byte ranged GET rather than HEAD: the OTA routes are GET-only, and a
+# 206 with a Content-Range proves the server honors ranges for this file
+PROBE_HEADERS = {"Range": "bytes=0-0"}
+
+
+def _probe(client, url, segments):
+    with client.stream("GET", url, headers=PROBE_HEADERS) as r:
+        return _plan_from_probe(r, url, segments)
+
+
+def _plan_from_probe(r, url, segments):
+    """Plan a segmented download, or None if single-stream is the better fit."""
+    size = _content_range_total(r) if r.status_code == 206 else None
+    if not size:
+        return None
+    n = min(segments, size // DOWNLOAD_MIN_SEGMENT_BYTES)
+    if n < 2:
+        return None
+    step = -(-size // n)
+    return {
+        "url": url,
+        "size": size,
+        # Sent as If-Range so a changed file comes back as 200 instead of mixing versions
+        "validator": r.headers.get("etag") or r.headers.get("last-modified"),
+        "segments": [[s, min(s + step, size), 0] for s in range(0, size, step)],
+    }
+
+
+def _load_plan(state_path, tmp, url):
+    """Saved per-segment progress, if it still matches the .part file on disk."""
+    if not os.path.exists(state_path):
+        return None
+    try:
+        with open(state_path) as f:
+            plan = json.load(f)
+        if plan.get("url") == url and os.path.getsize(tmp) == plan["size"]:
+            done = sum(d for _, _, d in plan["segments"])
+            print(f"[download] Resuming segmented download at {done}/{plan['size']} bytes", flush=True)
+            return plan
+    except (OSError, ValueError, KeyError):
+        pass
+    _discard(tmp, state_path)
+    return None
+
+
+def _save_plan(state_path, plan):
+    tmp = state_path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(plan, f)
+    os.replace(tmp, state_path)
+
+
+def _discard(*paths):
+    for p in paths:
+        try:
+            os.remove(p)
+        except FileNotFoundError:
+            pass
+
+
+class _Progress:
+    """
+    Tracks per-segment progress, checkpoints it to the sidecar file, and
+    hashes the file's contiguous prefix as it grows. Chunks landing exactly at
+    the hashed frontier are hashed from memory; bytes written ahead of it are
+    read back (from page cache) once the segments before them complete.
+    """
+
+    def __init__(self, fd, state_path, plan, on_progress=None):
+        self.fd = fd
+        self.state_path = state_path
+        self.plan = plan
+        self.on_progress = on_progress
+        self.done = sum(d for _, _, d in plan["segments"])
+        self.lock = threading.Lock()
+        self.unsaved = 0
+        self.hasher = hashlib.sha256()
+        self.hashed = 0
+
+    def advance(self, seg, offset, chunk):
+        with self.lock:
+            seg[2] += len(chunk)
+            self.done += len(chunk)
+            self.unsaved += len(chunk)
+            if offset == self.hashed:
+                self.hasher.update(chunk)
+                self.hashed += len(chunk)
+            self.catch_up()
+            if self.unsaved >= DOWNLOAD_CHECKPOINT_BYTES:
+                self.checkpoint()
+        if self.on_progress:
+            self.on_progress(self.done, self.plan["size"])
+
+    def catch_up(self):
+        for start, end, done in self.plan["segments"]:
+            if self.hashed >= end:
+                continue
+            frontier = start + done
+            while self.hashed < frontier:
+                data = os.pread(self.fd, min(1024 * 1024, frontier - self.hashed), self.hashed)
+                if not data:
+                    raise RuntimeError("short read while hashing")
+                self.hasher.update(data)
+                self.hashed += len(data)
+            if frontier < end:
+                return
+
+    def save(self):
+        with self.lock:
+            self.checkpoint()
+
+    def checkpoint(self):
+        # Data must be durable before the sidecar claims it is there
+        os.fsync(self.fd)
+        _save_plan(self.state_path, self.plan)
+        self.unsaved = 0
+
+
+def _content_range_total(r):
+    # "bytes 0-99/1234" -> 1234
+    total = r.headers.get("content-range", "").rpartition("/")[2]
+    return int(total) if total.isdigit() else None
+
+
+def _segment_request(progress, seg):
+    """(resume offset, request headers) for a segment, or None if it is complete."""
+    start, end, done = seg
+    pos = start + done
+    if pos >= end:
+        return None
+    headers = {"Range": f"bytes={pos}-{end - 1}"}
+    if progress.plan.get("validator"):
+        headers["If-Range"] = progress.plan["validator"]
+    return pos, headers
+
+
+def _check_segment_response(r, progress, pos, end):
+    r.raise_for_status()
+    if r.status_code != 206 or _content_range_total(r) != progress.plan["size"]:
+        raise RangeNotSupported(f"range {pos}-{end - 1} answered with HTTP {r.status_code}")
+
+
+def _write_segment_chunk(progress, seg, pos, chunk):
+    """pwrite one chunk at pos, update progress/hash, and return the new offset."""
+    if pos + len(chunk) > seg[1]:
+        raise RuntimeError(f"segment {seg[0]}-{seg[1]} overran")
+    offset = pos
+    view = memoryview(chunk)
+    while view:
+        written = os.pwrite(progress.fd, view, pos)
+        view = view[written:]
+        pos += written
+    progress.advance(seg, offset, chunk)
+    return pos
+
+
+def _fetch_segment(client, url, seg, progress):
+    req = _segment_request(progress, seg)
+    if req is None:
+        return
+    pos, headers = req
+
+    with client.stream("GET", url, headers=headers) as r:
+        _check_segment_response(r, progress, pos, seg[1])
+        for chunk in r.iter_bytes():
+            if chunk:
+                pos = _write_segment_chunk(progress, seg, pos, chunk)
+
+    if pos != seg[1]:
+        raise RuntimeError(f"segment {seg[0]}-{seg[1]} ended early at {pos}")
+
+
+def _open_segmented(tmp, state_path, plan, on_progress=None):
+    size = plan["size"]
+    fd = os.open(tmp, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if os.fstat(fd).st_size != size:
+            # Preallocate so segments can be written in place
+            if hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(fd, 0, size)
+            else:
+                os.ftruncate(fd, size)
+            _save_plan(state_path, plan)
+            print(f"[download] Starting segmented download: {len(plan['segments'])} x ~{plan['segments'][0][1]} bytes", flush=True)
+
+        progress = _Progress(fd, state_path, plan, on_progress)
+        with progress.lock:
+            progress.catch_up()  # re-hash the prefix a previous attempt left on disk
+        return progress
+    except Exception:
+        os.close(fd)
+        raise
+
+
+def _finish_segmented(progress, errors):
+    """Surface the first error (range failures first), else return (digest, size)."""
+    for e in errors:
+        if isinstance(e, RangeNotSupported):
+            raise e
+    for e in errors:
+        if e is not None:
+            raise e
+
+    size = progress.plan["size"]
+    with progress.lock:
+        progress.catch_up()
+    if progress.hashed != size:
+        raise RuntimeError(f"hashed {progress.hashed} of {size} bytes")
+    return progress.hasher.hexdigest(), size
+
+
+def _download_segments(client, url, tmp, state_path, plan):
+    progress = _open_segmented(tmp, state_path, plan)
+    try:
+        pending = [seg for seg in plan["segments"] if seg[0] + seg[2] < seg[1]]
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, len(pending))) as pool:
+                futures = [pool.submit(_fetch_segment, client, url, seg, progress) for seg in pending]
+                errors = [f.exception() for f in futures]
+        finally:
+            progress.save()
+        return _finish_segmented(progress, errors)
+    finally:
+        os.close(progress.fd)
+
+
+# -----------------------------
+# Async variant (same .part/.part.json layout as the sync path)
+# -----------------------------
+async def async_download_with_resume(url: str, dest: str, timeout: int = 30, segments: int = None,
+                                     expected_size: int = None, expected_sha256: str = None,
+                                     client: httpx.AsyncClient = None, on_progress=None):
+    """
+    Non-blocking download_with_resume for asyncio callers.
+
+    Network I/O runs on the event loop; file writes and hashing run in the
+    default thread pool. Pass a pooled `client` to reuse connections.
+    `on_progress(done_bytes, total_bytes_or_None)` is called as data arrives
+    (from a worker thread for segmented downloads).
+    Returns (sha256_hex, size).
+    """
+    if client is None:
+        async with httpx.AsyncClient(timeout=timeout, follow_redirects=True) as own:
+            return await async_download_with_resume(
+                url, dest, timeout, segments, expected_size, expected_sha256, own, on_progress
+            )
+
+    await asyncio.to_thread(os.makedirs, os.path.dirname(dest) or ".", exist_ok=True)
+    segments = DOWNLOAD_SEGMENTS if segments is None else segments
+
+    tmp = dest + ".part"
+    state_path = tmp + ".json"
+    result = None
+    started, prefix = time.perf_counter(), await asyncio.to_thread(_bytes_on_disk, tmp, state_path)
+
+    if segments > 1 and (os.path.exists(state_path) or not os.path.exists(tmp)):
+        plan = await asyncio.to_thread(_load_plan, state_path, tmp, url)
+        if plan is not None and expected_size is not None and plan["size"] != expected_size:
+            _discard(tmp, state_path)  # partial file belongs to different content
+            plan = None
+        plan = plan or await _async_probe(client, url, segments, timeout)
+        if plan is not None:
+            _check_size(plan["size"], expected_size)
+            try:
+                result = await _async_download_segments(client, url, tmp, state_path, plan, timeout, on_progress)
+            except RangeNotSupported as e:
+                print(f"[download] {e}; falling back to single stream", flush=True)
+                _discard(tmp, state_path)
+
+    if result is None:
+        result = await _async_download_stream(client, url, tmp, timeout, expected_size, on_progress)
+
+    digest, size = result
+    if expected_sha256 and digest != expected_sha256:
+        _discard(tmp, state_path)
+        DOWNLOAD_FAILURES.inc()
+        raise DownloadVerificationError(f"sha256 mismatch for {url}: got {digest}")
+
     os.replace(tmp, dest)
+    _discard(state_path)
+    _record(started, prefix, size)
     print(f"[download] Completed: {dest}", flush=True)
+    return digest, size
+
+
+async def _async_probe(client, url, segments, timeout):
+    async with client.stream("GET", url, headers=PROBE_HEADERS, timeout=timeout) as r:
+        return _plan_from_probe(r, url, segments)
+
+
+def _write_and_hash(f, h, chunk):
+    f.write(chunk)
+    h.update(chunk)
+
+
+def _fsync_close(f):
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+
+
+async def _async_download_stream(client, url, tmp, timeout, expected_size=None, on_progress=None):
+    headers = {}
+    mode = "wb"
+    h = hashlib.sha256()
+
+    if os.path.exists(tmp):
+        start = os.path.getsize(tmp)
+        headers["Range"] = f"bytes={start}-"
+        mode = "ab"
+        print(f"[download] Resuming from {start} bytes", flush=True)
+    else:
+        start = 0
+        print("[download] Starting fresh download", flush=True)
+
+    async with client.stream("GET", url, headers=headers, timeout=timeout) as r:
+        if r.status_code == 416 and start and expected_size == start:
+            # Previous attempt already fetched everything
+            return (await asyncio.to_thread(hash_prefix, tmp)).hexdigest(), start
+
+        r.raise_for_status()
+
+        if r.status_code not in (200, 206):
+            raise RuntimeError(f"Unexpected HTTP {r.status_code}")
+
+        # Range requested but not honored → restart cleanly
+        if "Range" in headers and r.status_code == 200:
+            mode = "wb"
+            start = 0
+            print("[download] Server ignored Range; restarting download", flush=True)
+
+        if r.status_code == 206:
+            total = _content_range_total(r)
+        else:
+            total = int(r.headers["content-length"]) if "content-length" in r.headers else None
+        _check_size(total, expected_size)
+
+        if start:
+            await asyncio.to_thread(hash_prefix, tmp, start, h)
+
+        size = start
+        f = await asyncio.to_thread(open, tmp, mode)
+        try:
+            async for chunk in r.aiter_bytes():
+                if chunk:
+                    await asyncio.to_thread(_write_and_hash, f, h, chunk)
+                    size += len(chunk)
+                    if expected_size is not None and size > expected_size:
+                        raise DownloadVerificationError(f"received more than {expected_size} bytes")
+                    if on_progress:
+                        on_progress(size, total)
+        finally:
+            await asyncio.to_thread(_fsync_close, f)
+
+    return h.hexdigest(), size
+
+
+async def _async_fetch_segment(client, url, seg, progress, timeout):
+    req = _segment_request(progress, seg)
+    if req is None:
+        return
+    pos, headers = req
+
+    async with client.stream("GET", url, headers=headers, timeout=timeout) as r:
+        _check_segment_response(r, progress, pos, seg[1])
+        async for chunk in r.aiter_bytes():
+            if chunk:
+                pos = await asyncio.to_thread(_write_segment_chunk, progress, seg, pos, chunk)
+
+    if pos != seg[1]:
+        raise RuntimeError(f"segment {seg[0]}-{seg[1]} ended early at {pos}")
+
+
+async def _async_download_segments(client, url, tmp, state_path, plan, timeout, on_progress=None):
+    progress = await asyncio.to_thread(_open_segmented, tmp, state_path, plan, on_progress)
+    try:
+        pending = [seg for seg in plan["segments"] if seg[0] + seg[2] < seg[1]]
+        try:
+            results = await asyncio.gather(
+                *(_async_fetch_segment(client, url, seg, progress, timeout) for seg in pending),
+                return_exceptions=True,
+            )
+            errors = [r if isinstance(r, BaseException) else None for r in results]
+        finally:
+            await asyncio.to_thread(progress.save)
+        return await asyncio.to_thread(_finish_segmented, progress, errors)
+    finally:
+        os.close(progress.fd)
 
 
 def cleanup_part_files(directory: str):
     for name in os.listdir(directory):
-        if name.endswith(".part"):
+        if name.endswith(".part") or name.endswith(".part.json"):
             path = os.path.join(directory, name)
             try:
                 os.remove(path)
@@ -0,0 +1,86 @@
+import os
+import asyncio
+import hashlib
+from fastapi import HTTPException
+from fastapi.responses import Response
+
+# Longest a /manifest/watch request is held open; keep it under proxy idle timeouts
+MANIFEST_WATCH_MAX_SECONDS = float(os.getenv("MANIFEST_WATCH_MAX_SECONDS", "60"))
+
+
+class ManifestWatch:
+    """
+    In-memory copy of a manifest file with a content ETag.
+
+    `response()` answers conditional GETs (304 when If-None-Match matches) and
+    `watch()` long-polls: it returns as soon as the manifest differs from the
+    caller's ETag, or 304 when nothing changed within the timeout. While no
+    manifest exists yet it waits for the first one too, and answers 404
+    "manifest not found" only once the timeout passes; clients must not take
+    that 404 for a server without the watch endpoint.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.body = None
+        self.etag = None
+        self._stat_key = None
+        self._changed = asyncio.Event()
+
+    def refresh(self):
+        """Re-read the file if it changed on disk; wakes watchers when the content differs."""
+        try:
+            st = os.stat(self.path)
+            key = (st.st_ino, st.st_size, st.st_mtime_ns)
+        except FileNotFoundError:
+            key = None
+        if key == self._stat_key:
+            return False
+        self._stat_key = key
+
+        body = None
+        if key is not None:
+            try:
+                with open(self.path, "rb") as f:
+                    body = f.read()
+            except FileNotFoundError:
+                pass
+        etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"' if body is not None else None
+        if etag == self.etag:
+            return False
+
+        self.body, self.etag = body, etag
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+        return True
+
+    def response(self, request):
+        self.refresh()
+        if self.body is None:
+            raise HTTPException(404, "manifest not found")
+        headers = {"ETag": self.etag, "Cache-Control": "no-cache"}
+        if request.headers.get("if-none-match") == self.etag:
+            return Response(status_code=304, headers=headers)
+        return Response(self.body, media_type="application/json", headers=headers)
+
+    async def watch(self, request, timeout=None):
+        timeout = MANIFEST_WATCH_MAX_SECONDS if timeout is None else min(timeout, MANIFEST_WATCH_MAX_SECONDS)
+        self.refresh()
+        if self.body is None or request.headers.get("if-none-match") == self.etag:
+            try:
+                await asyncio.wait_for(self._changed.wait(), max(0.0, timeout))
+            except asyncio.TimeoutError:
+                pass
+        return self.response(request)
+
+
+async def poll_files(watches, interval=1.0):
+    """For manifests replaced by other processes (e.g. a CI publish): stat each of `watches` (a dict) periodically."""
+    while True:
+        for w in list(watches.values()):
+            try:
+                if w.refresh():
+                    print(f"[manifest] {w.path} changed: {w.etag}", flush=True)
+            except Exception as e:
+                print(f"[manifest] refresh of {w.path} failed: {e}", flush=True)
+        await asyncio.sleep(interval)
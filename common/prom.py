@@ -0,0 +1,150 @@
+import os
+import bisect
+
+# Prometheus text exposition (format 0.0.4) without a client library.
+#
+# Metrics are created once at import time and updated in place: a counter is
+# an attribute increment and a histogram observation a bisect over a tuple
+# plus two increments, so instrumented hot paths allocate nothing. Updates
+# take no lock; under the GIL a concurrent increment can very rarely be lost,
+# which is acceptable for monitoring.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Upper bounds of histogram buckets (+Inf is implicit)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)   # seconds
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)                 # seconds
+THROUGHPUT_BUCKETS = tuple(2 ** k for k in range(16, 31, 2))                                          # bytes/s, 64 KiB/s .. 1 GiB/s
+SIZE_BUCKETS = (1, 10, 50, 100, 200, 500, 1000, 2000, 5000, 10000)                                     # rows
+
+
+def _labels(labels, extra=None):
+    items = list(labels.items()) + ([extra] if extra else [])
+    if not items:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in items)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(items, escaped)) + "}"
+
+
+def _num(v):
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class Counter:
+    kind = "counter"
+    __slots__ = ("name", "help", "labels", "value")
+
+    def __init__(self, name, help, labels):
+        self.name, self.help, self.labels = name, help, labels
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def samples(self):
+        yield self.name + _labels(self.labels), self.value
+
+
+class Gauge:
+    """Set directly, or pass `fn` to read the value at scrape time (free on the hot path)."""
+
+    kind = "gauge"
+    __slots__ = ("name", "help", "labels", "value", "fn")
+
+    def __init__(self, name, help, labels, fn=None):
+        self.name, self.help, self.labels = name, help, labels
+        self.value = 0
+        self.fn = fn
+
+    def set(self, v):
+        self.value = v
+
+    def samples(self):
+        yield self.name + _labels(self.labels), self.fn() if self.fn is not None else self.value
+
+
+class Histogram:
+    kind = "histogram"
+    __slots__ = ("name", "help", "labels", "buckets", "counts", "sum")
+
+    def __init__(self, name, help, labels, buckets):
+        self.name, self.help, self.labels = name, help, labels
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)   # last slot: above every bound
+        self.sum = 0.0
+
+    def observe(self, v):
+        self.counts[bisect.bisect_left(self.buckets, v)] += 1
+        self.sum += v
+
+    def quantile(self, q):
+        """Estimate of the q-quantile, interpolated within its bucket as histogram_quantile() does."""
+        total = sum(self.counts)
+        if not total:
+            return None
+        rank, seen, lower = q * total, 0, 0.0
+        for bound, n in zip(self.buckets, self.counts):
+            if n and seen + n >= rank:
+                return lower + (bound - lower) * (rank - seen) / n
+            seen += n
+            lower = bound
+        return self.buckets[-1]   # above every bound: the highest one is the best estimate
+
+    def samples(self):
+        total = 0
+        for bound, n in zip(self.buckets + (float("inf"),), self.counts):
+            total += n
+            yield self.name + "_bucket" + _labels(self.labels, ("le", _num(bound))), total
+        yield self.name + "_sum" + _labels(self.labels), self.sum
+        yield self.name + "_count" + _labels(self.labels), total
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, **labels):
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name, help, fn=None, **labels):
+        return self._add(Gauge(name, help, labels, fn))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, **labels):
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        """All metrics in text format; series of one name (different labels) share HELP/TYPE."""
+        families = {}
+        for m in self.metrics:
+            families.setdefault(m.name, []).append(m)
+        lines = []
+        for name, members in families.items():
+            lines.append(f"# HELP {name} {members[0].help}")
+            lines.append(f"# TYPE {name} {members[0].kind}")
+            for m in members:
+                try:
+                    lines.extend(f"{series} {_num(value)}" for series, value in m.samples())
+                except Exception as e:   # a failing gauge callback must not break the scrape
+                    lines.append(f"# {name} unavailable: {e}")
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path):
+        """Atomically write the metrics for node_exporter's textfile collector."""
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+
+# Default registry shared by the modules of one process
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+render = REGISTRY.render
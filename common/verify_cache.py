@@ -0,0 +1,131 @@
+import os
+import json
+import time
+import base64
+import hashlib
+import threading
+from common import prom
+
+VERIFY_CACHE = os.getenv("VERIFY_CACHE", "true").lower() == "true"
+VERIFY_CACHE_MAX = int(os.getenv("VERIFY_CACHE_MAX", "256"))
+# Check the bundle's signature over the artifact digest in Python instead of
+# spawning cosign. This does not re-check the transparency log entry, so it is
+# opt-in; cosign remains the fallback whenever it cannot decide.
+VERIFY_INPROCESS = os.getenv("VERIFY_INPROCESS", "false").lower() == "true"
+
+
+# how a signature was accepted: cache | inprocess | cosign
+SIGNATURES_VERIFIED = {how: prom.counter("ota_signature_verifications_total", "Accepted artifact signatures", how=how)
+                       for how in ("cache", "inprocess", "cosign")}
+COSIGN_SECONDS = prom.histogram("ota_cosign_verify_seconds", "cosign verify-blob duration", prom.DURATION_BUCKETS)
+
+
+def _sha256_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class VerifyCache:
+    """
+    Persistent record of successful signature verifications, keyed by
+    (artifact sha256, bundle sha256, public-key fingerprint). The whole cache
+    is dropped when the key fingerprint changes (key rotation).
+    """
+
+    def __init__(self, path, pubkey_path):
+        self.path = path
+        self.pubkey_path = pubkey_path
+        self._lock = threading.Lock()
+        self._fingerprint = None
+        self._entries = None
+
+    def fingerprint(self):
+        with open(self.pubkey_path, "rb") as f:
+            return _sha256_bytes(f.read())
+
+    def _load(self):
+        fp = self.fingerprint()
+        if self._entries is not None and fp == self._fingerprint:
+            return
+        entries = {}
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            if data.get("key") == fp:
+                entries = data.get("entries", {})
+            else:
+                print("[verify] public key changed; verification cache cleared", flush=True)
+        except (OSError, ValueError):
+            pass
+        self._fingerprint, self._entries = fp, entries
+
+    def _key(self, artifact_sha256, bundle_path):
+        with open(bundle_path, "rb") as f:
+            return f"{artifact_sha256}:{_sha256_bytes(f.read())}"
+
+    def hit(self, artifact_sha256, bundle_path):
+        if not VERIFY_CACHE:
+            return False
+        with self._lock:
+            self._load()
+            return self._key(artifact_sha256, bundle_path) in self._entries
+
+    def record(self, artifact_sha256, bundle_path):
+        if not VERIFY_CACHE:
+            return
+        with self._lock:
+            self._load()
+            self._entries[self._key(artifact_sha256, bundle_path)] = time.time()
+            if len(self._entries) > VERIFY_CACHE_MAX:
+                newest = sorted(self._entries.items(), key=lambda kv: kv[1])[-VERIFY_CACHE_MAX:]
+                self._entries = dict(newest)
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump({"key": self._fingerprint, "entries": self._entries}, f)
+            os.replace(tmp, self.path)
+
+
+def verify_inprocess(pubkey_path, bundle_path, artifact_sha256):
+    """
+    True if the bundle's message signature over artifact_sha256 checks out
+    against the public key. False when it cannot decide (no `cryptography`,
+    unexpected bundle layout, or a bad signature), in which case callers run
+    cosign.
+    """
+    try:
+        from cryptography.exceptions import InvalidSignature
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import ec
+        from cryptography.hazmat.primitives.asymmetric.utils import Prehashed
+    except ImportError:
+        return False
+    try:
+        with open(bundle_path) as f:
+            sig = json.load(f)["messageSignature"]
+        if sig["messageDigest"]["algorithm"] != "SHA2_256":
+            return False
+        digest = base64.b64decode(sig["messageDigest"]["digest"])
+        if digest.hex() != artifact_sha256:
+            return False
+        with open(pubkey_path, "rb") as f:
+            key = serialization.load_pem_public_key(f.read())
+        if not isinstance(key, ec.EllipticCurvePublicKey):
+            return False
+        key.verify(base64.b64decode(sig["signature"]), digest, ec.ECDSA(Prehashed(hashes.SHA256())))
+        return True
+    except (InvalidSignature, KeyError, ValueError, OSError):
+        return False
+
+
+def already_verified(cache, pubkey_path, artifact_sha256, bundle_path):
+    """
+    "cache" or "inprocess" when cosign can be skipped, else None. An in-process
+    success is recorded in the cache like a cosign success.
+    """
+    if cache.hit(artifact_sha256, bundle_path):
+        SIGNATURES_VERIFIED["cache"].inc()
+        return "cache"
+    if VERIFY_INPROCESS and verify_inprocess(pubkey_path, bundle_path, artifact_sha256):
+        cache.record(artifact_sha256, bundle_path)
+        SIGNATURES_VERIFIED["inprocess"].inc()
+        return "inprocess"
+    return None
@@ -0,0 +1,102 @@
+import os
+import collections
+
+# ---- Ingest de-duplication (gateway retries are at-least-once) ----
+DEDUP_WINDOW = int(os.getenv("DEDUP_WINDOW", "65536"))          # sequence numbers tracked above the floor
+DEDUP_MAX_SOURCES = int(os.getenv("DEDUP_MAX_SOURCES", "10000"))  # least recently seen sources evicted beyond this
+
+
+class SeenWindow:
+    """
+    Sequence numbers seen from one source, as a sliding anti-replay window:
+    bit i of `mask` marks floor+1+i, and every seq <= `settled` was stored or
+    will never be sent again, so it is a duplicate.
+
+    In-order delivery only moves the floor (and `settled` with it), so the
+    usual cost is one integer per source. Rows arriving out of order (a
+    retried chunk behind a later one) set bits until the gap closes. A seq
+    more than `size` ahead slides the window forward; what it passes over is
+    unknown rather than seen, so such rows are accepted (possibly twice)
+    instead of lost. The gateway's low-water mark (`settle()`) closes gaps
+    that never fill, e.g. rows it thinned away before forwarding them.
+    """
+
+    __slots__ = ("floor", "mask", "size", "settled")
+
+    def __init__(self, floor=0, mask=0, size=DEDUP_WINDOW, settled=None):
+        self.floor, self.mask, self.size = floor, mask, size
+        self.settled = floor if settled is None else settled
+
+    def add(self, seq):
+        """True if `seq` is new (and records it), False for a duplicate."""
+        if seq <= self.floor:
+            return seq > self.settled
+        if seq == self.floor + 1 and not self.mask:
+            if self.settled == self.floor:
+                self.settled = seq
+            self.floor = seq
+            return True
+        offset = seq - self.floor - 1
+        if offset >= self.size:
+            # The unseen numbers passed over become unknown: `settled` stays
+            shift = offset - self.size + 1
+            self.mask >>= shift
+            self.floor += shift
+            offset -= shift
+        bit = 1 << offset
+        if self.mask & bit:
+            return False
+        self.mask |= bit
+        self._close()
+        return True
+
+    def settle(self, low_water):
+        """The source will never send a seq <= `low_water` (again): forget the gaps below it."""
+        if low_water > self.floor:
+            self.mask >>= low_water - self.floor
+            self.floor = self.settled = low_water
+            self._close()
+        elif low_water > self.settled:
+            self.settled = low_water
+
+    def _close(self):
+        # Close the gap: advance the floor past the run of seen numbers
+        run = (~self.mask & (self.mask + 1)).bit_length() - 1
+        if run:
+            if self.settled == self.floor:
+                self.settled += run
+            self.mask >>= run
+            self.floor += run
+
+
+class SeenWindows:
+    """A `SeenWindow` per source ("<gateway id>/<buffer stream id>"), LRU-bounded."""
+
+    def __init__(self, max_sources=DEDUP_MAX_SOURCES):
+        self.max_sources = max_sources
+        self.sources = collections.OrderedDict()
+
+    def add(self, source, seq):
+        return self._window(source).add(seq)
+
+    def settle(self, source, low_water):
+        self._window(source).settle(low_water)
+
+    def _window(self, source):
+        w = self.sources.get(source)
+        if w is None:
+            w = self.sources[source] = SeenWindow()
+            while len(self.sources) > self.max_sources:
+                self.sources.popitem(last=False)
+        else:
+            self.sources.move_to_end(source)
+        return w
+
+    def snapshot(self):
+        # The mask is written in hex: at most DEDUP_WINDOW / 4 characters per source
+        return {src: [w.floor, format(w.mask, "x"), w.settled] for src, w in self.sources.items()}
+
+    def restore(self, snap):
+        for src, (floor, mask, *settled) in snap.items():
+            # Snapshots from before `settled` treated everything up to the floor as seen
+            self.sources[src] = SeenWindow(floor, int(mask, 16), settled=settled[0] if settled else floor)
@@ -1,39 +1,183 @@
 import os
-from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import FileResponse
+import re
+import gzip
+import json
+import time
+import asyncio
+from fastapi import FastAPI, Request, HTTPException, Query
+from fastapi.responses import FileResponse, Response
+from tsdb import TimeSeriesStore
+from common.manifest_watch import ManifestWatch, poll_files
+from common import prom
 
 app = FastAPI()
-METRICS = []
+STORE = TimeSeriesStore()
+SNAPSHOT_SECONDS = int(os.getenv("TSDB_SNAPSHOT_SECONDS", "60"))
+
+INGEST_SECONDS = prom.histogram("dashboard_ingest_seconds", "Ingest request handling time", endpoint="single")
+BATCH_INGEST_SECONDS = prom.histogram("dashboard_ingest_seconds", "Ingest request handling time", endpoint="batch")
+BATCH_ROWS = prom.histogram("dashboard_ingest_batch_rows", "Rows per /ingest/batch request", prom.SIZE_BUCKETS)
+INGEST_REJECTED = prom.counter("dashboard_ingest_rejected_total", "Batches rejected as malformed")
+INGEST_REJECTED_ROWS = prom.counter("dashboard_ingest_rejected_rows_total", "Samples rejected for not being a JSON object")
+INGEST_DUPLICATES = prom.counter("dashboard_ingest_duplicates_total", "Samples dropped as already stored (retried flushes)")
+prom.gauge("dashboard_samples", "Samples held by the time-series store", fn=lambda: STORE.total)
 
 # Central OTA directory (mounted from host: ./dashboard/ota)
 OTA_DIR = "/app/ota"
 
 @app.post("/ingest")
 async def ingest(req: Request):
+    started = time.perf_counter()
     data = await req.json()
-    METRICS.append(data)
-    return {"ok": True, "count": len(METRICS)}
+    if not isinstance(data, dict):
+        INGEST_REJECTED_ROWS.inc()
+        raise HTTPException(400, "expected a JSON object")
+    # Idempotency-Key: "<source>:<seq>" (gateway /ingest fallback)
+    source, _, seq = req.headers.get("idempotency-key", "").rpartition(":")
+    keyed = bool(source) and seq.isdigit()
+    if keyed:
+        data["_seq"] = int(seq)
+        _settle(source, req)
+    duplicate = not STORE.add(data, source or None) and keyed
+    if duplicate:
+        INGEST_DUPLICATES.inc()
+    INGEST_SECONDS.observe(time.perf_counter() - started)
+    return {"ok": True, "duplicate": duplicate, "count": STORE.total}
+
+@app.post("/ingest/batch")
+async def ingest_batch(req: Request):
+    """Accepts NDJSON (application/x-ndjson) or a JSON array, optionally gzip-encoded."""
+    started = time.perf_counter()
+    body = await req.body()
+    try:
+        if req.headers.get("content-encoding", "").lower() == "gzip":
+            body = gzip.decompress(body)
+        if "ndjson" in req.headers.get("content-type", ""):
+            rows = [json.loads(line) for line in body.splitlines() if line.strip()]
+        else:
+            rows = json.loads(body)
+    except (OSError, EOFError, ValueError) as e:
+        INGEST_REJECTED.inc()
+        raise HTTPException(400, f"invalid batch: {e}")
+    if not isinstance(rows, list):
+        INGEST_REJECTED.inc()
+        raise HTTPException(400, "expected a JSON array or NDJSON body")
+
+    # Rows carry `_seq`; with X-Ingest-Source, rows already stored are skipped
+    source = req.headers.get("x-ingest-source")
+    if source:
+        _settle(source, req)
+    # A malformed row is reported, not retried: the rest of the batch is stored
+    samples = [row for row in rows if isinstance(row, dict)]
+    rejected = len(rows) - len(samples)
+    added = STORE.add_many(samples, source)
+    INGEST_DUPLICATES.inc(len(samples) - added)
+    INGEST_REJECTED_ROWS.inc(rejected)
+    BATCH_ROWS.observe(len(rows))
+    BATCH_INGEST_SECONDS.observe(time.perf_counter() - started)
+    return {"ok": True, "accepted": len(samples), "duplicates": len(samples) - added, "rejected": rejected,
+            "count": STORE.total}
+
+def _settle(source, req):
+    # X-Ingest-Low-Water: the gateway holds no row of `source` at or below it any more
+    low_water = req.headers.get("x-ingest-low-water", "")
+    if low_water.isdigit():
+        STORE.settle(source, int(low_water))
 
 @app.get("/status")
 def status():
     return {
-        "total": len(METRICS),
-        "latest": METRICS[-5:]
+        "total": STORE.total,
+        "latest": list(STORE.latest)
     }
 
+@app.get("/metrics/prom")
+def metrics_prom():
+    return Response(prom.render(), media_type=prom.CONTENT_TYPE)
+
+@app.get("/metrics")
+def query_metrics(
+    robot_id: str = None,
+    from_: float = Query(None, alias="from"),
+    to: float = None,
+    agg: str = "raw",
+):
+    """Samples per robot between from/to (epoch seconds); agg = raw | 1s | 1m | 1h."""
+    try:
+        return {"agg": agg, "robots": STORE.query(robot_id, from_, to, agg)}
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+
+# ---- Optional on-disk snapshots (TSDB_PATH) ----
+
+@app.on_event("startup")
+async def start_snapshots():
+    if not STORE.path:
+        return
+    STORE.load()
+
+    async def snapshot_loop():
+        while True:
+            await asyncio.sleep(SNAPSHOT_SECONDS)
+            try:
+                await asyncio.to_thread(STORE.save)
+            except Exception as e:
+                print("[dashboard] snapshot failed:", e, flush=True)
+
+    asyncio.create_task(snapshot_loop())
+
+@app.on_event("shutdown")
+def save_snapshot():
+    STORE.save()
+
 # ---- OTA endpoints (central server) ----
 
+# Legacy single app line lives directly in OTA_DIR; other products/channels
+# are published to OTA_DIR/<product>/<channel>/
+MANIFEST_CHECK_SECONDS = float(os.getenv("MANIFEST_CHECK_SECONDS", "1"))
+NAME_RE = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_.-]*$")
+manifests = {"": ManifestWatch(os.path.join(OTA_DIR, "manifest.json"))}
+
+def _ota_dir(product=None, channel=None):
+    if product is None:
+        return OTA_DIR
+    if not NAME_RE.match(product) or not NAME_RE.match(channel):
+        raise HTTPException(404, "unknown product/channel")
+    return os.path.join(OTA_DIR, product, channel)
+
+def _manifest(product=None, channel=None):
+    key = f"{product}/{channel}" if product else ""
+    w = manifests.get(key)
+    if w is None:
+        d = _ota_dir(product, channel)
+        if not os.path.isdir(d):
+            raise HTTPException(404, "manifest not found")
+        w = manifests[key] = ManifestWatch(os.path.join(d, "manifest.json"))
+    return w
+
+@app.on_event("startup")
+async def start_manifest_watch():
+    # Manifests are published by copying files into OTA_DIR; notice it quickly
+    asyncio.create_task(poll_files(manifests, MANIFEST_CHECK_SECONDS))
+
 @app.get("/ota/manifest.json")
-def ota_manifest():
-    p = os.path.join(OTA_DIR, "manifest.json")
-    if not os.path.exists(p):
-        raise HTTPException(404, "manifest not found")
-    return FileResponse(p)
+@app.get("/ota/{product}/{channel}/manifest.json")
+def ota_manifest(request: Request, product: str = None, channel: str = None):
+    return _manifest(product, channel).response(request)
+
+@app.get("/ota/manifest/watch")
+@app.get("/ota/{product}/{channel}/manifest/watch")
+async def ota_manifest_watch(request: Request, product: str = None, channel: str = None, timeout: float = None):
+    """Long-poll: send If-None-Match with the last ETag; returns on change or 304 after timeout."""
+    return await _manifest(product, channel).watch(request, timeout)
 
 
 @app.get("/ota/{name}")
-def ota_file(name: str):
-    p = os.path.join(OTA_DIR, name)
-    if not os.path.exists(p):
+@app.get("/ota/{product}/{channel}/{name}")
+def ota_file(name: str, product: str = None, channel: str = None):
+    if not NAME_RE.match(name):
+        raise HTTPException(404, "file not found")
+    p = os.path.join(_ota_dir(product, channel), name)
+    if not os.path.isfile(p):
         raise HTTPException(404, "file not found")
     return FileResponse(p)
@@ -0,0 +1,238 @@
+import os
+import gzip
+import json
+import math
+import time
+import bisect
+import threading
+import collections
+from dedup import SeenWindows
+
+# ---- Time-series store (bounded) ----
+TSDB_RAW_POINTS = int(os.getenv("TSDB_RAW_POINTS", "1000"))    # raw samples kept per robot
+TSDB_MAX_ROBOTS = int(os.getenv("TSDB_MAX_ROBOTS", "10000"))   # least recently seen robots evicted beyond this
+TSDB_PATH = os.getenv("TSDB_PATH", "")                         # optional snapshot file (gzip JSON)
+
+# resolution name -> (bucket seconds, buckets kept per robot)
+ROLLUPS = {
+    "1s": (1, int(os.getenv("TSDB_1S_BUCKETS", "3600"))),     # 1 hour
+    "1m": (60, int(os.getenv("TSDB_1M_BUCKETS", "1440"))),    # 1 day
+    "1h": (3600, int(os.getenv("TSDB_1H_BUCKETS", "720"))),   # 30 days
+}
+
+# rollup bucket layout
+COUNT, CPU_SUM, CPU_MIN, CPU_MAX, MEM_SUM, MEM_MIN, MEM_MAX, UNHEALTHY, LAST_HEALTHY, LAST_VERSION = range(10)
+
+
+def _num(v):
+    return float(v) if isinstance(v, (int, float)) and not isinstance(v, bool) else None
+
+
+def _stats(v):
+    """Window statistics of one field, if well-formed."""
+    if isinstance(v, dict) and all(_num(v.get(k)) is not None for k in ("min", "max", "mean")):
+        return v
+    return None
+
+
+class Rollup:
+    """Fixed-capacity buckets of one resolution, kept in time order."""
+
+    def __init__(self, step, capacity):
+        self.step = step
+        self.capacity = capacity
+        self.keys = []      # sorted bucket start times
+        self.buckets = {}   # start -> bucket list
+
+    def add(self, ts, cpu, mem, healthy, version, n=1, cpu_range=None, mem_range=None):
+        """One sample, or a gateway window of n samples: cpu/mem are then sums and *_range (min, max)."""
+        start = int(ts // self.step) * self.step
+        b = self.buckets.get(start)
+        if b is None:
+            if len(self.keys) >= self.capacity and start < self.keys[0]:
+                return  # older than everything retained
+            b = self.buckets[start] = [0, 0.0, None, None, 0.0, None, None, 0, None, None]
+            bisect.insort(self.keys, start)
+            while len(self.keys) > self.capacity:
+                del self.buckets[self.keys.pop(0)]
+        b[COUNT] += n
+        if cpu is not None:
+            lo, hi = cpu_range or (cpu, cpu)
+            b[CPU_SUM] += cpu
+            b[CPU_MIN] = lo if b[CPU_MIN] is None else min(b[CPU_MIN], lo)
+            b[CPU_MAX] = hi if b[CPU_MAX] is None else max(b[CPU_MAX], hi)
+        if mem is not None:
+            lo, hi = mem_range or (mem, mem)
+            b[MEM_SUM] += mem
+            b[MEM_MIN] = lo if b[MEM_MIN] is None else min(b[MEM_MIN], lo)
+            b[MEM_MAX] = hi if b[MEM_MAX] is None else max(b[MEM_MAX], hi)
+        if healthy is False:
+            b[UNHEALTHY] += n   # a window never mixes health states
+        if healthy is not None:
+            b[LAST_HEALTHY] = healthy
+        if version is not None:
+            b[LAST_VERSION] = version
+
+    def query(self, start, end):
+        lo = bisect.bisect_left(self.keys, start // self.step * self.step) if math.isfinite(start) else 0
+        hi = bisect.bisect_right(self.keys, end)
+        out = []
+        for k in self.keys[lo:hi]:
+            b = self.buckets[k]
+            n = b[COUNT]
+            out.append({
+                "ts": k,
+                "count": n,
+                "cpu": {"mean": round(b[CPU_SUM] / n, 3), "min": b[CPU_MIN], "max": b[CPU_MAX]} if b[CPU_MIN] is not None else None,
+                "mem": {"mean": round(b[MEM_SUM] / n, 3), "min": b[MEM_MIN], "max": b[MEM_MAX]} if b[MEM_MIN] is not None else None,
+                "unhealthy": b[UNHEALTHY],
+                "healthy": b[LAST_HEALTHY],
+                "version": b[LAST_VERSION],
+            })
+        return out
+
+
+class RobotSeries:
+    def __init__(self):
+        # raw ring: (ts, cpu, mem, healthy, version)
+        self.raw = collections.deque(maxlen=TSDB_RAW_POINTS)
+        self.rollups = {name: Rollup(step, cap) for name, (step, cap) in ROLLUPS.items()}
+
+    def add(self, ts, cpu, mem, healthy, version):
+        self.raw.append((ts, cpu, mem, healthy, version))
+        for r in self.rollups.values():
+            r.add(ts, cpu, mem, healthy, version)
+
+    def add_window(self, ts, n, cpu, mem, healthy, version):
+        """A gateway window of n samples; cpu/mem are {"min", "max", "mean", "count"} or None."""
+        self.raw.append((ts, cpu and cpu["mean"], mem and mem["mean"], healthy, version))
+        cpu_sum = cpu["mean"] * cpu.get("count", n) if cpu else None
+        mem_sum = mem["mean"] * mem.get("count", n) if mem else None
+        for r in self.rollups.values():
+            r.add(ts, cpu_sum, mem_sum, healthy, version, n,
+                  cpu and (cpu["min"], cpu["max"]), mem and (mem["min"], mem["max"]))
+
+    def query_raw(self, start, end):
+        return [
+            {"ts": ts, "cpu": cpu, "mem": mem, "healthy": healthy, "version": version}
+            for ts, cpu, mem, healthy, version in self.raw
+            if start <= ts <= end
+        ]
+
+
+class TimeSeriesStore:
+    """
+    Bounded per-robot store: a raw ring plus 1s/1m/1h rollups for each robot,
+    an LRU cap on the number of robots, and the last few samples for /status.
+    """
+
+    def __init__(self, path=TSDB_PATH):
+        self.path = path
+        self.total = 0
+        self.latest = collections.deque(maxlen=5)
+        self.robots = collections.OrderedDict()   # robot_id -> RobotSeries, LRU order
+        self.seen = SeenWindows()                  # idempotency keys of forwarded samples
+        self._lock = threading.Lock()
+
+    def add(self, sample, source=None):
+        """
+        Store one sample. Gateways number forwarded samples (`_seq`) per
+        `source`; a sample whose key was already stored is dropped. Returns
+        True if the sample was added.
+        """
+        if not isinstance(sample, dict):
+            return False
+        seq = sample.pop("_seq", None)
+        ts = _num(sample.get("ts"))
+        ts = time.time() if ts is None else ts
+        healthy = sample.get("healthy") if isinstance(sample.get("healthy"), bool) else None
+        version = sample.get("version") if isinstance(sample.get("version"), str) else None
+        robot_id = str(sample.get("robot_id", "unknown"))
+        agg = sample.get("agg")
+        n = agg.get("count") if isinstance(agg, dict) else None
+        with self._lock:
+            if source is not None and isinstance(seq, int) and not self.seen.add(source, seq):
+                return False
+            series = self._series(robot_id)
+            if isinstance(n, int) and n > 0:
+                # Pre-aggregated at the gateway (TELEMETRY_AGGREGATE_SECONDS)
+                series.add_window(ts, n, _stats(agg.get("cpu")), _stats(agg.get("mem")), healthy, version)
+                self.total += n
+            else:
+                series.add(ts, _num(sample.get("cpu")), _num(sample.get("mem")), healthy, version)
+                self.total += 1
+            self.latest.append(sample)
+        return True
+
+    def add_many(self, samples, source=None):
+        """Returns the number of samples added (duplicates excluded)."""
+        return sum(self.add(s, source) for s in samples)
+
+    def settle(self, source, low_water):
+        """`source` will never send a `_seq` <= `low_water` (again); see SeenWindow.settle."""
+        with self._lock:
+            self.seen.settle(source, low_water)
+
+    def _series(self, robot_id):
+        s = self.robots.get(robot_id)
+        if s is None:
+            s = self.robots[robot_id] = RobotSeries()
+            while len(self.robots) > TSDB_MAX_ROBOTS:
+                self.robots.popitem(last=False)
+        else:
+            self.robots.move_to_end(robot_id)
+        return s
+
+    def query(self, robot_id=None, start=None, end=None, agg="raw"):
+        if agg != "raw" and agg not in ROLLUPS:
+            raise ValueError(f"agg must be one of raw, {', '.join(ROLLUPS)}")
+        start = float("-inf") if start is None else start
+        end = float("inf") if end is None else end
+        with self._lock:
+            ids = [robot_id] if robot_id is not None else list(self.robots)
+            out = {}
+            for rid in ids:
+                s = self.robots.get(rid)
+                if s is None:
+                    continue
+                out[rid] = s.query_raw(start, end) if agg == "raw" else s.rollups[agg].query(start, end)
+            return out
+
+    # ---- persistence ----
+    def save(self):
+        """Write a columnar gzip JSON snapshot of the raw rings and rollups."""
+        if not self.path:
+            return
+        with self._lock:
+            # Saved together so a restart neither loses nor re-adds retried samples
+            snap = {"total": self.total, "latest": list(self.latest), "seen": self.seen.snapshot(), "robots": {}}
+            for rid, s in self.robots.items():
+                snap["robots"][rid] = {
+                    "raw": [list(col) for col in zip(*s.raw)] if s.raw else [],
+                    "rollups": {name: [[k] + r.buckets[k] for k in r.keys] for name, r in s.rollups.items()},
+                }
+        tmp = self.path + ".tmp"
+        with gzip.open(tmp, "wt", encoding="utf-8") as f:
+            json.dump(snap, f, separators=(",", ":"))
+        os.replace(tmp, self.path)
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        with gzip.open(self.path, "rt", encoding="utf-8") as f:
+            snap = json.load(f)
+        with self._lock:
+            self.total = snap.get("total", 0)
+            self.latest.extend(snap.get("latest", []))
+            self.seen.restore(snap.get("seen", {}))
+            for rid, data in snap.get("robots", {}).items():
+                s = self._series(rid)
+                s.raw.extend(zip(*data["raw"]))
+                for name, rows in data["rollups"].items():
+                    r = s.rollups.get(name)
+                    if r is None:
+                        continue
+                    for row in rows[-r.capacity:]:
+                        r.keys.append(row[0])
+                        r.buckets[row[0]] = row[1:]
+        print(f"[dashboard] loaded time-series snapshot: {len(self.robots)} robots", flush=True)
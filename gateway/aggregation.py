@@ -0,0 +1,115 @@
+import os
+
+# ---- Edge pre-aggregation of robot telemetry ----
+# 0 forwards every sample; otherwise one row per robot per window goes upstream
+TELEMETRY_AGGREGATE_SECONDS = float(os.getenv("TELEMETRY_AGGREGATE_SECONDS", "0"))
+TELEMETRY_RAW_RETENTION_HOURS = float(os.getenv("TELEMETRY_RAW_RETENTION_HOURS", "24"))
+# A quiet robot's window is closed this long after its end
+AGGREGATE_GRACE_SECONDS = float(os.getenv("AGGREGATE_GRACE_SECONDS", "2"))
+
+NUMERIC_FIELDS = ("cpu", "mem")
+
+
+def _number(v):
+    return isinstance(v, (int, float)) and not isinstance(v, bool)
+
+
+class _Window:
+    __slots__ = ("bucket", "first", "last", "count", "healthy", "version", "stats", "extra")
+
+    def __init__(self, bucket, ts_ms, data):
+        self.bucket = bucket
+        self.first = self.last = ts_ms
+        self.count = 0
+        self.healthy = data.get("healthy")
+        self.version = data.get("version")
+        self.stats = {}    # field -> [min, max, sum, last, n]
+        self.extra = {}
+
+    def add(self, ts_ms, data):
+        self.last = ts_ms
+        self.count += 1
+        for key, value in data.items():
+            if key in NUMERIC_FIELDS and _number(value):
+                s = self.stats.get(key)
+                if s is None:
+                    self.stats[key] = [value, value, value, value, 1]
+                else:
+                    s[0] = min(s[0], value)
+                    s[1] = max(s[1], value)
+                    s[2] += value
+                    s[3] = value
+                    s[4] += 1
+            elif key not in ("robot_id", "healthy", "version", "ts"):
+                self.extra[key] = value   # other fields: last value wins
+
+    def row(self, robot_id, seconds):
+        """(payload, ts_ms) of the aggregate; top-level cpu/mem are means so plain consumers still work."""
+        agg = {"seconds": seconds, "from": self.first / 1000, "to": self.last / 1000, "count": self.count}
+        out = dict(self.extra)
+        out["robot_id"] = robot_id
+        if self.version is not None:
+            out["version"] = self.version
+        if self.healthy is not None:
+            out["healthy"] = self.healthy
+        for key, (lo, hi, total, last, n) in self.stats.items():
+            mean = round(total / n, 3)
+            out[key] = mean
+            agg[key] = {"min": lo, "max": hi, "mean": mean, "last": last, "count": n}
+        out["agg"] = agg
+        return out, self.first
+
+
+class WindowAggregator:
+    """
+    Rolls robot samples into per-robot windows of TELEMETRY_AGGREGATE_SECONDS
+    (aligned to the clock) with min/max/mean/last of cpu and mem.
+
+    A window holds a single health state and version: a sample that changes
+    either closes the open window and starts the next one. Each forwarded row
+    therefore has one `healthy` value, and `agg.from` of the first row after a
+    transition is the exact time of the change. Samples without a robot_id are
+    passed through unchanged.
+    """
+
+    def __init__(self, seconds=TELEMETRY_AGGREGATE_SECONDS):
+        self.seconds = seconds
+        self.window_ms = int(seconds * 1000)
+        self.windows = {}   # robot_id -> _Window
+        self.samples = 0    # samples folded into windows
+
+    def add(self, data, ts_ms):
+        """Fold one sample in; returns [(payload, ts_ms), ...] of windows it closed."""
+        robot_id = data.get("robot_id") if isinstance(data, dict) else None
+        if not isinstance(robot_id, str):
+            return [(data, ts_ms)]
+        closed = []
+        bucket = ts_ms // self.window_ms
+        w = self.windows.get(robot_id)
+        if w is not None and (
+            w.bucket != bucket
+            or ("healthy" in data and data["healthy"] != w.healthy)
+            or ("version" in data and data["version"] != w.version)
+        ):
+            closed.append(w.row(robot_id, self.seconds))
+            w = None
+        if w is None:
+            w = self.windows[robot_id] = _Window(bucket, ts_ms, data)
+        w.add(ts_ms, data)
+        self.samples += 1
+        return closed
+
+    def expire(self, now_ms, grace_ms=AGGREGATE_GRACE_SECONDS * 1000):
+        """Close windows that ended more than `grace_ms` ago (robots that went quiet)."""
+        closed = []
+        for robot_id, w in list(self.windows.items()):
+            if (w.bucket + 1) * self.window_ms + grace_ms <= now_ms:
+                closed.append(w.row(robot_id, self.seconds))
+                del self.windows[robot_id]
+        return closed
+
+    def drain(self):
+        """Close every open window (shutdown)."""
+        closed = [w.row(robot_id, self.seconds) for robot_id, w in self.windows.items()]
+        self.windows.clear()
+        return closed
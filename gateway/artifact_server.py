@@ -0,0 +1,398 @@
+import os
+import mmap
+import time
+import asyncio
+import hashlib
+import collections
+from fastapi import HTTPException
+from fastapi.responses import Response
+
+CACHE_DIR = os.getenv("CACHE_DIR", "/app/cache")
+
+# ---- Artifact serving (gateway -> robots) ----
+ARTIFACT_MAX_TRANSFERS = int(os.getenv("ARTIFACT_MAX_TRANSFERS", "8"))    # concurrent bodies in flight
+ARTIFACT_QUEUE_TIMEOUT = float(os.getenv("ARTIFACT_QUEUE_TIMEOUT", "30"))  # seconds a request may wait for a slot
+ARTIFACT_SYNC_WAIT = float(os.getenv("ARTIFACT_SYNC_WAIT", "120"))         # seconds to wait for an in-progress sync
+ARTIFACT_MMAP_MB = int(os.getenv("ARTIFACT_MMAP_MB", "256"))               # budget for memory-mapped hot files
+ARTIFACT_HOT_HITS = int(os.getenv("ARTIFACT_HOT_HITS", "2"))               # requests before a file is mapped
+ARTIFACT_CHUNK = 256 * 1024
+
+# path -> sha256 from manifests; other files get a computed digest (cached by size+mtime)
+_digests = {}
+_computed = {}
+
+# paths being (re)downloaded or verified; requests wait on the event instead of
+# seeing a half-written or not-yet-verified file
+_syncing = {}
+
+# The same, for every worker process: one marker file per path the leader syncs
+SYNC_MARKER_DIR = os.path.join(CACHE_DIR, ".syncing")
+SYNC_POLL_SECONDS = 0.25
+
+# Suffix of files being fetched and verified; renamed to their served name once verified
+STAGING_SUFFIX = ".unverified"
+
+
+class HotFile:
+    def __init__(self, path, st):
+        self.key = (st.st_size, st.st_mtime_ns)
+        self.size = st.st_size
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if st.st_size else None
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+
+
+# path -> HotFile, least recently served first
+_hot = collections.OrderedDict()
+_hot_bytes = 0
+# path -> ((size, mtime), requests) of files not mapped yet, most recent last
+_hits = collections.OrderedDict()
+_HITS_TRACKED = 1024
+
+
+class FairLimiter:
+    """
+    Caps concurrent transfers. Waiters are queued per client and granted slots
+    round-robin across clients, so one robot opening many connections cannot
+    starve the rest of the site.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.queues = collections.OrderedDict()   # client -> deque of futures
+
+    @property
+    def waiting(self):
+        return sum(len(q) for q in self.queues.values())
+
+    async def acquire(self, client):
+        if self.active < self.limit and not self.queues:
+            self.active += 1
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self.queues.setdefault(client, collections.deque()).append(fut)
+        try:
+            await asyncio.wait_for(fut, ARTIFACT_QUEUE_TIMEOUT)
+        except BaseException:
+            if fut.done() and not fut.cancelled():
+                self.release()  # slot was granted as we gave up; pass it on
+            else:
+                q = self.queues.get(client)
+                if q is not None and fut in q:
+                    q.remove(fut)
+                    if not q:
+                        del self.queues[client]
+            raise
+
+    def release(self):
+        while self.queues:
+            client, q = next(iter(self.queues.items()))
+            fut = q.popleft()
+            if q:
+                self.queues.move_to_end(client)   # next client's turn
+            else:
+                del self.queues[client]
+            if not fut.done():
+                fut.set_result(None)   # hand our slot over
+                return
+        self.active -= 1
+
+
+limiter = FairLimiter(ARTIFACT_MAX_TRANSFERS)
+
+
+# -----------------------------
+# Bookkeeping hooks for the OTA sync
+# -----------------------------
+def register_manifest(manifest, cache_dir):
+    """Remember manifest digests so artifact and patch ETags are their sha256."""
+    if manifest.get("artifact") and manifest.get("sha256"):
+        _digests[os.path.join(cache_dir, manifest["artifact"])] = manifest["sha256"]
+    if manifest.get("bundle") and manifest.get("bundle_sha256"):
+        _digests[os.path.join(cache_dir, manifest["bundle"])] = manifest["bundle_sha256"]
+    for d in manifest.get("deltas", []):
+        _digests[os.path.join(cache_dir, d["patch"])] = d["sha256"]
+
+
+def staging_path(path):
+    """Where `path` is downloaded and verified; never served."""
+    return path + STAGING_SUFFIX
+
+
+def _marker(path):
+    return os.path.join(SYNC_MARKER_DIR, hashlib.sha256(path.encode()).hexdigest())
+
+
+def begin_sync(paths):
+    os.makedirs(SYNC_MARKER_DIR, exist_ok=True)
+    for p in paths:
+        _syncing.setdefault(p, asyncio.Event())
+        with open(_marker(p), "w") as f:
+            f.write(p)
+
+
+def end_sync(paths):
+    for p in paths:
+        try:
+            os.remove(_marker(p))
+        except FileNotFoundError:
+            pass
+        ev = _syncing.pop(p, None)
+        if ev is not None:
+            ev.set()
+
+
+def clear_sync_markers():
+    """New leader: syncs its predecessor left unfinished will not finish; stop making requests wait."""
+    try:
+        names = os.listdir(SYNC_MARKER_DIR)
+    except FileNotFoundError:
+        return
+    for name in names:
+        try:
+            os.remove(os.path.join(SYNC_MARKER_DIR, name))
+        except FileNotFoundError:
+            pass
+
+
+def syncing():
+    """Paths being synced by this process, and their staging files (kept by GC)."""
+    return [q for p in _syncing for q in (p, staging_path(p))]
+
+
+def stats():
+    def rel(paths):
+        return [os.path.relpath(p, CACHE_DIR) for p in paths]
+
+    return {
+        "active": limiter.active,
+        "waiting": limiter.waiting,
+        "hot_files": rel(_hot),
+        "hot_mb": round(_hot_bytes / (1024 * 1024), 2),
+        "syncing": rel(_syncing),
+    }
+
+
+# -----------------------------
+# Helpers
+# -----------------------------
+def _sha256_path(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+async def _etag(path, st, digest=None):
+    digest = digest or _digests.get(path)
+    if digest is None:
+        key = (st.st_size, st.st_mtime_ns)
+        cached = _computed.get(path)
+        if cached is None or cached[0] != key:
+            cached = _computed[path] = (key, await asyncio.to_thread(_sha256_path, path))
+        digest = cached[1]
+    return f'"sha256:{digest}"'
+
+
+def _parse_range(header, size):
+    """(start, end_inclusive) for a single byte range; None to serve the whole file."""
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, _, last = header[6:].strip().partition("-")
+    try:
+        if first == "":
+            n = int(last)
+            if n <= 0:
+                raise ValueError
+            start, end = max(0, size - n), size - 1
+        else:
+            start = int(first)
+            end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    end = min(end, size - 1)
+    if start > end or start >= size:
+        raise HTTPException(416, headers={"Content-Range": f"bytes */{size}"})
+    return start, end
+
+
+def _hot_file(path, st):
+    """
+    Memory-mapped view of a served file, kept LRU within ARTIFACT_MMAP_MB.
+    Only files asked for ARTIFACT_HOT_HITS times are mapped: by then the
+    threaded reads of the earlier requests have pulled them into the page
+    cache, so slicing the map on the event loop does not wait on the disk.
+    """
+    global _hot_bytes
+    budget = ARTIFACT_MMAP_MB * 1024 * 1024
+    key = (st.st_size, st.st_mtime_ns)
+    hf = _hot.get(path)
+    if hf is not None and hf.key == key:
+        _hot.move_to_end(path)
+        return hf
+    if hf is not None:
+        _hot.pop(path).close()
+        _hot_bytes -= hf.size
+    if st.st_size > budget:
+        return None
+    seen, hits = _hits.pop(path, (key, 0))
+    hits = hits + 1 if seen == key else 1
+    if hits < ARTIFACT_HOT_HITS:
+        _hits[path] = (key, hits)
+        if len(_hits) > _HITS_TRACKED:
+            _hits.popitem(last=False)
+        return None
+    while _hot and _hot_bytes + st.st_size > budget:
+        _, old = _hot.popitem(last=False)
+        _hot_bytes -= old.size
+        old.close()
+    hf = _hot[path] = HotFile(path, st)
+    _hot_bytes += hf.size
+    return hf
+
+
+class ArtifactResponse(Response):
+    """
+    Streams [start, end] of a file as slices of a memory-mapped copy, falling
+    back to threaded reads if it cannot be mapped. ASGI gives the app no socket
+    to sendfile() to (uvicorn does not offer the zero-copy extension), so the
+    page cache mapping is as close to zero-copy as the body path gets.
+    """
+
+    def __init__(self, path, st, start, end, status_code, headers, send_body, on_done=None):
+        super().__init__(status_code=status_code, headers=headers)
+        self.path = path
+        self.st = st
+        self.start = start
+        self.end = end
+        self.send_body = send_body
+        self.on_done = on_done
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await self._send(scope, send)
+        finally:
+            if self.on_done is not None:
+                self.on_done()
+
+    async def _send(self, scope, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if not self.send_body:
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        hf = _hot_file(self.path, self.st)
+        if hf is not None:
+            pos = self.start
+            while pos <= self.end:
+                nxt = min(pos + ARTIFACT_CHUNK, self.end + 1)
+                await send({"type": "http.response.body", "body": hf.map[pos:nxt], "more_body": nxt <= self.end})
+                pos = nxt
+            return
+
+        f = await asyncio.to_thread(open, self.path, "rb")
+        try:
+            await asyncio.to_thread(f.seek, self.start)
+            remaining = self.end - self.start + 1
+            while remaining > 0:
+                chunk = await asyncio.to_thread(f.read, min(ARTIFACT_CHUNK, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+        finally:
+            f.close()
+
+
+async def serve(request, name, index):
+    """
+    GET/HEAD /artifact/{name} from the namespace directory of `index`, with
+    ETag, If-None-Match, Range and If-Range.
+    """
+    if name.startswith(".") or name.endswith((".part", ".part.json", ".tmp", STAGING_SUFFIX)) or name.startswith("manifest."):
+        raise HTTPException(404, "artifact not found")
+    # demand for LRU/LFU eviction
+    return await _serve_file(request, os.path.join(index.dir, name), on_send=lambda: index.touch(name))
+
+
+async def serve_blob(request, digest, blobs, on_send=None):
+    """GET/HEAD /blobs/sha256/{digest}: immutable content, the same for every product and channel."""
+    try:
+        path = blobs.path(digest)
+    except ValueError:
+        raise HTTPException(404, "blob not found")
+    headers = {"Cache-Control": "public, max-age=31536000, immutable"}
+    return await _serve_file(request, path, on_send=on_send, extra_headers=headers, digest=digest)
+
+
+async def _wait_synced(path):
+    """
+    Single flight: a request for a path being synced (by this worker or the
+    leader) waits for the sync to finish instead of getting a 404 or a file
+    that is about to be replaced.
+    """
+    ev = _syncing.get(path)
+    try:
+        if ev is not None:
+            await asyncio.wait_for(ev.wait(), ARTIFACT_SYNC_WAIT)
+            return
+        deadline = time.monotonic() + ARTIFACT_SYNC_WAIT
+        while os.path.exists(_marker(path)):
+            if time.monotonic() >= deadline:
+                raise asyncio.TimeoutError
+            await asyncio.sleep(SYNC_POLL_SECONDS)
+    except asyncio.TimeoutError:
+        raise HTTPException(503, "artifact sync in progress", headers={"Retry-After": "10"})
+
+
+async def _serve_file(request, path, on_send=None, extra_headers=None, digest=None):
+    await _wait_synced(path)
+
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        raise HTTPException(404, "artifact not found")
+    if not os.path.isfile(path):
+        raise HTTPException(404, "artifact not found")
+
+    etag = await _etag(path, st, digest)
+    headers = {
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+        "Content-Type": "application/octet-stream",
+        "Last-Modified": time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(st.st_mtime)),
+        **(extra_headers or {}),
+    }
+
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+
+    rng = None
+    if_range = request.headers.get("if-range")
+    if if_range is None or if_range == etag:
+        rng = _parse_range(request.headers.get("range"), st.st_size)
+
+    if rng is None:
+        start, end, status = 0, st.st_size - 1, 200
+    else:
+        start, end, status = rng[0], rng[1], 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{st.st_size}"
+    headers["Content-Length"] = str(max(0, end - start + 1))
+
+    if request.method == "HEAD" or st.st_size == 0:
+        return ArtifactResponse(path, st, start, end, status, headers, send_body=False)
+
+    client = request.headers.get("x-robot-id") or (request.client.host if request.client else "?")
+    try:
+        await limiter.acquire(client)
+    except asyncio.TimeoutError:
+        raise HTTPException(503, "too many concurrent transfers", headers={"Retry-After": "5"})
+
+    if on_send is not None:
+        on_send()
+    return ArtifactResponse(path, st, start, end, status, headers, send_body=True, on_done=limiter.release)
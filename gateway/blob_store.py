@@ -0,0 +1,128 @@
+import os
+import re
+import threading
+
+CACHE_DIR = os.getenv("CACHE_DIR", "/app/cache")
+# Hidden so it can never collide with a <product>/<channel> namespace directory
+BLOB_DIR = os.path.join(CACHE_DIR, ".blobs", "sha256")
+
+DIGEST_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+class BlobStore:
+    """
+    Content-addressed copies of verified cache files: .blobs/sha256/<digest>.
+
+    Namespace files are hard links to their blob, so content published under
+    several versions, products or channels is stored and downloaded once.
+    A blob's link count minus one is its reference count: GC deleting a
+    namespace file drops a reference, and `release()` deletes blobs that no
+    namespace file references any more.
+    """
+
+    def __init__(self, root=BLOB_DIR):
+        self.dir = root
+        self.lock = threading.Lock()
+        self.enabled = True
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, digest):
+        if not DIGEST_RE.match(digest or ""):
+            raise ValueError(f"not a sha256 digest: {digest!r}")
+        return os.path.join(self.dir, digest)
+
+    def has(self, digest):
+        return self.enabled and os.path.isfile(self.path(digest))
+
+    def link(self, digest, dest):
+        """Make `dest` a reference to the blob. False if there is no such blob."""
+        if not self.enabled:
+            return False
+        tmp = dest + ".tmp"
+        with self.lock:
+            try:
+                os.link(self.path(digest), tmp)
+            except FileNotFoundError:
+                return False
+            except FileExistsError:
+                os.remove(tmp)
+                os.link(self.path(digest), tmp)
+            os.replace(tmp, dest)
+        return True
+
+    def adopt(self, path, digest):
+        """
+        Store a verified file under its digest. If the blob already exists the
+        file is replaced by a link to it, so both share one copy on disk.
+        """
+        if not self.enabled:
+            return
+        blob = self.path(digest)
+        with self.lock:
+            try:
+                os.link(path, blob)
+                return
+            except FileExistsError:
+                pass
+            except OSError as e:
+                # e.g. a filesystem without hard links: keep plain per-namespace files
+                self.enabled = False
+                print(f"[gateway] blob store disabled, cannot link into {self.dir}: {e}", flush=True)
+                return
+            if os.path.samefile(path, blob):
+                return
+            tmp = path + ".tmp"
+            os.link(blob, tmp)
+            os.replace(tmp, path)
+
+    def refs(self, digest):
+        try:
+            return os.stat(self.path(digest)).st_nlink - 1
+        except FileNotFoundError:
+            return 0
+
+    def release(self, digests):
+        """Delete the given blobs if nothing references them any more. Returns deleted digests."""
+        deleted = []
+        with self.lock:
+            for digest in digests:
+                try:
+                    if os.stat(self.path(digest)).st_nlink <= 1:
+                        os.remove(self.path(digest))
+                        deleted.append(digest)
+                except (FileNotFoundError, ValueError):
+                    pass
+        return deleted
+
+    def sweep(self):
+        """Startup: drop unreferenced blobs and leftover temp links (one scandir)."""
+        orphans = []
+        with os.scandir(self.dir) as it:
+            for de in it:
+                if not DIGEST_RE.match(de.name):
+                    os.remove(de.path)
+                elif de.stat().st_nlink <= 1:
+                    orphans.append(de.name)
+        deleted = self.release(orphans)
+        if deleted:
+            print(f"[gateway] removed {len(deleted)} unreferenced blobs", flush=True)
+        return deleted
+
+    def stats(self):
+        blobs = refs = size = shared = 0
+        with os.scandir(self.dir) as it:
+            for de in it:
+                if not DIGEST_RE.match(de.name):
+                    continue
+                st = de.stat()
+                blobs += 1
+                refs += st.st_nlink - 1
+                size += st.st_size
+                shared += st.st_size * max(0, st.st_nlink - 2)
+        return {
+            "enabled": self.enabled,
+            "blobs": blobs,
+            "references": refs,
+            "size_mb": round(size / (1024 * 1024), 2),
+            "saved_mb": round(shared / (1024 * 1024), 2),   # extra references that cost no disk
+        }
@@ -1,33 +1,200 @@
 import os
-import glob
 import json
 import re
+import time
+import heapq
+import threading
+from common import prom
 
-CACHE_DIR = "/app/cache"
+CACHE_DIR = os.getenv("CACHE_DIR", "/app/cache")
 
 MAX_VERSIONS = int(os.getenv("CACHE_KEEP_LAST", "3"))      # keep last N
 MAX_CACHE_MB = int(os.getenv("CACHE_MAX_MB", "500"))       # max MB
+# Which unpinned versions go first: semver (oldest) | lru (least recently served) | lfu (least served)
+CACHE_EVICTION = os.getenv("CACHE_EVICTION", "semver").lower()
 
-# matches app-v1.2.3.tar.gz
-ART_RE = re.compile(r"^app-v(\d+)\.(\d+)\.(\d+)\.tar\.gz$")
+# matches <product>-v1.2.3.tar.gz, e.g. app-v1.2.3.tar.gz
+ART_RE = re.compile(r"^(?P<product>[A-Za-z0-9_.-]+?)-v(?P<version>\d+\.\d+\.\d+)\.tar\.gz$")
+# matches <product>-v1.2.3-to-1.2.4.tar.gz.zst (delta patches)
+PATCH_RE = re.compile(
+    r"^(?P<product>[A-Za-z0-9_.-]+?)-v(?P<from>\d+\.\d+\.\d+)-to-(?P<to>\d+\.\d+\.\d+)\.tar\.gz\.zst$"
+)
+# last fully rolled-out manifest, served to robots not (yet) in the rollout
+STABLE_MANIFEST = "manifest.stable.json"
 
-def ensure_cache():
-    os.makedirs(CACHE_DIR, exist_ok=True)
+GC_RUNS = prom.counter("gateway_cache_gc_runs_total", "Cache GC runs")
+GC_DELETED = prom.counter("gateway_cache_gc_deleted_files_total", "Files deleted by cache GC")
+GC_BLOBS_FREED = prom.counter("gateway_cache_gc_freed_blobs_total", "Unreferenced blobs deleted by cache GC")
+GC_SECONDS = prom.histogram("gateway_cache_gc_seconds", "Cache GC run duration")
+
+def ensure_cache(cache_dir=CACHE_DIR):
+    os.makedirs(cache_dir, exist_ok=True)
 
 def file_size_mb(path):
     return os.path.getsize(path) / (1024 * 1024)
 
-def get_cache_size_mb():
-    total = 0.0
-    for name in os.listdir(CACHE_DIR):
-        path = os.path.join(CACHE_DIR, name)
-        if os.path.isfile(path):
-            total += file_size_mb(path)
-    return total
+class CacheIndex:
+    """
+    Persistent index of one cache directory: name -> size, semver, kind,
+    content digest (when known), pinned, last access and hit count. The OTA sync and the artifact server
+    keep it current, so GC never rescans and stats the whole directory.
+    Safe to use from the event loop and the GC thread.
+    """
+
+    def __init__(self, cache_dir):
+        self.dir = cache_dir
+        self.path = os.path.join(cache_dir, ".cache-index.json")
+        self.lock = threading.RLock()
+        self.entries = {}
+        self.total_bytes = 0
+        self._dirty = False
+
+    @staticmethod
+    def describe(name):
+        """(kind, version) for cache file names; kind is None for files GC does not manage."""
+        m = ART_RE.match(name)
+        if m:
+            return "artifact", m.group("version")
+        if name.endswith(".bundle"):
+            m = ART_RE.match(name[:-len(".bundle")])
+            if m:
+                return "bundle", m.group("version")
+        m = PATCH_RE.match(name)
+        if m:
+            return "patch", m.group("to")
+        return None, None
+
+    def load(self):
+        """Read the saved index and reconcile it with the directory once (startup)."""
+        ensure_cache(self.dir)
+        try:
+            with open(self.path) as f:
+                saved = json.load(f).get("entries", {})
+        except (OSError, ValueError):
+            saved = {}
+        with self.lock:
+            self.entries, self.total_bytes = {}, 0
+            with os.scandir(self.dir) as it:
+                for de in it:
+                    kind, version = self.describe(de.name)
+                    if kind is None or not de.is_file():
+                        continue
+                    st = de.stat()
+                    old = saved.get(de.name, {})
+                    self._put(de.name, kind, version, st.st_size, digest=old.get("digest"),
+                              last_access=old.get("last_access", st.st_mtime), hits=old.get("hits", 0))
+            self._dirty = True
+        self.save()
+
+    def _put(self, name, kind, version, size, digest=None, last_access=None, hits=0):
+        old = self.entries.get(name)
+        if old is not None:
+            self.total_bytes -= old["size"]
+            hits = max(hits, old["hits"])
+            digest = digest or old.get("digest")
+        self.entries[name] = {
+            "kind": kind,
+            "version": version,
+            "size": size,
+            "digest": digest,
+            "last_access": last_access or time.time(),
+            "hits": hits,
+            "pinned": old["pinned"] if old else False,
+        }
+        self.total_bytes += size
+        self._dirty = True
+
+    def add(self, name, digest=None):
+        """Record a file that was just written to the cache (and its sha256, if known)."""
+        kind, version = self.describe(name)
+        if kind is None:
+            return
+        try:
+            size = os.path.getsize(os.path.join(self.dir, name))
+        except FileNotFoundError:
+            return self.remove(name)
+        with self.lock:
+            self._put(name, kind, version, size, digest)
+
+    def remove(self, name):
+        with self.lock:
+            e = self.entries.pop(name, None)
+            if e is not None:
+                self.total_bytes -= e["size"]
+                self._dirty = True
+            return e
+
+    def touch(self, name):
+        """A robot fetched this file; feeds LRU/LFU eviction."""
+        with self.lock:
+            e = self.entries.get(name)
+            if e is not None:
+                e["last_access"] = time.time()
+                e["hits"] += 1
+                self._dirty = True
+
+    def touch_digest(self, digest):
+        """A robot fetched /blobs/sha256/<digest>; count it for every name with that content."""
+        with self.lock:
+            names = [name for name, e in self.entries.items() if e.get("digest") == digest]
+        for name in names:
+            self.touch(name)
+
+    def versions(self):
+        """
+        version -> {"names", "patches", "size", "last_access", "hits", "pinned",
+        "has_artifact"}; patches are grouped under the version they produce.
+        """
+        out = {}
+        with self.lock:
+            for name, e in self.entries.items():
+                v = out.setdefault(e["version"], {"names": [], "patches": [], "size": 0, "last_access": 0,
+                                                  "hits": 0, "pinned": False, "has_artifact": False})
+                v["patches" if e["kind"] == "patch" else "names"].append(name)
+                v["size"] += e["size"]
+                v["pinned"] = v["pinned"] or e["pinned"]
+                v["last_access"] = max(v["last_access"], e["last_access"])
+                v["hits"] += e["hits"]
+                if e["kind"] == "artifact":
+                    v["has_artifact"] = True
+        return out
+
+    def set_pinned(self, versions):
+        with self.lock:
+            for e in self.entries.values():
+                pinned = e["version"] in versions
+                if e["pinned"] != pinned:
+                    e["pinned"] = pinned
+                    self._dirty = True
 
-def get_active_version_from_manifest():
+    def save(self):
+        with self.lock:
+            if not self._dirty:
+                return
+            data = {"entries": dict(self.entries)}
+            self._dirty = False
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, self.path)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "files": len(self.entries),
+                "size_mb": round(self.total_bytes / (1024 * 1024), 2),
+                "eviction": CACHE_EVICTION,
+                "versions": {v: {k: info[k] for k in ("size", "hits", "last_access", "pinned")}
+                             for v, info in self.versions().items()},
+            }
+
+
+def get_cache_size_mb(index):
+    return index.total_bytes / (1024 * 1024)
+
+def get_active_version_from_manifest(name="manifest.json", cache_dir=CACHE_DIR):
     """Active version = manifest.json version (the one robots should install)."""
-    p = os.path.join(CACHE_DIR, "manifest.json")
+    p = os.path.join(cache_dir, name)
     if not os.path.exists(p):
         return None
     try:
@@ -45,107 +212,102 @@ def safe_remove(path):
         print("[gateway] failed to remove", path, e, flush=True)
 
 def parse_semver_from_filename(path):
-    """Return (major, minor, patch) if filename matches app-vX.Y.Z.tar.gz else None."""
+    """Return (major, minor, patch) if filename matches <product>-vX.Y.Z.tar.gz else None."""
     base = os.path.basename(path)
     m = ART_RE.match(base)
     if not m:
         return None
-    return (int(m.group(1)), int(m.group(2)), int(m.group(3)))
+    return tuple(int(x) for x in m.group("version").split("."))
+
+def _eviction_key(version, info):
+    """Smaller keys are evicted first."""
+    if CACHE_EVICTION == "lru":
+        return (info["last_access"], info["hits"])
+    if CACHE_EVICTION == "lfu":
+        return (info["hits"], info["last_access"])
+    return tuple(int(x) for x in version.split("."))
+
+def _remove(index, names, deleted, released):
+    for name in names:
+        safe_remove(os.path.join(index.dir, name))
+        e = index.remove(name)
+        deleted.append(name)
+        if e is not None and e.get("digest"):
+            released.add(e["digest"])
 
-def gc_cache_once():
+def gc_cache_once(index, max_mb=MAX_CACHE_MB, keep_last=MAX_VERSIONS, skip=(), blobs=None):
     """
-    Policy (bounded cache, single directory):
-      1) Always keep manifest.json
-      2) Always keep the artifact+bundle referenced by manifest version (if present)
-      3) Keep newest MAX_VERSIONS artifacts by semver (fallback: mtime)
-      4) Delete older artifacts + their bundles
-      5) Delete any *.part temp files
-      6) Enforce MAX_CACHE_MB by deleting oldest non-active versions
+    Policy (bounded cache, one namespace directory), driven by its index:
+      1) Always keep manifest.json (and the stable manifest of a rollout)
+      2) Always keep the artifact+bundle referenced by either manifest (if present)
+      3) Keep the keep_last best other versions by CACHE_EVICTION order
+         (newest semver, most recently served, or most served)
+      4) Delete other versions' artifacts, bundles and delta patches
+      5) Delete *.part temp files (and segmented-download sidecars) and
+         unverified staging files, except those of paths in `skip` (syncs in
+         progress)
+      6) Enforce max_mb by evicting the lowest-ranked unpinned versions
+      7) Drop the blob-store references of deleted files; blobs no other
+         namespace still links are deleted (see blob_store.BlobStore)
+    Blocking; run it off the event loop.
     """
-    ensure_cache()
-    print("[gateway] running cache GC...", flush=True)
-
-    active_ver = get_active_version_from_manifest()
-
-    # Find OTA artifacts
-    ota_files = glob.glob(os.path.join(CACHE_DIR, "app-v*.tar.gz"))
-
-    # Sort by semver if possible; else by mtime
-    parsed = [(f, parse_semver_from_filename(f)) for f in ota_files]
-    if all(v is not None for _, v in parsed):
-        parsed.sort(key=lambda x: x[1], reverse=True)  # newest version first
-        ota_files_sorted = [f for f, _ in parsed]
-    else:
-        ota_files_sorted = sorted(ota_files, key=lambda f: os.path.getmtime(f), reverse=True)
-
-    keep = set()
-
-    # Keep active version (if present)
-    if active_ver:
-        active_art = os.path.join(CACHE_DIR, f"app-v{active_ver}.tar.gz")
-        active_bun = active_art + ".bundle"
-        if os.path.exists(active_art):
-            keep.add(active_art)
-        if os.path.exists(active_bun):
-            keep.add(active_bun)
-
-    # Keep newest N artifacts (+ their bundles)
-    kept_artifacts = 0
-    for art in ota_files_sorted:
-        if kept_artifacts >= MAX_VERSIONS:
-            break
-        keep.add(art)
-        bun = art + ".bundle"
-        if os.path.exists(bun):
-            keep.add(bun)
-        kept_artifacts += 1
-
-    # Delete old artifacts/bundles not in keep
+    cache_dir = index.dir
+    ensure_cache(cache_dir)
+    started = time.perf_counter()
+
+    active_ver = get_active_version_from_manifest(cache_dir=cache_dir)
+    stable_ver = get_active_version_from_manifest(STABLE_MANIFEST, cache_dir)
+    pinned = {v for v in (active_ver, stable_ver) if v}
+    index.set_pinned(pinned)
+
     deleted = []
-    for art in ota_files_sorted:
-        bun = art + ".bundle"
-        if art not in keep:
-            safe_remove(art)
-            deleted.append(os.path.basename(art))
-        if bun not in keep:
-            safe_remove(bun)
-            deleted.append(os.path.basename(bun))
-
-    # Delete temp files
-    for tmp in glob.glob(os.path.join(CACHE_DIR, "*.part")):
-        safe_remove(tmp)
-        deleted.append(os.path.basename(tmp))
-
-    # Enforce size cap (delete oldest artifacts until under MAX_CACHE_MB)
-    def cache_ok():
-        return get_cache_size_mb() <= MAX_CACHE_MB
-
-    if not cache_ok():
-        # oldest first now
-        if all(parse_semver_from_filename(f) is not None for f in ota_files):
-            # sort oldest semver first
-            ota_oldest = sorted(ota_files, key=lambda f: parse_semver_from_filename(f))
-        else:
-            ota_oldest = sorted(ota_files, key=lambda f: os.path.getmtime(f))
-
-        for art in ota_oldest:
-            if cache_ok():
-                break
-
-            # never delete active version
-            if active_ver and f"app-v{active_ver}.tar.gz" == os.path.basename(art):
+    released = set()
+    versions = index.versions()
+
+    # Patches are only useful towards a version robots are offered; bundles
+    # without their artifact are leftovers of a failed sync
+    for version, info in versions.items():
+        if version in pinned:
+            continue
+        _remove(index, info["patches"], deleted, released)
+        if not info["has_artifact"]:
+            _remove(index, info["names"], deleted, released)
+
+    # Rank unpinned versions; keep the best keep_last (pinned ones count towards N)
+    heap = [(_eviction_key(v, info), v) for v, info in versions.items()
+            if info["has_artifact"] and v not in pinned]
+    heapq.heapify(heap)
+    surplus = len(heap) - max(0, keep_last - len(pinned & set(versions)))
+    for _ in range(max(0, surplus)):
+        _, v = heapq.heappop(heap)
+        _remove(index, versions[v]["names"], deleted, released)
+
+    # Size cap: evict lowest-ranked unpinned versions until under budget
+    budget = max_mb * 1024 * 1024
+    while heap and index.total_bytes > budget:
+        _, v = heapq.heappop(heap)
+        _remove(index, versions[v]["names"], deleted, released)
+
+    # Temp files are not indexed; one listdir (no stats) finds them
+    skip = set(skip)
+    for name in os.listdir(cache_dir):
+        if name.endswith((".part", ".part.json", ".unverified")):
+            if os.path.join(cache_dir, name.split(".part")[0]) in skip:
                 continue
+            safe_remove(os.path.join(cache_dir, name))
+            deleted.append(name)
 
-            bun = art + ".bundle"
-            if os.path.exists(art):
-                safe_remove(art)
-                deleted.append(os.path.basename(art))
-            if os.path.exists(bun):
-                safe_remove(bun)
-                deleted.append(os.path.basename(bun))
+    freed_blobs = blobs.release(released) if blobs is not None and released else []
 
+    index.save()
+    GC_RUNS.inc()
+    GC_DELETED.inc(len(deleted))
+    GC_BLOBS_FREED.inc(len(freed_blobs))
+    GC_SECONDS.observe(time.perf_counter() - started)
     print(
-        f"[gateway] GC done. active={active_ver} size={get_cache_size_mb():.2f}MB deleted={len(deleted)}",
+        f"[gateway] GC {cache_dir} done. active={active_ver} size={get_cache_size_mb(index):.2f}MB deleted={len(deleted)} "
+        f"blobs_freed={len(freed_blobs)} "
+        f"in {1000 * (time.perf_counter() - started):.1f}ms",
         flush=True
     )
-    return {"active": active_ver, "deleted": deleted, "size_mb": round(get_cache_size_mb(), 2)}
\ No newline at end of file
+    return {"active": active_ver, "deleted": deleted, "size_mb": round(get_cache_size_mb(index), 2)}
@@ -0,0 +1,165 @@
+import os
+import time
+import queue
+import sqlite3
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from common import prom
+
+DB_READERS = int(os.getenv("DB_READERS", "2"))
+DB_STATEMENT_CACHE = int(os.getenv("DB_STATEMENT_CACHE", "128"))
+
+# Most SQLite calls (and /metrics requests) finish well under a millisecond
+LATENCY_BUCKETS = (0.0001, 0.00025) + prom.LATENCY_BUCKETS
+
+
+def connect(path):
+    # Connections are long-lived and owned by a single thread each. sqlite3
+    # keeps compiled statements in a per-connection LRU, so reusing the same
+    # SQL text means each statement is prepared once per connection.
+    conn = sqlite3.connect(path, check_same_thread=False, cached_statements=DB_STATEMENT_CACHE)
+    conn.execute("PRAGMA journal_mode=WAL;")  # better durability/concurrency
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    return conn
+
+
+TRANSACTION_SECONDS = prom.histogram("gateway_sqlite_transaction_seconds", "Write transaction time on the writer thread (statements + commit)")
+# op -> histogram, created on an op's first call
+_op_seconds = {}
+
+
+def _op_histogram(op):
+    h = _op_seconds.get(op)
+    if h is None:
+        h = _op_seconds[op] = prom.histogram("gateway_sqlite_seconds", "SQLite call latency, queue wait included",
+                                             LATENCY_BUCKETS, op=op)
+    return h
+
+
+def latency_stats(**extra):
+    """
+    {op: {count, avg_ms, p50_ms, p99_ms}} read from the gateway_sqlite_seconds
+    histograms, plus the `extra` histograms under their keyword names.
+    """
+    out = {}
+    for op, h in {**_op_seconds, **extra}.items():
+        count = sum(h.counts)
+        if count:
+            out[op] = {
+                "count": count,
+                "avg_ms": round(h.sum / count * 1000, 3),
+                "p50_ms": round(h.quantile(0.50) * 1000, 3),
+                "p99_ms": round(h.quantile(0.99) * 1000, 3),
+            }
+    return out
+
+
+class Database:
+    """
+    Gateway SQLite access without blocking the event loop.
+
+    - one writer connection on a dedicated thread, fed by a queue; every
+      write job is committed on that thread, so writes never contend
+    - a small pool of reader threads, each with its own connection
+    - every call's latency (queue wait included) is recorded in the
+      gateway_sqlite_seconds histogram of its op (see `latency_stats()`)
+    """
+
+    def __init__(self, path, readers=DB_READERS):
+        self.path = path
+        self.readers = readers
+        self._jobs = queue.Queue()
+        self._writer = None
+        self._pool = None
+        self._local = threading.local()
+        self._reader_conns = []
+        self._reader_conns_lock = threading.Lock()
+
+    def start(self):
+        if self._writer is not None:
+            return
+        self._writer = threading.Thread(target=self._writer_main, name="sqlite-writer", daemon=True)
+        self._writer.start()
+        self._pool = ThreadPoolExecutor(max_workers=self.readers, thread_name_prefix="sqlite-reader")
+
+    def stop(self):
+        if self._writer is not None:
+            self._jobs.put(None)
+            self._writer.join()
+            self._writer = None
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+        with self._reader_conns_lock:
+            for conn in self._reader_conns:
+                conn.close()
+            self._reader_conns.clear()
+
+    # ---- writer thread ----
+    def _writer_main(self):
+        conn = connect(self.path)
+        try:
+            while True:
+                job = self._jobs.get()
+                if job is None:
+                    return
+                fn, args, loop, fut = job
+                try:
+                    started = time.perf_counter()
+                    result = fn(conn, *args)
+                    conn.commit()
+                    TRANSACTION_SECONDS.observe(time.perf_counter() - started)
+                except Exception as e:
+                    conn.rollback()
+                    loop.call_soon_threadsafe(_set_exception, fut, e)
+                else:
+                    loop.call_soon_threadsafe(_set_result, fut, result)
+        finally:
+            conn.close()
+
+    async def write(self, op, fn, *args):
+        """Run fn(conn, *args) on the writer thread and commit."""
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        started = time.perf_counter()
+        self._jobs.put((fn, args, loop, fut))
+        try:
+            return await fut
+        finally:
+            _op_histogram(op).observe(time.perf_counter() - started)
+
+    @property
+    def queue_depth(self):
+        return self._jobs.qsize()
+
+    # ---- reader pool ----
+    def _reader_conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = connect(self.path)
+            with self._reader_conns_lock:
+                self._reader_conns.append(conn)
+        return conn
+
+    def _run_read(self, fn, args):
+        return fn(self._reader_conn(), *args)
+
+    async def read(self, op, fn, *args):
+        """Run fn(conn, *args) on a pooled reader connection."""
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self._pool, self._run_read, fn, args)
+        finally:
+            _op_histogram(op).observe(time.perf_counter() - started)
+
+
+def _set_result(fut, result):
+    if not fut.cancelled():
+        fut.set_result(result)
+
+
+def _set_exception(fut, exc):
+    if not fut.cancelled():
+        fut.set_exception(exc)
@@ -0,0 +1,88 @@
+import os
+import shutil
+import asyncio
+from common.downloader import hash_prefix
+from cache_manager import ART_RE
+
+# ---- Delta (patch) artifacts ----
+DELTA_ENABLED = os.getenv("DELTA_ENABLED", "true").lower() == "true"
+DELTA_MAX_BASES = int(os.getenv("DELTA_MAX_BASES", os.getenv("CACHE_KEEP_LAST", "3")))
+DELTA_MAX_RATIO = float(os.getenv("DELTA_MAX_RATIO", "0.5"))   # drop patches bigger than this share of the full artifact
+DELTA_LEVEL = os.getenv("DELTA_LEVEL", "19")
+
+
+def patch_name(product, from_version, to_version):
+    return f"{product}-v{from_version}-to-{to_version}.tar.gz.zst"
+
+
+def available():
+    return DELTA_ENABLED and shutil.which("zstd") is not None
+
+
+def _cached_bases(index, product, new_version, new_digest=None):
+    """Older cached artifacts of the product with other content, newest first: [(version, filename)]."""
+    bases = []
+    with index.lock:
+        names = [n for n, e in index.entries.items()
+                 if e["kind"] == "artifact" and (new_digest is None or e.get("digest") != new_digest)]
+    for name in names:
+        m = ART_RE.match(name)
+        if not m or m.group("product") != product:
+            continue
+        version = m.group("version")
+        if version != new_version:
+            bases.append((tuple(int(x) for x in version.split(".")), version, name))
+    bases.sort(reverse=True)
+    return [(version, name) for _, version, name in bases[:DELTA_MAX_BASES]]
+
+
+async def _zstd_patch(base_path, new_path, out_path):
+    tmp = out_path + ".tmp"
+    proc = await asyncio.create_subprocess_exec(
+        "zstd", "-q", "-f", f"-{DELTA_LEVEL}", "--long=30",
+        f"--patch-from={base_path}", new_path, "-o", tmp,
+    )
+    if await proc.wait() != 0:
+        raise RuntimeError(f"zstd --patch-from failed for {os.path.basename(out_path)}")
+    os.replace(tmp, out_path)
+
+
+async def build_deltas(manifest, index, blobs=None):
+    """
+    Create (or reuse) patches from every cached older version to the manifest's
+    artifact and return the manifest "deltas" list:
+      [{"from": ver, "patch": name, "sha256": hex, "size": n}, ...]
+    Patches that fail or are not much smaller than the full artifact are skipped.
+    Kept patches go into the blob store, if given.
+    """
+    if not available():
+        return []
+    m = ART_RE.match(manifest["artifact"])
+    if not m:
+        return []
+    product = m.group("product")
+    new_version = manifest["version"]
+    new_path = os.path.join(index.dir, manifest["artifact"])
+    full_size = os.path.getsize(new_path)
+
+    deltas = []
+    for version, base in _cached_bases(index, product, new_version, manifest.get("sha256")):
+        name = patch_name(product, version, new_version)
+        out = os.path.join(index.dir, name)
+        try:
+            if not os.path.exists(out):
+                await _zstd_patch(os.path.join(index.dir, base), new_path, out)
+            size = os.path.getsize(out)
+            if size > full_size * DELTA_MAX_RATIO:
+                os.remove(out)
+                continue
+            digest = (await asyncio.to_thread(hash_prefix, out)).hexdigest()
+        except Exception as e:
+            print(f"[gateway] delta {name} skipped: {e}", flush=True)
+            continue
+        if blobs is not None:
+            await asyncio.to_thread(blobs.adopt, out, digest)
+        index.add(name, digest)
+        deltas.append({"from": version, "patch": name, "sha256": digest, "size": size})
+        print(f"[gateway] delta {name}: {size} bytes ({100 * size / full_size:.1f}% of full)", flush=True)
+    return deltas
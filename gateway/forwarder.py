@@ -0,0 +1,187 @@
+import os
+import gzip
+import time
+import random
+import asyncio
+import httpx
+
+DASHBOARD_URL = os.getenv("DASHBOARD_URL", "http://dashboard:8080")
+
+# ---- Upstream forwarding (gateway -> dashboard) ----
+FLUSH_CHUNK_ROWS = int(os.getenv("FLUSH_CHUNK_ROWS", "500"))      # rows per request
+FLUSH_MAX_INFLIGHT = int(os.getenv("FLUSH_MAX_INFLIGHT", "4"))    # concurrent requests
+FLUSH_GZIP = os.getenv("FLUSH_GZIP", "true").lower() == "true"
+FLUSH_TIMEOUT = float(os.getenv("FLUSH_TIMEOUT", "10"))
+
+# ---- Adaptive auto-flush ----
+FLUSH_INTERVAL_SECONDS = int(os.getenv("FLUSH_INTERVAL_SECONDS", "5"))    # cadence once caught up
+FLUSH_BATCH_SIZE = int(os.getenv("FLUSH_BATCH_SIZE", "200"))              # rows per flush (starting/minimum)
+FLUSH_BATCH_MAX = int(os.getenv("FLUSH_BATCH_MAX", "20000"))              # rows per flush while draining a backlog
+FLUSH_TARGET_SECONDS = float(os.getenv("FLUSH_TARGET_SECONDS", "2"))      # slowest request of a healthy flush
+FLUSH_BACKOFF_MAX_SECONDS = float(os.getenv("FLUSH_BACKOFF_MAX_SECONDS", "300"))
+
+_client = None
+_batch_supported = True
+
+
+def get_client():
+    """Long-lived pooled client shared by every flush: HTTP/1.1 keep-alive, one connection per request in flight."""
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            timeout=FLUSH_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=FLUSH_MAX_INFLIGHT,
+                max_keepalive_connections=FLUSH_MAX_INFLIGHT,
+            ),
+        )
+    return _client
+
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def encode_chunk(lines, source=None, low_water=None):
+    """NDJSON body (optionally gzip) from already-serialized JSON lines."""
+    body = ("\n".join(lines) + "\n").encode("utf-8")
+    headers = {"Content-Type": "application/x-ndjson"}
+    if source:
+        headers["X-Ingest-Source"] = source
+        if low_water is not None:
+            headers["X-Ingest-Low-Water"] = str(low_water)
+    if FLUSH_GZIP:
+        body = gzip.compress(body, compresslevel=5)
+        headers["Content-Encoding"] = "gzip"
+    return body, headers
+
+
+async def _post_rows_one_by_one(client, chunk, acked, source, low_water):
+    # Fallback for dashboards without /ingest/batch; rows delivered before a
+    # failure are appended to `acked` so they are not sent again
+    for mid, line in chunk:
+        headers = {"Content-Type": "application/json"}
+        if source:
+            headers["Idempotency-Key"] = f"{source}:{mid}"
+            if low_water is not None:
+                headers["X-Ingest-Low-Water"] = str(low_water)
+        r = await client.post(f"{DASHBOARD_URL}/ingest", content=line, headers=headers)
+        r.raise_for_status()
+        acked.append(mid)
+
+
+async def _post_chunk(client, chunk, acked, source, low_water):
+    global _batch_supported
+    if _batch_supported:
+        body, headers = encode_chunk([line for _, line in chunk], source, low_water)
+        r = await client.post(f"{DASHBOARD_URL}/ingest/batch", content=body, headers=headers)
+        if r.status_code not in (404, 405):
+            r.raise_for_status()
+            acked.extend(mid for mid, _ in chunk)
+            return
+        _batch_supported = False
+        print("[gateway] dashboard has no /ingest/batch; falling back to /ingest", flush=True)
+    await _post_rows_one_by_one(client, chunk, acked, source, low_water)
+
+
+async def send_rows(rows, on_ack, inflight=None, source=None, low_water=None):
+    """
+    Forward buffered rows [(id, payload_json), ...] upstream.
+
+    `source` ("<gateway id>/<buffer stream id>") goes with every request; with
+    each line's `_seq` it lets the central server drop rows it already has
+    when a flush is retried. `low_water`, sent along, is the highest `_seq`
+    the source will never send again (acknowledged or thinned away), so the
+    central server can close the gaps in its de-dup window below it.
+
+    Rows are split into FLUSH_CHUNK_ROWS-sized NDJSON requests with at most
+    `inflight` (default FLUSH_MAX_INFLIGHT) in flight on the pooled client.
+    `await on_ack(ids)` is called as soon as a chunk (or, on the /ingest
+    fallback, the prefix of a chunk that got through) is acknowledged, so a
+    failure late in the flush never causes delivered rows to be sent again.
+    Returns (sent, error, slowest): number of acknowledged rows, the first
+    error seen (None if all chunks were delivered) and the longest chunk
+    request in seconds.
+    """
+    client = get_client()
+    sem = asyncio.Semaphore(min(inflight or FLUSH_MAX_INFLIGHT, FLUSH_MAX_INFLIGHT))
+    chunks = [rows[i:i + FLUSH_CHUNK_ROWS] for i in range(0, len(rows), FLUSH_CHUNK_ROWS)]
+    sent = 0
+    slowest = 0.0
+
+    async def ship(chunk):
+        nonlocal sent, slowest
+        acked = []
+        try:
+            async with sem:
+                started = time.perf_counter()
+                try:
+                    await _post_chunk(client, chunk, acked, source, low_water)
+                finally:
+                    slowest = max(slowest, time.perf_counter() - started)
+        finally:
+            if acked:
+                await on_ack(acked)
+                sent += len(acked)
+
+    results = await asyncio.gather(*(ship(c) for c in chunks), return_exceptions=True)
+    error = next((res for res in results if isinstance(res, BaseException)), None)
+    return sent, error, slowest
+
+
+def retry_after(error):
+    """Seconds from the Retry-After header of an HTTP error (429/503), else None."""
+    response = getattr(error, "response", None)
+    try:
+        return float(response.headers["retry-after"])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+
+class FlushPacer:
+    """
+    Sizes auto-flush cycles from upstream feedback (AIMD).
+
+    While a backlog remains and the slowest request of a flush stays under
+    FLUSH_TARGET_SECONDS, the next flush starts immediately with twice the
+    rows (up to FLUSH_BATCH_MAX) and one more request in flight (up to
+    FLUSH_MAX_INFLIGHT). A slow flush halves both; a failed one halves both
+    and waits with exponential backoff (full jitter, at least the upstream's
+    Retry-After). Once caught up, flushes return to FLUSH_INTERVAL_SECONDS.
+    """
+
+    def __init__(self):
+        self.batch = FLUSH_BATCH_SIZE
+        self.inflight = 1
+        self.backoff = FLUSH_INTERVAL_SECONDS
+        self.rate = 0.0   # rows/s delivered (EWMA over flushes that sent rows)
+
+    def update(self, res, batch):
+        """Record one flush_once() result for a `batch`-row flush; returns the delay before the next one."""
+        sent, seconds = res["sent"], res.get("seconds", 0)
+        if sent and seconds > 0:
+            self.rate = sent / seconds if not self.rate else 0.8 * self.rate + 0.2 * sent / seconds
+        if not res["ok"]:
+            self._decrease()
+            delay = random.uniform(FLUSH_INTERVAL_SECONDS / 2, self.backoff)
+            self.backoff = min(FLUSH_BACKOFF_MAX_SECONDS, self.backoff * 2)
+            return max(delay, res.get("retry_after") or 0)
+        self.backoff = FLUSH_INTERVAL_SECONDS
+        if res.get("selected", 0) < batch:
+            return FLUSH_INTERVAL_SECONDS   # caught up
+        if res["slowest"] > FLUSH_TARGET_SECONDS:
+            self._decrease()
+        else:
+            self.batch = min(FLUSH_BATCH_MAX, self.batch * 2)
+            self.inflight = min(FLUSH_MAX_INFLIGHT, self.inflight + 1)
+        return 0
+
+    def _decrease(self):
+        self.batch = max(FLUSH_BATCH_SIZE, self.batch // 2)
+        self.inflight = max(1, self.inflight // 2)
+
+    def stats(self):
+        return {"batch": self.batch, "inflight": self.inflight, "backoff_s": self.backoff, "rows_per_s": round(self.rate, 1)}
@@ -0,0 +1,108 @@
+import os
+import re
+from cache_manager import CacheIndex, ART_RE, PATCH_RE, STABLE_MANIFEST, MAX_CACHE_MB, MAX_VERSIONS
+from rollout import Rollout
+from workers import GATEWAY_WORKERS
+
+CACHE_DIR = os.getenv("CACHE_DIR", "/app/cache")
+DATA_DIR = os.getenv("DATA_DIR", "/app/data")
+
+# ---- Products and channels served by this gateway ----
+OTA_SOURCE_URL = os.getenv("OTA_SOURCE_URL", "http://dashboard:8080/ota")
+# "product/channel,..."; unset = a single app/stable line synced from OTA_SOURCE_URL itself
+OTA_SUBSCRIPTIONS = [s.strip() for s in os.getenv("OTA_SUBSCRIPTIONS", "").split(",") if s.strip()]
+DEFAULT_NAMESPACE = "app/stable"
+
+NAME_RE = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_.-]*$")
+
+
+def _parse_map(value):
+    """'app/stable=300,app/beta=50' -> {"app/stable": "300", "app/beta": "50"}"""
+    out = {}
+    for item in value.split(","):
+        key, sep, val = item.partition("=")
+        if sep and key.strip():
+            out[key.strip()] = val.strip()
+    return out
+
+
+# Per-namespace overrides: central source URL and cache quota (MB)
+OTA_SOURCES = _parse_map(os.getenv("OTA_SOURCES", ""))
+CACHE_QUOTAS = _parse_map(os.getenv("CACHE_QUOTAS", ""))
+
+
+class Namespace:
+    """One product/channel: its cache directory, index, rollout and sync state."""
+
+    def __init__(self, product, channel, source_url, max_mb, keep_last, watch):
+        self.product = product
+        self.channel = channel
+        self.key = f"{product}/{channel}"
+        self.dir = os.path.join(CACHE_DIR, product, channel)
+        self.source_url = source_url.rstrip("/")
+        self.max_mb = max_mb
+        self.keep_last = keep_last
+        self.index = CacheIndex(self.dir)
+        self.rollout = Rollout(self.dir, os.path.join(DATA_DIR, f"rollout-{product}-{channel}.json"),
+                               shared=GATEWAY_WORKERS > 1)
+        # ETag of the last central manifest that was fully synced; sent as If-None-Match
+        self.upstream = {"etag": None, "watch": watch}
+        # Progress of the current/last sync, served on GET /ota/status
+        self.status = {
+            "state": "idle",          # idle | checking | watching | downloading | verifying | error
+            "cached_version": None,
+            "target_version": None,
+            "file": None,
+            "bytes": 0,
+            "total": None,
+            "last_check": None,
+            "last_update": None,
+            "last_error": None,
+        }
+        os.makedirs(self.dir, exist_ok=True)
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.dir, "manifest.json")
+
+    def download_progress(self, done, total):
+        self.status["bytes"] = done
+        self.status["total"] = total
+
+
+def load(watch):
+    """{key: Namespace} for OTA_SUBSCRIPTIONS, in order; the first one is the default."""
+    keys = OTA_SUBSCRIPTIONS or [DEFAULT_NAMESPACE]
+    out = {}
+    for key in keys:
+        product, sep, channel = key.partition("/")
+        if not sep or not NAME_RE.match(product) or not NAME_RE.match(channel):
+            raise ValueError(f"bad OTA subscription {key!r}; expected product/channel")
+        if key in OTA_SOURCES:
+            source = OTA_SOURCES[key]
+        elif OTA_SUBSCRIPTIONS:
+            source = f"{OTA_SOURCE_URL.rstrip('/')}/{product}/{channel}"
+        else:
+            source = OTA_SOURCE_URL   # legacy single-line layout on the central server
+        max_mb = int(CACHE_QUOTAS.get(key, MAX_CACHE_MB))
+        out[key] = Namespace(product, channel, source, max_mb, MAX_VERSIONS, watch)
+    return out
+
+
+def migrate_legacy_layout(ns):
+    """Move a pre-namespace cache (files directly in CACHE_DIR) into the default namespace."""
+    if not os.path.exists(os.path.join(CACHE_DIR, "manifest.json")) or os.path.exists(ns.manifest_path):
+        return
+    moved = 0
+    for name in os.listdir(CACHE_DIR):
+        base = name[:-len(".bundle")] if name.endswith(".bundle") else name
+        if ART_RE.match(base) or PATCH_RE.match(name) or name in ("manifest.json", STABLE_MANIFEST):
+            os.replace(os.path.join(CACHE_DIR, name), os.path.join(ns.dir, name))
+            moved += 1
+    old_index = os.path.join(CACHE_DIR, ".cache-index.json")
+    if os.path.exists(old_index):
+        os.remove(old_index)   # rebuilt from the directory on load
+    old_state = os.path.join(DATA_DIR, "rollout.json")
+    if os.path.exists(old_state):
+        os.replace(old_state, ns.rollout.state_path)
+    print(f"[gateway] moved {moved} cached files into namespace {ns.key}", flush=True)
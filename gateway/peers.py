@@ -0,0 +1,220 @@
+import os
+import json
+import math
+import time
+import socket
+import struct
+import asyncio
+import collections
+from common.downloader import hash_prefix
+
+# ---- Peer gateways (blob sharing between gateways of one site) ----
+GATEWAY_ID = os.getenv("GATEWAY_ID", socket.gethostname())
+# Static peers: "http://gw2:8081,http://gw3:8081"
+GATEWAY_PEERS = [u.strip().rstrip("/") for u in os.getenv("GATEWAY_PEERS", "").split(",") if u.strip()]
+PEER_DISCOVERY = os.getenv("PEER_DISCOVERY", "static").lower()     # static | multicast
+PEER_MULTICAST_GROUP = os.getenv("PEER_MULTICAST_GROUP", "239.255.42.99")
+PEER_MULTICAST_PORT = int(os.getenv("PEER_MULTICAST_PORT", "48081"))
+# How other gateways reach this one; default http://<address the announcement came from>:PEER_HTTP_PORT
+PEER_ADVERTISE_URL = os.getenv("PEER_ADVERTISE_URL", "").rstrip("/")
+PEER_HTTP_PORT = int(os.getenv("PEER_HTTP_PORT", "8081"))
+PEER_ANNOUNCE_SECONDS = float(os.getenv("PEER_ANNOUNCE_SECONDS", "10"))
+PEER_TIMEOUT = float(os.getenv("PEER_TIMEOUT", "2"))                # per-peer lookup timeout
+PEER_STREAMS = int(os.getenv("PEER_STREAMS", "2"))                  # parallel ranges per peer
+PEER_MIN_SEGMENT_BYTES = int(os.getenv("PEER_MIN_SEGMENT_BYTES", str(4 * 1024 * 1024)))
+
+# url -> last announcement (multicast discovery)
+_discovered = {}
+_stats = collections.Counter()
+
+
+def urls():
+    """Peers to ask: the static list plus gateways announced recently."""
+    cutoff = time.time() - 3 * PEER_ANNOUNCE_SECONDS
+    found = [u for u, seen in _discovered.items() if seen >= cutoff]
+    return [u for u in dict.fromkeys(GATEWAY_PEERS + found) if u != PEER_ADVERTISE_URL]
+
+
+def stats():
+    return {
+        "id": GATEWAY_ID,
+        "discovery": PEER_DISCOVERY,
+        "peers": urls(),
+        **_stats,
+    }
+
+
+# -----------------------------
+# Discovery (UDP multicast on the site LAN)
+# -----------------------------
+def _announcement():
+    msg = {"id": GATEWAY_ID, "port": PEER_HTTP_PORT}
+    if PEER_ADVERTISE_URL:
+        msg["url"] = PEER_ADVERTISE_URL
+    return json.dumps(msg).encode()
+
+
+class _Announcements(asyncio.DatagramProtocol):
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            msg = json.loads(data)
+        except ValueError:
+            return
+        if not isinstance(msg, dict) or msg.get("id") == GATEWAY_ID:
+            return
+        url = msg.get("url") or f"http://{addr[0]}:{int(msg.get('port', PEER_HTTP_PORT))}"
+        if url not in _discovered:
+            print(f"[gateway] peer {msg.get('id')} discovered at {url}", flush=True)
+            # Answer right away so a gateway that just started knows us before its first sync
+            self.transport.sendto(_announcement(), (PEER_MULTICAST_GROUP, PEER_MULTICAST_PORT))
+        _discovered[url] = time.time()
+
+
+def _multicast_socket():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("", PEER_MULTICAST_PORT))
+    group = struct.pack("4sl", socket.inet_aton(PEER_MULTICAST_GROUP), socket.INADDR_ANY)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, group)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)   # stay on the site LAN
+    sock.setblocking(False)
+    return sock
+
+
+async def announce_loop():
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(_Announcements, sock=_multicast_socket())
+    try:
+        while True:
+            transport.sendto(_announcement(), (PEER_MULTICAST_GROUP, PEER_MULTICAST_PORT))
+            await asyncio.sleep(PEER_ANNOUNCE_SECONDS)
+    finally:
+        transport.close()
+
+
+def start():
+    if PEER_DISCOVERY == "multicast":
+        async def run():
+            try:
+                await announce_loop()
+            except OSError as e:
+                print(f"[gateway] peer discovery unavailable: {e}", flush=True)
+
+        asyncio.create_task(run())
+    if GATEWAY_PEERS or PEER_DISCOVERY == "multicast":
+        print(f"[gateway] peer cache sharing on ({PEER_DISCOVERY}; static peers: {GATEWAY_PEERS})", flush=True)
+
+
+# -----------------------------
+# Fetching blobs from peers
+# -----------------------------
+async def _holds(client, url, digest):
+    """Size of the blob on this peer, or None."""
+    try:
+        r = await client.head(f"{url}/blobs/sha256/{digest}", headers={"X-Gateway-Peer": GATEWAY_ID},
+                              timeout=PEER_TIMEOUT)
+    except Exception:
+        return None
+    if r.status_code != 200 or "content-length" not in r.headers:
+        return None
+    return int(r.headers["content-length"])
+
+
+async def find_holders(client, digest, size=None):
+    """(peers holding a verified copy of the blob, its size); size decided by majority when unknown."""
+    peers = urls()
+    if not peers:
+        return [], size
+    sizes = await asyncio.gather(*(_holds(client, u, digest) for u in peers))
+    if size is None:
+        counts = collections.Counter(s for s in sizes if s is not None)
+        if not counts:
+            return [], None
+        size = counts.most_common(1)[0][0]
+    return [u for u, s in zip(peers, sizes) if s == size], size
+
+
+async def _fetch_range(client, url, digest, fd, start, end, progress):
+    headers = {"Range": f"bytes={start}-{end}", "X-Gateway-Peer": GATEWAY_ID}
+    async with client.stream("GET", f"{url}/blobs/sha256/{digest}", headers=headers) as r:
+        if r.status_code != 206:
+            raise RuntimeError(f"HTTP {r.status_code} for a range request")
+        pos = start
+        async for chunk in r.aiter_bytes():
+            if pos + len(chunk) > end + 1:
+                raise RuntimeError("peer sent more than the requested range")
+            await asyncio.to_thread(os.pwrite, fd, chunk, pos)
+            pos += len(chunk)
+            progress(len(chunk))
+    if pos != end + 1:
+        raise RuntimeError(f"range {start}-{end} ended early at {pos}")
+
+
+async def _pull(client, holders, digest, fd, size, on_progress):
+    """Ranged GETs spread over the holders; a failing peer's ranges go to the others."""
+    n = max(1, min(len(holders) * PEER_STREAMS, math.ceil(size / PEER_MIN_SEGMENT_BYTES)))
+    step = math.ceil(size / n) or 1
+    ranges = collections.deque((s, min(s + step, size) - 1) for s in range(0, size, step))
+    done = [0]
+
+    def progress(k):
+        done[0] += k
+        _stats["bytes"] += k
+        if on_progress:
+            on_progress(done[0], size)
+
+    async def worker(url):
+        while ranges:
+            start, end = ranges.popleft()
+            try:
+                await _fetch_range(client, url, digest, fd, start, end, progress)
+            except Exception as e:
+                ranges.append((start, end))   # retried (from the start) by another peer
+                print(f"[gateway] peer {url} failed on {digest[:12]} bytes {start}-{end}: {e}", flush=True)
+                return url
+
+    live = list(holders)
+    while ranges and live:
+        failed = await asyncio.gather(*(worker(u) for u in live for _ in range(PEER_STREAMS)))
+        live = [u for u in live if u not in failed]
+    return not ranges
+
+
+async def fetch(client, digest, dest, size=None, tmp_dir=None, on_progress=None):
+    """
+    Download blob `digest` from peer gateways into `dest`. True on success;
+    False (nothing written) when no peer has it or the copy is bad, so the
+    caller falls back to the central server. The sha256 is always checked;
+    the caller still verifies the signature.
+    """
+    if not urls():
+        return False
+    holders, size = await find_holders(client, digest, size)
+    if not holders:
+        _stats["misses"] += 1
+        return False
+
+    # Temp file next to the blobs (same filesystem as dest); removed on any failure
+    tmp = os.path.join(tmp_dir or os.path.dirname(dest), f"{digest}.peer.part")
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    ok = False
+    try:
+        os.ftruncate(fd, size)
+        if await _pull(client, holders, digest, fd, size, on_progress):
+            await asyncio.to_thread(os.fsync, fd)
+            ok = (await asyncio.to_thread(hash_prefix, tmp)).hexdigest() == digest
+            if not ok:
+                print(f"[gateway] blob {digest[:12]} from peers failed its checksum", flush=True)
+    finally:
+        os.close(fd)
+        if ok:
+            os.replace(tmp, dest)
+        else:
+            os.remove(tmp)
+    _stats["hits" if ok else "failures"] += 1
+    if ok:
+        print(f"[gateway] blob {digest[:12]} ({size} bytes) fetched from {len(holders)} peer(s)", flush=True)
+    return ok
@@ -0,0 +1,425 @@
+import os
+import json
+import math
+import time
+import fcntl
+import bisect
+import asyncio
+import hashlib
+import itertools
+import contextlib
+from common.manifest_watch import ManifestWatch
+from cache_manager import STABLE_MANIFEST
+
+# ---- Staged rollout of new versions to the site ----
+# Opt-in: off, every new version is offered to all robots at once
+ROLLOUT_ENABLED = os.getenv("ROLLOUT_ENABLED", "false").lower() == "true"
+# cumulative share (%) of active robots offered the new version, wave by wave
+ROLLOUT_WAVES = [float(p) for p in os.getenv("ROLLOUT_WAVES", "5,25,50,100").split(",")]
+ROLLOUT_MAX_INSTALLING = int(os.getenv("ROLLOUT_MAX_INSTALLING", "5"))        # robots updating at once
+ROLLOUT_SOAK_SECONDS = float(os.getenv("ROLLOUT_SOAK_SECONDS", "60"))         # healthy time before the next wave
+ROLLOUT_INSTALL_TIMEOUT = float(os.getenv("ROLLOUT_INSTALL_TIMEOUT", "900"))  # not reporting the version by then = failed
+ROLLOUT_MAX_FAILURE_RATE = float(os.getenv("ROLLOUT_MAX_FAILURE_RATE", "0.2"))
+ROLLOUT_ROBOT_TTL = float(os.getenv("ROLLOUT_ROBOT_TTL", "3600"))             # robots silent longer are not counted
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_json(path, data):
+    _write_text(path, json.dumps(data))
+
+
+def _dump_state(state, **kw):
+    # `succeeded` is a set in memory, a sorted list on disk
+    return json.dumps(state, default=sorted, **kw)
+
+
+def _read_state(path):
+    state = _read_json(path)
+    if state is not None:
+        state["succeeded"] = set(state.get("succeeded", ()))
+    return state
+
+
+def _write_text(path, text):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+def _file_key(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+def _rank_key(robot_id):
+    # Stable pseudo-random order: the same robots are the canaries every release
+    return hashlib.sha256(robot_id.encode()).hexdigest()
+
+
+class Rollout:
+    """
+    Decides per robot whether GET /manifest returns the new (target) manifest
+    or the last fully rolled-out (stable) one.
+
+    Robots are admitted to the target in waves (ROLLOUT_WAVES, by a stable
+    hash of robot_id), at most ROLLOUT_MAX_INSTALLING at a time. /metrics
+    samples tell us when an admitted robot runs the target healthily (success)
+    or reports it failed/unhealthy (failure). A wave advances once all its
+    robots finished and stayed healthy for ROLLOUT_SOAK_SECONDS; the rollout
+    halts when the failure rate exceeds ROLLOUT_MAX_FAILURE_RATE.
+
+    `shared` (a multi-worker gateway): every worker serves manifests from the
+    state file, but only the leader decides. It admits robots from evaluate()
+    rather than on their manifest request, which may reach another worker;
+    the others pick its decisions up with refresh(). State changes happen
+    inside `locked()`, so an operator's halt on any worker is not lost.
+
+    The state file is written off the event loop: changes made while a write
+    is in progress are coalesced into the next one, and `locked()` writes
+    before it releases the lock.
+    """
+
+    def __init__(self, cache_dir, state_path, shared=False):
+        self.state_path = state_path
+        self.target_watch = ManifestWatch(os.path.join(cache_dir, "manifest.json"))
+        self.stable_watch = ManifestWatch(os.path.join(cache_dir, STABLE_MANIFEST))
+        self.robots = {}   # robot_id -> {"version", "healthy", "failed_versions", "seen", "rank"}
+        self._ranked = []  # (rank, robot_id) of every robot seen, in wave order
+        self._active_count = None   # (count, time) of robots seen within ROLLOUT_ROBOT_TTL
+        self.state = None
+        self.shared = shared
+        self.leader = True
+        self._seen = None  # state file (inode, mtime, size) last read or written
+        self._dirty = False
+        self._saving = None
+        self._changed = asyncio.Event()
+
+    # -----------------------------
+    # Manifests
+    # -----------------------------
+    @property
+    def target(self):
+        return _read_json(self.target_watch.path)
+
+    @property
+    def stable(self):
+        return _read_json(self.stable_watch.path)
+
+    def load(self):
+        target = self.target
+        state = _read_state(self.state_path)
+        if target is None:
+            self.state = None
+        elif state is not None and state.get("version") == target.get("version"):
+            self.state = state
+        else:
+            self.state = self._fresh_state(target["version"], done=self.stable is None)
+        self._seen = _file_key(self.state_path)
+
+    def refresh(self):
+        """Pick up state saved by another gateway worker. True if it changed."""
+        key = _file_key(self.state_path)
+        if key is None or key == self._seen:
+            return False
+        state, target = _read_state(self.state_path), self.target
+        if state is None or target is None or state.get("version") != target.get("version"):
+            return False   # the manifest and its state are written one after the other
+        self._seen = key
+        self.state = state
+        self._notify()
+        return True
+
+    @contextlib.asynccontextmanager
+    async def locked(self):
+        """Serialize state changes between gateway workers; a no-op in a single process."""
+        if not self.shared:
+            yield
+            return
+        with open(self.state_path + ".lock", "a") as f:
+            await asyncio.to_thread(fcntl.flock, f, fcntl.LOCK_EX)
+            self.refresh()
+            try:
+                yield
+            finally:
+                await self.flush()
+
+    def _fresh_state(self, version, done=False):
+        now = time.time()
+        return {
+            "version": version,
+            "wave": 0,
+            "wave_started": now,
+            "wave_complete_at": None,
+            "admitted": {},     # robot_id -> admission time
+            "succeeded": set(),
+            "failed": {},       # robot_id -> reason
+            "forgiven": [],     # failures excluded from the failure rate after a resume
+            "halted": None,     # reason, when halted
+            "done": done,
+            "started": now,
+        }
+
+    def begin(self, previous, manifest):
+        """
+        A new target manifest was written. The previous target becomes stable
+        if its rollout completed, or was still going with successes and no
+        halt; after a halt the older stable stays.
+        """
+        st = self.state
+        if previous is not None and st is not None and previous.get("version") == st["version"]:
+            if st["done"] or (st["succeeded"] and not st["halted"]):
+                _write_json(self.stable_watch.path, previous)
+        self.state = self._fresh_state(manifest["version"], done=not ROLLOUT_ENABLED or self.stable is None)
+        self._save()
+        self._notify()
+        print(f"[gateway] rollout of {manifest['version']} started"
+              f"{' (no stable version; offered to all)' if self.state['done'] else ''}", flush=True)
+
+    # -----------------------------
+    # Per-robot decisions
+    # -----------------------------
+    def watch_for(self, robot_id):
+        """ManifestWatch (target or stable) to serve to this robot."""
+        self._touch(robot_id)
+        st = self.state
+        if st is None or st["done"] or not os.path.exists(self.stable_watch.path):
+            return self.target_watch
+        if robot_id in st["failed"]:
+            return self.stable_watch   # roll it back
+        if robot_id in st["admitted"]:
+            return self.target_watch
+        if st["halted"] is None and not self.shared and self._eligible(robot_id):
+            st["admitted"][robot_id] = time.time()
+            self._save()
+            print(f"[gateway] rollout: {robot_id} admitted to {st['version']} (wave {st['wave'] + 1})", flush=True)
+            return self.target_watch
+        return self.stable_watch
+
+    def _touch(self, robot_id):
+        r = self.robots.get(robot_id)
+        if r is None:
+            r = self.robots[robot_id] = {"version": None, "healthy": None, "failed_versions": [],
+                                         "rank": _rank_key(robot_id)}
+            # The order is the same for every version; only new robots change it
+            bisect.insort(self._ranked, (r["rank"], robot_id))
+            self._active_count = None
+        r["seen"] = time.time()
+        return r
+
+    def _active(self):
+        cutoff = time.time() - ROLLOUT_ROBOT_TTL
+        return [rid for rid, r in self.robots.items() if r["seen"] >= cutoff]
+
+    def _active_robots(self):
+        # Counted at most once a second: robots only drop out after ROLLOUT_ROBOT_TTL
+        now = time.time()
+        if self._active_count is None or now - self._active_count[1] >= 1:
+            self._active_count = (len(self._active()), now)
+        return self._active_count[0]
+
+    def _wave_size(self, active=None):
+        pct = ROLLOUT_WAVES[min(self.state["wave"], len(ROLLOUT_WAVES) - 1)]
+        active = self._active_robots() if active is None else active
+        return max(1, math.ceil(active * pct / 100))
+
+    def _in_flight(self):
+        st = self.state
+        return [rid for rid in st["admitted"] if rid not in st["failed"] and rid not in st["succeeded"]]
+
+    def _waiting(self):
+        """Active robots not admitted yet, in wave order."""
+        admitted, cutoff = self.state["admitted"], time.time() - ROLLOUT_ROBOT_TTL
+        return (rid for _, rid in self._ranked if rid not in admitted and self.robots[rid]["seen"] >= cutoff)
+
+    def _eligible(self, robot_id):
+        st = self.state
+        open_slots = self._wave_size() - len(st["admitted"])
+        if open_slots <= 0 or len(self._in_flight()) >= ROLLOUT_MAX_INSTALLING:
+            return False
+        return robot_id in itertools.islice(self._waiting(), open_slots)
+
+    def _admit_waiting(self, now):
+        # shared: admit the next robots by rank, whichever worker they talk to
+        st = self.state
+        open_slots = min(self._wave_size() - len(st["admitted"]), ROLLOUT_MAX_INSTALLING - len(self._in_flight()))
+        if open_slots <= 0:
+            return
+        for rid in list(itertools.islice(self._waiting(), open_slots)):
+            st["admitted"][rid] = now
+            print(f"[gateway] rollout: {rid} admitted to {st['version']} (wave {st['wave'] + 1})", flush=True)
+
+    # -----------------------------
+    # Telemetry
+    # -----------------------------
+    def observe(self, data):
+        """Feed a /metrics sample: robot_id, version, healthy, failed_versions."""
+        robot_id = data.get("robot_id")
+        if not isinstance(robot_id, str) or not robot_id:
+            return
+        failed_versions = data.get("failed_versions")
+        r = self._touch(robot_id)
+        r["version"] = data.get("version")
+        r["healthy"] = data.get("healthy")
+        r["failed_versions"] = failed_versions if isinstance(failed_versions, list) else []
+
+        st = self.state
+        if st is None or st["done"]:
+            return
+        target = st["version"]
+        failed = target in r["failed_versions"] or (r["version"] == target and r["healthy"] is False)
+        ok = r["version"] == target and r["healthy"] is not False
+
+        if failed and robot_id not in st["failed"]:
+            st["admitted"].setdefault(robot_id, time.time())
+            st["succeeded"].discard(robot_id)
+            st["failed"][robot_id] = "unhealthy" if r["version"] == target else "install failed"
+            print(f"[gateway] rollout: {robot_id} failed {target} ({st['failed'][robot_id]})", flush=True)
+            self.evaluate()
+        elif ok and robot_id not in st["succeeded"] and robot_id not in st["failed"]:
+            st["admitted"].setdefault(robot_id, time.time())
+            st["succeeded"].add(robot_id)
+            self.evaluate()
+
+    def evaluate(self):
+        """Time out stuck installs, halt on failures, advance waves. Called on telemetry and periodically."""
+        st = self.state
+        if st is None or st["done"]:
+            return
+        now = time.time()
+        before = _dump_state(st, sort_keys=True)
+
+        for rid in self._in_flight():
+            if now - st["admitted"][rid] > ROLLOUT_INSTALL_TIMEOUT:
+                st["failed"][rid] = "timeout"
+                print(f"[gateway] rollout: {rid} timed out installing {st['version']}", flush=True)
+
+        failed = [rid for rid in st["failed"] if rid not in st["forgiven"]]
+        finished = len(st["succeeded"]) + len(failed)
+        if st["halted"] is None and failed and len(failed) / finished > ROLLOUT_MAX_FAILURE_RATE:
+            st["halted"] = f"failure rate {len(failed)}/{finished} above {ROLLOUT_MAX_FAILURE_RATE:.0%}"
+            print(f"[gateway] rollout of {st['version']} HALTED: {st['halted']}", flush=True)
+
+        if self.shared:
+            st["active"] = self._active_robots()   # for /rollout on the other workers
+            if st["halted"] is None:
+                self._admit_waiting(now)
+
+        if st["halted"] is None:
+            wave_full = len(st["admitted"]) >= self._wave_size() and not self._in_flight()
+            if not wave_full:
+                st["wave_complete_at"] = None
+            elif st["wave_complete_at"] is None:
+                st["wave_complete_at"] = now
+            elif now - st["wave_complete_at"] >= ROLLOUT_SOAK_SECONDS:
+                if st["wave"] + 1 < len(ROLLOUT_WAVES):
+                    st["wave"] += 1
+                    st["wave_started"], st["wave_complete_at"] = now, None
+                    print(f"[gateway] rollout of {st['version']}: wave {st['wave'] + 1} "
+                          f"({ROLLOUT_WAVES[st['wave']]:g}%)", flush=True)
+                else:
+                    st["done"] = True
+                    _write_json(self.stable_watch.path, self.target)
+                    print(f"[gateway] rollout of {st['version']} complete; now stable", flush=True)
+
+        if _dump_state(st, sort_keys=True) != before:
+            self._save()
+            self._notify()
+
+    # -----------------------------
+    # Operator controls / status
+    # -----------------------------
+    def halt(self, reason="manual"):
+        if self.state is not None and not self.state["done"]:
+            self.state["halted"] = reason
+            self._save()
+            self._notify()
+
+    def resume(self):
+        """Clear a halt; robots that failed stay on the stable version."""
+        if self.state is not None and self.state["halted"]:
+            self.state["halted"] = None
+            self.state["wave_complete_at"] = None
+            # failures so far would trip the threshold again immediately
+            self.state["forgiven"] = sorted(self.state["failed"])
+            self._save()
+            self._notify()
+
+    def status(self):
+        st = self.state
+        if st is None:
+            return {"state": "none"}
+        stable = self.stable
+        active = self._active_robots() if self.leader else st.get("active", 0)
+        return {
+            "state": "done" if st["done"] else "halted" if st["halted"] else "rolling",
+            "target_version": st["version"],
+            "stable_version": stable.get("version") if stable else None,
+            "wave": st["wave"] + 1,
+            "waves": ROLLOUT_WAVES,
+            "wave_size": self._wave_size(active),
+            "active_robots": active,
+            "admitted": len(st["admitted"]),
+            "installing": sorted(self._in_flight()),
+            "succeeded": len(st["succeeded"]),
+            "failed": st["failed"],
+            "halted": st["halted"],
+        }
+
+    # -----------------------------
+    # Internals
+    # -----------------------------
+    def _save(self):
+        self._dirty = True
+        if self.shared:
+            return   # written by locked() before it releases the lock
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Not on the event loop (startup tools, tests)
+            self._dirty = False
+            if self.state is not None:
+                _write_text(self.state_path, _dump_state(self.state))
+                self._seen = _file_key(self.state_path)
+            return
+        if self._saving is None:
+            self._saving = loop.create_task(self.flush())
+
+    async def flush(self):
+        """Write pending state changes, in a thread; serialized here so the loop may keep changing it."""
+        try:
+            while self._dirty:
+                self._dirty = False
+                if self.state is None:
+                    break
+                await asyncio.to_thread(_write_text, self.state_path, _dump_state(self.state))
+                self._seen = _file_key(self.state_path)
+        finally:
+            if self._saving is asyncio.current_task():
+                self._saving = None
+
+    async def close(self):
+        """Wait for pending state writes (shutdown)."""
+        if self._saving is not None:
+            await self._saving
+        await self.flush()
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def wait_change(self, timeout):
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
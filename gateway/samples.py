@@ -0,0 +1,344 @@
+import json
+import math
+import uuid
+import sqlite3
+from datetime import datetime
+
+# Typed storage for robot telemetry samples.
+#
+# Robots report a fixed schema (robot_id, version, cpu, mem, healthy), so each
+# sample is stored as integer epoch-ms + numeric columns, with robot_id and
+# version interned into small dictionary tables. Any other field (or a known
+# field with an unexpected type) is kept verbatim in the `extra` JSON column.
+
+SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS robots (
+      id INTEGER PRIMARY KEY,
+      name TEXT NOT NULL UNIQUE
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS versions (
+      id INTEGER PRIMARY KEY,
+      name TEXT NOT NULL UNIQUE
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS samples (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      ts INTEGER NOT NULL,
+      robot INTEGER,
+      version INTEGER,
+      cpu REAL,
+      mem REAL,
+      healthy INTEGER,
+      extra TEXT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS meta (
+      key TEXT PRIMARY KEY,
+      value TEXT NOT NULL
+    )
+    """,
+    # Every robot sample, kept for TELEMETRY_RAW_RETENTION_HOURS when only
+    # window aggregates are forwarded (see aggregation.py)
+    """
+    CREATE TABLE IF NOT EXISTS raw_samples (
+      id INTEGER PRIMARY KEY,
+      ts INTEGER NOT NULL,
+      robot INTEGER,
+      version INTEGER,
+      cpu REAL,
+      mem REAL,
+      healthy INTEGER,
+      extra TEXT
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS raw_samples_robot_ts ON raw_samples(robot, ts)",
+    "CREATE INDEX IF NOT EXISTS raw_samples_ts ON raw_samples(ts)",
+)
+
+INSERT_SQL = {
+    table: f"INSERT INTO {table}(ts, robot, version, cpu, mem, healthy, extra) VALUES(?, ?, ?, ?, ?, ?, ?)"
+    for table in ("samples", "raw_samples")
+}
+
+# Rebuilds the robot's original JSON object inside SQLite, so the flush path
+# forwards ready-to-send lines without a Python decode/re-encode. The inner
+# json_patch strips NULL columns so absent fields stay absent; the stripped
+# object is then merged over `extra` (their keys never overlap). `_seq` is the
+# row id: with the buffer's stream id it is the sample's idempotency key.
+SELECT_LINES_SQL = """
+SELECT s.id,
+       json_patch(
+         COALESCE(s.extra, '{}'),
+         json_patch('{}', json_object(
+           '_seq', s.id,
+           'ts', s.ts / 1000.0,
+           'robot_id', r.name,
+           'version', v.name,
+           'cpu', s.cpu,
+           'mem', s.mem,
+           'healthy', CASE s.healthy WHEN 1 THEN json('true') WHEN 0 THEN json('false') END
+         ))
+       )
+FROM samples s
+LEFT JOIN robots r ON r.id = s.robot
+LEFT JOIN versions v ON v.id = s.version
+ORDER BY s.id
+LIMIT ?
+"""
+
+# name -> id caches; only touched from the writer thread
+_interned = {"robots": {}, "versions": {}}
+
+
+def encode(data, ts_ms):
+    """
+    Split a robot payload into (ts, robot_id, version, cpu, mem, healthy, extra).
+
+    Raises ValueError for NaN/Infinity anywhere in the sample: SQLite's JSON
+    functions reject them, so a stored one would fail every flush select.
+    """
+    if not isinstance(data, dict):
+        data = {"value": data}
+    extra = dict(data)
+    robot_id = extra.pop("robot_id") if isinstance(data.get("robot_id"), str) else None
+    version = extra.pop("version") if isinstance(data.get("version"), str) else None
+    cpu = _real("cpu", extra.pop("cpu")) if _is_number(data.get("cpu")) else None
+    mem = _real("mem", extra.pop("mem")) if _is_number(data.get("mem")) else None
+    healthy = int(extra.pop("healthy")) if isinstance(data.get("healthy"), bool) else None
+    try:
+        extra_json = json.dumps(extra, separators=(",", ":"), allow_nan=False) if extra else None
+    except ValueError:
+        raise ValueError("sample contains a non-finite number (NaN or Infinity)") from None
+    return (ts_ms, robot_id, version, cpu, mem, healthy, extra_json)
+
+
+def _is_number(v):
+    return isinstance(v, (int, float)) and not isinstance(v, bool)
+
+
+def _real(name, v):
+    try:
+        v = float(v)
+    except OverflowError:
+        v = math.inf
+    if not math.isfinite(v):
+        raise ValueError(f"{name} is not a finite number")
+    return v
+
+
+def _intern(conn, table, name):
+    if name is None:
+        return None
+    cache = _interned[table]
+    key = cache.get(name)
+    if key is None:
+        conn.execute(f"INSERT OR IGNORE INTO {table}(name) VALUES(?)", (name,))
+        key = conn.execute(f"SELECT id FROM {table} WHERE name = ?", (name,)).fetchone()[0]
+        cache[name] = key
+    return key
+
+
+def insert_many(conn, rows, table="samples"):
+    try:
+        conn.executemany(
+            INSERT_SQL[table],
+            [
+                (ts, _intern(conn, "robots", robot), _intern(conn, "versions", ver), cpu, mem, healthy, extra)
+                for ts, robot, ver, cpu, mem, healthy, extra in rows
+            ],
+        )
+    except Exception:
+        # The transaction is rolled back, so newly interned ids may not exist
+        for cache in _interned.values():
+            cache.clear()
+        raise
+
+
+def insert_one(conn, row, table="samples"):
+    insert_many(conn, [row], table)
+
+
+def select_lines(conn, limit):
+    """Oldest `limit` samples as [(id, json_line), ...]."""
+    return conn.execute(SELECT_LINES_SQL, (limit,)).fetchall()
+
+
+def delete_ids(conn, ids):
+    conn.executemany("DELETE FROM samples WHERE id = ?", [(i,) for i in ids])
+
+
+# Raw history (aggregation enabled): same JSON reconstruction, by robot and time
+_RAW_LINE = """
+SELECT json_patch(
+         COALESCE(s.extra, '{}'),
+         json_patch('{}', json_object(
+           'ts', s.ts / 1000.0,
+           'robot_id', r.name,
+           'version', v.name,
+           'cpu', s.cpu,
+           'mem', s.mem,
+           'healthy', CASE s.healthy WHEN 1 THEN json('true') WHEN 0 THEN json('false') END
+         ))
+       )
+FROM raw_samples s
+LEFT JOIN robots r ON r.id = s.robot
+LEFT JOIN versions v ON v.id = s.version
+"""
+RAW_ROBOT_SQL = _RAW_LINE + "WHERE s.robot = (SELECT id FROM robots WHERE name = ?) AND s.ts BETWEEN ? AND ? ORDER BY s.ts LIMIT ?"
+RAW_ALL_SQL = _RAW_LINE + "WHERE s.ts BETWEEN ? AND ? ORDER BY s.ts LIMIT ?"
+RAW_AFTER_SQL = _RAW_LINE.replace("SELECT ", "SELECT s.id, s.ts, ", 1) + "WHERE s.id > ? ORDER BY s.id LIMIT ?"
+
+
+def select_raw(conn, robot_id, start_ms, end_ms, limit):
+    """Raw samples as JSON lines, oldest first; all robots when robot_id is None."""
+    if robot_id is None:
+        rows = conn.execute(RAW_ALL_SQL, (start_ms, end_ms, limit))
+    else:
+        rows = conn.execute(RAW_ROBOT_SQL, (robot_id, start_ms, end_ms, limit))
+    return [line for (line,) in rows]
+
+
+def select_raw_after(conn, after_id, limit):
+    """Raw samples after `after_id` in insert order as [(id, ts_ms, json_line), ...]."""
+    return conn.execute(RAW_AFTER_SQL, (after_id, limit)).fetchall()
+
+
+def prune_raw(conn, before_ms, limit):
+    """Delete up to `limit` raw samples older than `before_ms`. Returns the number deleted."""
+    return conn.execute(
+        "DELETE FROM raw_samples WHERE id IN (SELECT id FROM raw_samples WHERE ts < ? LIMIT ?)",
+        (before_ms, limit),
+    ).rowcount
+
+
+# Keeps the first sample per robot and time bucket among the oldest rows;
+# unhealthy samples and window aggregates (their `agg` object, see
+# aggregation.py) are never dropped: an aggregate already is the one row of
+# its window, and thinning would lose its counts.
+DOWNSAMPLE_SQL = """
+DELETE FROM samples WHERE id IN (
+  SELECT id FROM (
+    SELECT id, healthy, extra, ROW_NUMBER() OVER (PARTITION BY robot, ts / ? ORDER BY id) AS n
+    FROM (SELECT id, robot, ts, healthy, extra FROM samples ORDER BY id LIMIT ?)
+  )
+  WHERE n > 1 AND healthy IS NOT 0 AND json_type(extra, '$.agg') IS NOT 'object'
+)
+"""
+
+
+def downsample_oldest(conn, rows, bucket_ms):
+    """Thin the oldest `rows` samples to one per robot per `bucket_ms`. Returns the number deleted."""
+    return conn.execute(DOWNSAMPLE_SQL, (bucket_ms, rows)).rowcount
+
+
+def count_rows(conn, table="samples"):
+    return conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+
+def init_schema(conn):
+    """Create tables; returns the buffer's stream id."""
+    for stmt in SCHEMA:
+        conn.execute(stmt)
+    _migrate_legacy(conn)
+    _repair_non_finite(conn)
+    return stream_id(conn)
+
+
+def stream_id(conn):
+    """
+    Random id of this buffer, created with it. Row ids only grow within one
+    database file (AUTOINCREMENT), so a new file must not reuse the keys the
+    central server has already seen.
+    """
+    conn.execute("INSERT OR IGNORE INTO meta(key, value) VALUES('stream', ?)", (uuid.uuid4().hex[:16],))
+    return conn.execute("SELECT value FROM meta WHERE key = 'stream'").fetchone()[0]
+
+
+def shard_stream(conn):
+    """Stream id of a buffer another gateway worker created, or None before it has its schema."""
+    try:
+        row = conn.execute("SELECT value FROM meta WHERE key = 'stream'").fetchone()
+    except sqlite3.OperationalError:
+        return None
+    return row[0] if row else None
+
+
+# Fields rollout decisions need, read back for the leader when several
+# gateway workers buffer samples (see workers.py)
+OBSERVE_SQL = {
+    table: f"""
+SELECT s.id, r.name, v.name, s.healthy,
+       CASE json_type(s.extra, '$.failed_versions') WHEN 'array' THEN json_extract(s.extra, '$.failed_versions') END,
+       json_extract(s.extra, '$.product'),
+       json_extract(s.extra, '$.channel')
+FROM {table} s
+LEFT JOIN robots r ON r.id = s.robot
+LEFT JOIN versions v ON v.id = s.version
+WHERE s.id > ?
+ORDER BY s.id
+LIMIT ?
+"""
+    for table in ("samples", "raw_samples")
+}
+
+
+def select_observations(conn, table, after_id, limit):
+    """[(id, {robot_id, version, healthy, failed_versions, product, channel}), ...] of rows after `after_id`."""
+    out = []
+    for rid, robot, version, healthy, failed, product, channel in conn.execute(OBSERVE_SQL[table], (after_id, limit)):
+        out.append((rid, {
+            "robot_id": robot,
+            "version": version,
+            "healthy": None if healthy is None else bool(healthy),
+            "failed_versions": json.loads(failed) if failed else [],
+            "product": product,
+            "channel": channel,
+        }))
+    return out
+
+
+def max_id(conn, table="samples"):
+    return conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0]
+
+
+def _repair_non_finite(conn):
+    """
+    Rows buffered before encode() rejected NaN/Infinity: an infinite cpu/mem
+    or unparsable extra would make every flush select fail. Drop those values.
+    """
+    for table in ("samples", "raw_samples"):
+        n = conn.execute(
+            f"UPDATE {table} SET extra = NULL WHERE extra IS NOT NULL AND NOT json_valid(extra)"
+        ).rowcount
+        for col in ("cpu", "mem"):
+            n += conn.execute(f"UPDATE {table} SET {col} = NULL WHERE abs({col}) > 1.7976931348623157e308").rowcount
+        if n:
+            print(f"[gateway] dropped non-finite values from {n} buffered {table} rows", flush=True)
+
+
+def _migrate_legacy(conn):
+    """Move rows from the old JSON-text `metrics` table into `samples`."""
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'metrics'"
+    ).fetchone()
+    if not exists:
+        return
+    rows = []
+    for ts, payload in conn.execute("SELECT ts, payload FROM metrics ORDER BY id"):
+        try:
+            rows.append(encode(json.loads(payload), _iso_to_ms(ts)))
+        except ValueError:
+            pass   # NaN/Infinity: could never be forwarded
+    if rows:
+        insert_many(conn, rows)
+    conn.execute("DROP TABLE metrics")
+    print(f"[gateway] migrated {len(rows)} buffered metrics rows to typed storage", flush=True)
+
+
+def _iso_to_ms(ts):
+    return int(datetime.fromisoformat(ts).timestamp() * 1000)
@@ -1,270 +1,850 @@
 import os
 import time, shutil
 import json
-import sqlite3
+import heapq
+import itertools
 import asyncio
-import hashlib
 import subprocess
 import asyncio
-from datetime import datetime, timezone
 from pathlib import Path
 import httpx
-from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import FileResponse
-from cache_manager import gc_cache_once
-from common.downloader import download_with_resume
+from fastapi import FastAPI, Request, HTTPException, Query
+from fastapi.responses import Response
+from cache_manager import gc_cache_once, STABLE_MANIFEST
+from blob_store import BlobStore
+from common.downloader import async_download_with_resume
+from common.verify_cache import VerifyCache, already_verified, SIGNATURES_VERIFIED, COSIGN_SECONDS
+from common import prom
+from common.manifest_watch import MANIFEST_WATCH_MAX_SECONDS
+import forwarder
+import telemetry_buffer
+from telemetry_buffer import TelemetryBuffer
+import aggregation
+from aggregation import WindowAggregator
+from rollout import ROLLOUT_ENABLED
+import db as database
+from db import Database
+import artifact_server
+import delta
+import samples
+import namespaces
+import peers
+import workers
 
 app = FastAPI()
 
-DASHBOARD_URL = os.getenv("DASHBOARD_URL", "http://dashboard:8080")
-
-DATA_DIR = "/app/data"
-DB_PATH = os.path.join(DATA_DIR, "metrics.db")
+DATA_DIR = os.getenv("DATA_DIR", "/app/data")
 os.makedirs(DATA_DIR, exist_ok=True)
 
-CACHE_DIR = "/app/cache"
+# ---- Worker processes (GATEWAY_WORKERS): telemetry is buffered per worker in
+# its own SQLite shard; one leader syncs OTA, runs GC and flushes all shards ----
+SHARD = workers.claim_shard(DATA_DIR)
+DB_PATH = workers.shard_path(DATA_DIR, SHARD)
+leader = workers.Leader(DATA_DIR)
+OBSERVE_BATCH = 5000   # rows per read when the leader follows other workers' samples (rollouts, windows)
+
+CACHE_DIR = os.getenv("CACHE_DIR", "/app/cache")
 os.makedirs(CACHE_DIR, exist_ok=True)
 GC_INTERVAL = int(os.getenv("CACHE_GC_INTERVAL", "300"))  # 5 min
 
-# ---- Central OTA source (dashboard) ----
-OTA_SOURCE_URL = os.getenv("OTA_SOURCE_URL", "http://dashboard:8080/ota")
+# ---- Central OTA source (dashboard); per product/channel, see namespaces.py ----
 POLL_SECONDS = int(os.getenv("OTA_POLL_SECONDS", "30"))
+# Long-poll the central manifest instead of polling it (falls back if unsupported)
+OTA_WATCH = os.getenv("OTA_WATCH", "true").lower() == "true"
+OTA_WATCH_SECONDS = float(os.getenv("OTA_WATCH_SECONDS", "30"))
 
 # ---- Cosign verification ----
-COSIGN_PUB = "/app/cosign.pub"
+COSIGN_PUB = os.getenv("COSIGN_PUB", "/app/cosign.pub")
+verify_cache = VerifyCache(os.path.join(CACHE_DIR, ".verify-cache.json"), COSIGN_PUB)
+
+# ---- Content-addressed store shared by all namespaces ----
+blobs = BlobStore()
 
 # ---- Autoflush metrics enablement ----
 AUTO_FLUSH = os.getenv("AUTO_FLUSH", "false").lower() == "true"
-FLUSH_INTERVAL_SECONDS = int(os.getenv("FLUSH_INTERVAL_SECONDS", "5"))
-FLUSH_BATCH_SIZE = int(os.getenv("FLUSH_BATCH_SIZE", "200"))
+# Batch sizing/backoff: forwarder.FlushPacer (FLUSH_* settings live in forwarder.py)
 
 _flush_lock = asyncio.Lock()
-
-def db_conn():
-    # check_same_thread False is safe here because we open per request
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    conn.execute("PRAGMA journal_mode=WAL;")  # better durability/concurrency
-    conn.execute("PRAGMA synchronous=NORMAL;")
-    return conn
-
-def init_db():
-    conn = db_conn()
-    conn.execute(
-        """
-        CREATE TABLE IF NOT EXISTS metrics (
-          id INTEGER PRIMARY KEY AUTOINCREMENT,
-          ts TEXT NOT NULL,
-          payload TEXT NOT NULL
-        )
-        """
-    )
-    conn.commit()
-    conn.close()
+flush_pacer = forwarder.FlushPacer()
+
+db = Database(DB_PATH)
+telemetry = TelemetryBuffer(db, high_water=telemetry_buffer.BUFFER_HIGH_WATER_ROWS // workers.GATEWAY_WORKERS,
+                            shared=workers.GATEWAY_WORKERS > 1)
+shards = workers.ShardSet(DATA_DIR, workers.Shard(SHARD, db, telemetry), peers.GATEWAY_ID)
+# ---- Edge pre-aggregation: forward per-robot windows, keep raw samples locally ----
+windows = WindowAggregator() if aggregation.TELEMETRY_AGGREGATE_SECONDS > 0 else None
+raw_history = TelemetryBuffer(db, table="raw_samples") if windows else None
+NAMESPACES = namespaces.load(OTA_WATCH)
+DEFAULT_NS = next(iter(NAMESPACES.values()))
+ROLLOUT_TICK_SECONDS = float(os.getenv("ROLLOUT_TICK_SECONDS", "5"))
+
+# ---- Prometheus metrics (GET /metrics/prom); gauges are read at scrape time ----
+INGEST_SECONDS = prom.histogram("gateway_ingest_seconds", "POST /metrics handling time", database.LATENCY_BUCKETS)
+FLUSH_SECONDS = prom.histogram("gateway_flush_seconds", "Duration of flush cycles that found rows", prom.DURATION_BUCKETS)
+FLUSH_BATCH_ROWS = prom.histogram("gateway_flush_batch_rows", "Rows selected per flush", prom.SIZE_BUCKETS)
+FLUSH_SENT = prom.counter("gateway_flush_sent_rows_total", "Rows delivered to the central server")
+FLUSH_ERRORS = prom.counter("gateway_flush_errors_total", "Flush cycles that left rows undelivered")
+INGEST_REJECTED = prom.counter("gateway_ingest_rejected_total", "POST /metrics answered 429 (telemetry buffer full)")
+prom.gauge("gateway_flush_batch_target", "Rows per auto-flush chosen by the pacer", fn=lambda: flush_pacer.batch)
+prom.gauge("gateway_flush_inflight_target", "Concurrent upstream requests chosen by the pacer", fn=lambda: flush_pacer.inflight)
+prom.gauge("gateway_telemetry_buffer_full", "1 while the telemetry buffer is over its high-water mark", fn=lambda: int(telemetry.full))
+prom.gauge("gateway_telemetry_downsampled_rows", "Old samples thinned to make room since startup", fn=lambda: telemetry.downsampled)
+prom.gauge("gateway_telemetry_buffered_rows", "Samples buffered for the central server", fn=lambda: shards.count)
+prom.gauge("gateway_leader", "1 in the worker process that syncs OTA and flushes", fn=lambda: int(leader.is_leader))
+WINDOWS_QUEUED = prom.counter("gateway_telemetry_windows_total", "Window aggregates queued for the central server")
+if windows:
+    prom.gauge("gateway_telemetry_open_windows", "Robots with an open aggregation window", fn=lambda: len(windows.windows))
+    prom.gauge("gateway_telemetry_raw_rows", "Raw samples kept at the edge", fn=lambda: raw_history.count)
+prom.gauge("gateway_telemetry_pending_rows", "Samples not yet committed to SQLite", fn=lambda: telemetry.pending)
+prom.gauge("gateway_sqlite_queue_depth", "Jobs waiting for the SQLite writer", fn=lambda: db.queue_depth)
+prom.gauge("gateway_artifact_transfers_active", "Artifact bodies being sent", fn=lambda: artifact_server.limiter.active)
+prom.gauge("gateway_artifact_transfers_waiting", "Artifact requests queued for a slot", fn=lambda: artifact_server.limiter.waiting)
+for _ns_key, _namespace in NAMESPACES.items():
+    prom.gauge("gateway_cache_bytes", "Indexed cache size", fn=lambda ns=_namespace: ns.index.total_bytes, namespace=_ns_key)
 
 @app.on_event("startup")
-def startup():
-    init_db()
+async def startup():
+    db.start()
+    stream = await db.write("init", samples.init_schema)
+    shards.own.source = f"{peers.GATEWAY_ID}/{stream}"
+    await telemetry.start()
+    if workers.GATEWAY_WORKERS > 1:
+        asyncio.create_task(recount_loop())
+        print(f"[gateway] worker {SHARD + 1}/{workers.GATEWAY_WORKERS} (pid {os.getpid()}) "
+              f"buffers telemetry in {os.path.basename(DB_PATH)}", flush=True)
+    if windows:
+        await raw_history.start()
+        asyncio.create_task(aggregation_loop())
+        print(f"[gateway] telemetry aggregated into {windows.seconds:g}s windows; "
+              f"raw samples kept {aggregation.TELEMETRY_RAW_RETENTION_HOURS:g}h", flush=True)
+
+@app.on_event("shutdown")
+async def stop_telemetry():
+    if windows:
+        await _queue_windows(windows.drain())
+        await raw_history.stop()
+    await telemetry.stop()
+    shards.close()
+    db.stop()
+
+async def recount_loop():
+    """Multi-worker: rows of a shard are added by its worker and deleted by the leader; re-read the counts."""
+    while True:
+        await asyncio.sleep(5)
+        try:
+            await shards.recount()
+        except Exception as e:
+            print(f"[gateway] telemetry recount failed: {e}", flush=True)
+
+async def _queue_windows(closed):
+    for payload, ts_ms in closed:
+        await telemetry.add(samples.encode(payload, ts_ms))
+        WINDOWS_QUEUED.inc()
+
+async def aggregation_loop():
+    """Close windows of robots that went quiet; prune raw samples past their retention."""
+    last_prune = 0.0
+    while True:
+        await asyncio.sleep(min(windows.seconds, 5))
+        try:
+            if workers.GATEWAY_WORKERS == 1:
+                await _queue_windows(windows.expire(int(time.time() * 1000)))
+            elif leader.is_leader:
+                await _aggregate()
+            if time.monotonic() - last_prune >= 60:
+                last_prune = time.monotonic()
+                cutoff = int((time.time() - aggregation.TELEMETRY_RAW_RETENTION_HOURS * 3600) * 1000)
+                while True:   # in slices, so ingest commits are not held up
+                    n = await db.write("raw_prune", samples.prune_raw, cutoff, 10000)
+                    raw_history.removed(n)
+                    if n < 10000:
+                        break
+        except Exception as e:
+            print(f"[gateway] telemetry aggregation error: {e}", flush=True)
+
+async def _aggregate():
+    """
+    Multi-worker (leader): a robot's samples reach any worker, so its windows
+    are folded here from every shard's raw samples, merged by time. Samples
+    are read once they are AGGREGATE_GRACE_SECONDS old, when the window
+    they close is due to expire anyway.
+    """
+    await raw_history.commit()
+    now_ms = int(time.time() * 1000)
+    ready_ms = now_ms - int(aggregation.AGGREGATE_GRACE_SECONDS * 1000)
+    parts = []
+    for shard in await shards.all():
+        if shard.aggregated is None:
+            # Newly elected: robots are picked up from their next sample
+            shard.aggregated = await shard.db.read("aggregate_start", samples.max_id, "raw_samples")
+        part = []
+        while True:
+            rows = await shard.db.read("aggregate_select", samples.select_raw_after, shard.aggregated, OBSERVE_BATCH)
+            ready = list(itertools.takewhile(lambda r: r[1] < ready_ms, rows))
+            if ready:
+                part += ready
+                shard.aggregated = ready[-1][0]
+            if len(ready) < OBSERVE_BATCH:
+                break
+        parts.append(part)
+    for _, ts_ms, line in heapq.merge(*parts, key=lambda r: r[1]):
+        await _queue_windows(windows.add(json.loads(line), ts_ms))
+    await _queue_windows(windows.expire(now_ms))
 
 @app.post("/metrics")
 async def metrics(req: Request):
+    started = time.perf_counter()
+    if not telemetry.accepting():
+        INGEST_REJECTED.inc()
+        raise HTTPException(429, "telemetry buffer full", headers={"Retry-After": str(_retry_after())})
     data = await req.json()
-    ts = datetime.now(timezone.utc).isoformat()
-
-    conn = db_conn()
+    ts_ms = int(time.time() * 1000)
     try:
-        conn.execute(
-            "INSERT INTO metrics(ts, payload) VALUES(?, ?)",
-            (ts, json.dumps(data)),
-        )
-        conn.commit()
-        buffered = conn.execute("SELECT COUNT(*) FROM metrics").fetchone()[0]
-    finally:
-        conn.close()
-
+        row = samples.encode(data, ts_ms)
+    except ValueError as e:
+        raise HTTPException(422, str(e))
+    if ROLLOUT_ENABLED and isinstance(data, dict) and isinstance(data.get("robot_id"), str):
+        rollout = _namespace_of(data).rollout
+        if not rollout.shared:
+            rollout.observe(data)   # shared: the leader reads it back from the shards, see _observe()
+
+    if windows is None:
+        buffered = await telemetry.add(row)
+    else:
+        await raw_history.add(row)
+        if workers.GATEWAY_WORKERS == 1:
+            await _queue_windows(windows.add(data, ts_ms))
+        # otherwise the leader folds every worker's raw samples, see _aggregate()
+        buffered = telemetry.count
+    INGEST_SECONDS.observe(time.perf_counter() - started)
     return {"ok": True, "buffered": buffered}
 
+def _retry_after():
+    """Seconds until the buffer should be back under its low-water mark at the current drain rate."""
+    excess = telemetry.count - telemetry.high_water * telemetry_buffer.BUFFER_LOW_WATER
+    if flush_pacer.rate <= 0 or excess <= 0:
+        return 30
+    return int(min(300, max(5, excess / flush_pacer.rate)))
+
+@app.get("/metrics/prom")
+def metrics_prom():
+    return Response(prom.render(), media_type=prom.CONTENT_TYPE)
+
+@app.get("/db/stats")
+def db_stats():
+    """Per-operation SQLite latency next to end-to-end /metrics latency (http_metrics), from the histograms."""
+    return database.latency_stats(http_metrics=INGEST_SECONDS)
+
+@app.get("/flush/stats")
+def flush_stats():
+    st = {
+        **flush_pacer.stats(),
+        "buffered": shards.count,
+        "buffer_full": telemetry.full,
+        "downsampled": telemetry.downsampled,
+    }
+    if workers.GATEWAY_WORKERS > 1:
+        # As seen by the worker that answered; the leader knows every shard
+        st["worker"] = {"shard": SHARD, "pid": os.getpid(), "leader": leader.is_leader}
+        st["shards"] = {i: s.telemetry.count for i, s in sorted(shards.shards.items())}
+    if windows:
+        st["aggregation"] = {
+            "seconds": windows.seconds,
+            "open_windows": len(windows.windows),
+            "samples": windows.samples,
+            "windows_queued": WINDOWS_QUEUED.value,
+            "raw_rows": raw_history.count,
+        }
+    return st
+
+@app.get("/telemetry/raw")
+async def telemetry_raw(robot_id: str = None, from_: float = Query(None, alias="from"), to: float = None, limit: int = 1000):
+    """Raw samples kept at the edge while aggregates are forwarded; from/to in epoch seconds."""
+    if raw_history is None:
+        raise HTTPException(404, "telemetry aggregation is off; every sample is forwarded")
+    await raw_history.commit()
+    now = time.time()
+    start = now - aggregation.TELEMETRY_RAW_RETENTION_HOURS * 3600 if from_ is None else from_
+    end = now + 60 if to is None else to
+    limit = max(1, min(limit, 10000))
+    # Every worker's shard: a robot's samples may have reached any of them
+    parts = [await s.db.read("raw_select", samples.select_raw, robot_id, int(start * 1000), int(end * 1000), limit)
+             for s in await shards.all()]
+    lines = parts[0] if len(parts) == 1 else list(
+        itertools.islice(heapq.merge(*parts, key=lambda line: json.loads(line)["ts"]), limit))
+    return Response("[" + ",".join(lines) + "]", media_type="application/json")
+
 @app.post("/flush")
 async def flush():
      return await flush_once()
 
-async def flush_once(limit: int = None):
-    limit = limit or FLUSH_BATCH_SIZE
+async def flush_once(limit: int = None, inflight: int = None):
+    """
+    One flush of up to `limit` rows per shard: every shard on the leader, only
+    its own on another worker (a manual POST /flush that reached it).
+    """
+    limit = limit or forwarder.FLUSH_BATCH_SIZE
 
     async with _flush_lock:  # prevents auto + manual flush overlapping
-        conn = db_conn()
-        try:
-            rows = conn.execute(
-                "SELECT id, payload FROM metrics ORDER BY id LIMIT ?",
-                (limit,)
-            ).fetchall()
-
-            remaining_before = conn.execute("SELECT COUNT(*) FROM metrics").fetchone()[0]
+        res = {"ok": True, "sent": 0, "selected": 0, "seconds": 0.0, "slowest": 0.0}
+        for shard in (await shards.all() if leader.is_leader else [shards.own]):
+            r = await _flush_shard(shard, limit, inflight)
+            res["sent"] += r["sent"]
+            # a full batch from any shard means a backlog (see FlushPacer)
+            res["selected"] = max(res["selected"], r.get("selected", 0))
+            res["seconds"] = round(res["seconds"] + r.get("seconds", 0), 3)
+            res["slowest"] = max(res["slowest"], r.get("slowest", 0))
+            if not r["ok"]:
+                # Upstream trouble: the other shards wait for the next cycle too
+                res.update(ok=False, error=r["error"], retry_after=r.get("retry_after"))
+                break
+        if not leader.is_leader:
+            await telemetry.recount()   # the leader may have flushed part of this shard
+        res["remaining"] = shards.count
+        return res
+
+async def _flush_shard(shard, limit, inflight):
+    try:
+        await shard.telemetry.commit()  # include samples still in the write-behind ring
+        rows = await shard.db.read("flush_select", samples.select_lines, limit)
+
+        if not rows:
+            return {"ok": True, "sent": 0}
+        if leader.is_leader and windows is None and workers.GATEWAY_WORKERS > 1 and ROLLOUT_ENABLED:
+            await _observe(shard)   # before the rows are deleted
+
+        # Lines are assembled by SQLite; forward them as-is
+        started = time.perf_counter()
+        FLUSH_BATCH_ROWS.observe(len(rows))
+
+        async def delivered(ids):
+            # Committed per acknowledged chunk, so a later failure cannot resend them
+            await shard.db.write("flush_delete", samples.delete_ids, ids)
+            shard.telemetry.removed(len(ids))
+            FLUSH_SENT.inc(len(ids))
+
+        # Oldest first and ids are never reused: everything below the first row is gone
+        sent, error, slowest = await forwarder.send_rows(rows, delivered, inflight, shard.source, rows[0][0] - 1)
+        seconds = time.perf_counter() - started
+        FLUSH_SECONDS.observe(seconds)
+
+        res = {"ok": error is None, "sent": sent, "selected": len(rows),
+               "seconds": round(seconds, 3), "slowest": round(slowest, 3)}
+        if error is not None:
+            FLUSH_ERRORS.inc()
+            # Undelivered rows stay buffered for the next cycle
+            res["error"] = str(error)
+            res["retry_after"] = forwarder.retry_after(error)
+        return res
+
+    except Exception as e:
+        # If anything fails, keep rows (don’t delete)
+        FLUSH_ERRORS.inc()
+        return {"ok": False, "sent": 0, "error": str(e)}
+
+async def _observe(shard):
+    """
+    Multi-worker (leader): feed the samples a shard's worker buffered to the
+    rollout decisions, from where it was last read; raw samples when windows
+    are forwarded, so health changes are not a window late. The flush and
+    observe_loop() both call it; the shard's lock keeps them from feeding the
+    same rows twice.
+    """
+    async with shard.observing:
+        table = "raw_samples" if windows else "samples"
+        if shard.observed is None:
+            # Newly elected: robots are picked up from their next sample
+            shard.observed = await shard.db.read("observe_start", samples.max_id, table)
+        while True:
+            rows = await shard.db.read("observe", samples.select_observations, table, shard.observed, OBSERVE_BATCH)
             if not rows:
-                return {"ok": True, "sent": 0, "remaining": remaining_before}
-
-            sent_ids = []
-            async with httpx.AsyncClient(timeout=5) as client:
-                for mid, payload_json in rows:
-                    payload = json.loads(payload_json)
-                    r = await client.post(f"{DASHBOARD_URL}/ingest", json=payload)
-                    r.raise_for_status()
-                    sent_ids.append(mid)
-
-            if sent_ids:
-                conn.executemany("DELETE FROM metrics WHERE id = ?", [(i,) for i in sent_ids])
-                conn.commit()
-
-            remaining_after = conn.execute("SELECT COUNT(*) FROM metrics").fetchone()[0]
-            return {"ok": True, "sent": len(sent_ids), "remaining": remaining_after}
-
+                return
+            shard.observed = rows[-1][0]
+            by_ns = {}
+            for _, data in rows:
+                by_ns.setdefault(_namespace_of(data), []).append(data)
+            for ns, batch in by_ns.items():
+                async with ns.rollout.locked():
+                    for data in batch:
+                        ns.rollout.observe(data)
+            if len(rows) < OBSERVE_BATCH:
+                return
+
+async def observe_loop():
+    while True:
+        await asyncio.sleep(1)
+        try:
+            for shard in await shards.all():
+                await _observe(shard)
         except Exception as e:
-            # If anything fails, keep rows (don’t delete)
-            remaining = conn.execute("SELECT COUNT(*) FROM metrics").fetchone()[0]
-            return {"ok": False, "sent": 0, "remaining": remaining, "error": str(e)}
-        finally:
-            conn.close()
-            
+            print(f"[gateway] reading samples for rollouts failed: {e}", flush=True)
+
 async def auto_flush_loop():
+    last_log = 0.0
     while True:
         try:
-            res = await flush_once()
-            # log only when something happened or there was an error
-            if res.get("sent", 0) > 0:
-                print(f"[gateway] auto-flush sent={res['sent']} remaining={res['remaining']}", flush=True)
-            elif res.get("ok") is False:
-                print(f"[gateway] auto-flush failed: {res.get('error')}", flush=True)
+            batch = flush_pacer.batch
+            res = await flush_once(batch, flush_pacer.inflight)
+            delay = flush_pacer.update(res, batch)
+            # log failures, and progress at most every 10 s while draining
+            if res["sent"] > 0 and time.monotonic() - last_log >= 10:
+                last_log = time.monotonic()
+                print(f"[gateway] auto-flush sent={res['sent']} remaining={res['remaining']} "
+                      f"batch={flush_pacer.batch} inflight={flush_pacer.inflight}", flush=True)
+            if not res["ok"]:
+                print(f"[gateway] auto-flush failed: {res.get('error')}; next attempt in {delay:.1f}s", flush=True)
         except Exception as e:
             print(f"[gateway] auto-flush loop error: {e}", flush=True)
+            delay = forwarder.FLUSH_INTERVAL_SECONDS
 
-        await asyncio.sleep(FLUSH_INTERVAL_SECONDS)
+        await asyncio.sleep(delay)
 
 
-@app.on_event("startup")
-async def start_auto_flush():
-    if AUTO_FLUSH:
-        asyncio.create_task(auto_flush_loop())
-        print("[gateway] auto-flush enabled", flush=True)
+@app.on_event("shutdown")
+async def stop_forwarder():
+    await forwarder.close_client()
+
+def _robot_id(request: Request):
+    return request.headers.get("x-robot-id") or (request.client.host if request.client else "?")
+
+def _ns(product: str = None, channel: str = None):
+    if product is None:
+        return DEFAULT_NS
+    ns = NAMESPACES.get(f"{product}/{channel}")
+    if ns is None:
+        raise HTTPException(404, f"unknown product/channel {product}/{channel}")
+    return ns
+
+def _namespace_of(data):
+    """Namespace a robot's sample belongs to (robots send product/channel; older ones don't)."""
+    if data.get("product") and data.get("channel"):
+        return NAMESPACES.get(f"{data['product']}/{data['channel']}", DEFAULT_NS)
+    return DEFAULT_NS
+
+# Unprefixed routes serve the default (first subscribed) product/channel;
+# /ns/{product}/{channel}/... serves any subscribed one.
 
 @app.get("/manifest")
-def get_manifest():
-    p = os.path.join(CACHE_DIR, "manifest.json")
-    if not os.path.exists(p):
-        raise HTTPException(404, "manifest not found")
-    return FileResponse(p)
-
-@app.get("/artifact/{name}")
-def get_artifact(name: str):
-    p = os.path.join(CACHE_DIR, name)
-    if not os.path.exists(p):
-        raise HTTPException(404, "artifact not found")
-    return FileResponse(p)
+@app.get("/ns/{product}/{channel}/manifest")
+def get_manifest(request: Request, product: str = None, channel: str = None):
+    # Target or stable manifest, depending on the robot's place in the rollout
+    return _ns(product, channel).rollout.watch_for(_robot_id(request)).response(request)
+
+@app.get("/manifest/watch")
+@app.get("/ns/{product}/{channel}/manifest/watch")
+async def watch_manifest(request: Request, product: str = None, channel: str = None, timeout: float = None):
+    """Long-poll: send If-None-Match with the last ETag; returns on change or 304 after timeout."""
+    rollout = _ns(product, channel).rollout
+    robot_id = _robot_id(request)
+    timeout = MANIFEST_WATCH_MAX_SECONDS if timeout is None else min(timeout, MANIFEST_WATCH_MAX_SECONDS)
+    deadline = time.monotonic() + timeout
+    while True:
+        # Re-decided on every rollout change: admission, next wave, halt, new version
+        watch = rollout.watch_for(robot_id)
+        watch.refresh()
+        remaining = deadline - time.monotonic()
+        # Nothing synced yet: wait for the first manifest like for a change
+        if remaining <= 0 or (watch.body is not None and request.headers.get("if-none-match") != watch.etag):
+            return watch.response(request)
+        await rollout.wait_change(remaining)
+
+@app.get("/rollout")
+@app.get("/ns/{product}/{channel}/rollout")
+def rollout_status(product: str = None, channel: str = None):
+    return _ns(product, channel).rollout.status()
+
+@app.post("/rollout/halt")
+@app.post("/ns/{product}/{channel}/rollout/halt")
+async def rollout_halt(product: str = None, channel: str = None):
+    rollout = _ns(product, channel).rollout
+    async with rollout.locked():
+        rollout.halt()
+    return rollout.status()
+
+@app.post("/rollout/resume")
+@app.post("/ns/{product}/{channel}/rollout/resume")
+async def rollout_resume(product: str = None, channel: str = None):
+    rollout = _ns(product, channel).rollout
+    async with rollout.locked():
+        rollout.resume()
+    return rollout.status()
+
+@app.api_route("/artifact/{name}", methods=["GET", "HEAD"])
+@app.api_route("/ns/{product}/{channel}/artifact/{name}", methods=["GET", "HEAD"])
+async def get_artifact(name: str, request: Request, product: str = None, channel: str = None):
+    return await artifact_server.serve(request, name, _ns(product, channel).index)
+
+@app.api_route("/blobs/sha256/{digest}", methods=["GET", "HEAD"])
+async def get_blob(digest: str, request: Request):
+    def demand():
+        for ns in NAMESPACES.values():
+            ns.index.touch_digest(digest)
+
+    # Peer gateways fetching a copy are not robot demand
+    on_send = None if request.headers.get("x-gateway-peer") else demand
+    return await artifact_server.serve_blob(request, digest, blobs, on_send=on_send)
+
+@app.get("/peers")
+def peer_stats():
+    return peers.stats()
+
+@app.get("/artifact-stats")
+def artifact_stats():
+    return artifact_server.stats()
+
+@app.get("/cache-stats")
+def cache_stats():
+    out = {}
+    for key, ns in NAMESPACES.items():
+        out[key] = ns.index.stats()
+        out[key]["quota_mb"] = ns.max_mb
+    out["blobs"] = blobs.stats()
+    return out
+
+@app.get("/namespaces")
+def list_namespaces():
+    return [
+        {
+            "product": ns.product,
+            "channel": ns.channel,
+            "source": ns.source_url,
+            "version": ns.status["cached_version"],
+            "rollout": ns.rollout.status().get("state"),
+            "size_mb": round(ns.index.total_bytes / (1024 * 1024), 2),
+            "quota_mb": ns.max_mb,
+        }
+        for ns in NAMESPACES.values()
+    ]
 
 # -----------------------------
 # OTA: helpers
 # -----------------------------
-def sha256_file(path):
-    h = hashlib.sha256()
-    with open(path, "rb") as f:
-        for chunk in iter(lambda: f.read(8192), b""):
-            h.update(chunk)
-    return h.hexdigest()
-
-
-def cosign_verify_blob(artifact_path: str, bundle_path: str):
-    subprocess.check_call(
-        [
-            "cosign",
-            "verify-blob",
-            "--key",
-            COSIGN_PUB,
-            "--bundle",
-            bundle_path,
-            artifact_path,
-        ]
-    )
+async def cosign_verify_blob(artifact_path: str, bundle_path: str, artifact_sha256: str = None):
+    if artifact_sha256:
+        how = await asyncio.to_thread(already_verified, verify_cache, COSIGN_PUB, artifact_sha256, bundle_path)
+        if how:
+            name = os.path.basename(artifact_path).removesuffix(artifact_server.STAGING_SUFFIX)
+            print(f"[gateway] signature of {name} verified ({how})", flush=True)
+            return
+
+    cmd = [
+        "cosign",
+        "verify-blob",
+        "--key",
+        COSIGN_PUB,
+        "--bundle",
+        bundle_path,
+        artifact_path,
+    ]
+    started = time.perf_counter()
+    proc = await asyncio.create_subprocess_exec(*cmd)
+    rc = await proc.wait()
+    COSIGN_SECONDS.observe(time.perf_counter() - started)
+    if rc != 0:
+        raise subprocess.CalledProcessError(rc, cmd)
+    SIGNATURES_VERIFIED["cosign"].inc()
+    if artifact_sha256:
+        await asyncio.to_thread(verify_cache.record, artifact_sha256, bundle_path)
+
+
+def _status(ns):
+    st = dict(ns.status)
+    if st["state"] == "downloading" and st["total"]:
+        st["percent"] = round(100 * st["bytes"] / st["total"], 1)
+    return st
+
+@app.get("/ota/status")
+def ota_status():
+    # Default product/channel at the top level; every namespace under "namespaces"
+    st = _status(DEFAULT_NS)
+    st["namespaces"] = {key: _status(ns) for key, ns in NAMESPACES.items()}
+    return st
 
 
 # -----------------------------
-# OTA: poll + sync (central -> gateway cache)
+# OTA: poll + sync (central -> gateway cache), one loop per namespace
 # -----------------------------
-async def ota_sync_once():
-    async with httpx.AsyncClient(timeout=20) as client:
-        # 1) Fetch manifest from central
-        r = await client.get(f"{OTA_SOURCE_URL}/manifest.json")
-        r.raise_for_status()
-        manifest = r.json()
-
-        new_version = manifest["version"]
-        artifact = manifest["artifact"]
-        bundle = manifest["bundle"]
-        expected_sha = manifest["sha256"]
-
-        # 2) If cached version matches, skip
-        cached_manifest_path = os.path.join(CACHE_DIR, "manifest.json")
-        if os.path.exists(cached_manifest_path):
-            try:
-                cached = json.load(open(cached_manifest_path))
-                if cached.get("version") == new_version:
-                    return
-            except Exception:
-                pass
-
-        # 3) Download artifact + bundle (with resume)
-
-        art_path = os.path.join(CACHE_DIR, artifact)
-        bun_path = os.path.join(CACHE_DIR, bundle)
-
-        download_with_resume(
-            f"{OTA_SOURCE_URL}/{artifact}",
-            art_path,
-            timeout=60
+async def ota_sync_once(ns):
+    ns.status.update(state="watching" if ns.upstream["watch"] else "checking", last_check=time.time())
+    try:
+        await _ota_sync(ns)
+    except Exception as e:
+        ns.status.update(state="error", last_error=str(e))
+        raise
+    ns.status.update(state="idle", file=None)
+
+async def _fetch_manifest(client, ns):
+    """Central manifest, or None if it has not changed since the last sync (304)."""
+    headers = {"If-None-Match": ns.upstream["etag"]} if ns.upstream["etag"] else {}
+    if ns.upstream["watch"]:
+        r = await client.get(
+            f"{ns.source_url}/manifest/watch",
+            params={"timeout": OTA_WATCH_SECONDS},
+            headers=headers,
+            timeout=OTA_WATCH_SECONDS + 20,
         )
-
-        download_with_resume(
-            f"{OTA_SOURCE_URL}/{bundle}",
-            bun_path,
-            timeout=60
+        if not _watch_unsupported(r):
+            return _manifest_or_none(r)
+        print(f"[gateway] {ns.key}: central server has no manifest watch; polling instead", flush=True)
+        ns.upstream["watch"] = False
+    r = await client.get(f"{ns.source_url}/manifest.json", headers=headers)
+    return _manifest_or_none(r)
+
+def _watch_unsupported(r):
+    # 405, or the router's 404; "manifest not found" only means nothing is published yet
+    if r.status_code == 405:
+        return True
+    if r.status_code != 404:
+        return False
+    try:
+        body = r.json()
+    except ValueError:
+        return True
+    return not isinstance(body, dict) or body.get("detail") != "manifest not found"
+
+def _manifest_or_none(r):
+    if r.status_code == 304:
+        return None
+    r.raise_for_status()
+    return r.json(), r.headers.get("etag")
+
+async def _ota_sync(ns):
+    async with httpx.AsyncClient(timeout=20, follow_redirects=True) as client:
+        # 1) Fetch manifest from central (conditional / long-poll)
+        fetched = await _fetch_manifest(client, ns)
+        if fetched is None:
+            return
+        manifest, etag = fetched
+        ns.status.update(state="checking")
+        await _sync_manifest(client, ns, manifest)
+        ns.upstream["etag"] = etag   # only once handled, so failures are retried
+
+async def _sync_manifest(client, ns, manifest):
+    new_version = manifest["version"]
+    artifact = manifest["artifact"]
+    bundle = manifest["bundle"]
+    for name in (artifact, bundle):
+        if os.path.basename(name) != name or name.startswith("."):
+            raise ValueError(f"unsafe file name in manifest: {name!r}")
+
+    # 2) If cached version matches, skip
+    if os.path.exists(ns.manifest_path):
+        try:
+            cached = json.load(open(ns.manifest_path))
+            ns.status["cached_version"] = cached.get("version")
+            if cached.get("version") == new_version:
+                return
+        except Exception:
+            pass
+
+    # 3) Download artifact + bundle (with resume), off the event loop.
+    #    Robots asking for these files wait until they are verified.
+    ns.status.update(target_version=new_version, state="downloading")
+    paths = [os.path.join(ns.dir, artifact), os.path.join(ns.dir, bundle), blobs.path(manifest["sha256"])]
+    artifact_server.begin_sync(paths)
+    try:
+        await _download_and_verify(client, ns, manifest)
+    finally:
+        artifact_server.end_sync(paths)
+
+    # Patches from older cached versions; robots fall back to the full artifact
+    manifest.pop("deltas", None)
+    deltas = await delta.build_deltas(manifest, ns.index, blobs)
+    if deltas:
+        manifest["deltas"] = deltas
+
+    # 6) Write manifest atomically
+    previous = ns.rollout.target
+    man_tmp = ns.manifest_path + ".tmp"
+    with open(man_tmp, "w") as f:
+        json.dump(manifest, f)
+    os.replace(man_tmp, ns.manifest_path)
+    artifact_server.register_manifest(manifest, ns.dir)
+    async with ns.rollout.locked():
+        ns.rollout.begin(previous, manifest)   # also wakes robots long-polling /manifest/watch
+
+    ns.status.update(cached_version=new_version, last_update=time.time(), last_error=None)
+    print(f"[gateway] OTA cache for {ns.key} updated to version {new_version}", flush=True)
+
+async def _download_and_verify(client, ns, manifest):
+    artifact = manifest["artifact"]
+    bundle = manifest["bundle"]
+    # Fetched and verified under staging names, renamed into place only once
+    # verified: no worker can serve an unverified file
+    art_path = os.path.join(ns.dir, artifact)
+    bun_path = os.path.join(ns.dir, bundle)
+    art_tmp = artifact_server.staging_path(art_path)
+    bun_tmp = artifact_server.staging_path(bun_path)
+
+    # 4) Content already in the blob store (re-published, or promoted from
+    #    another channel) is linked instead of downloaded. Otherwise it comes
+    #    from peer gateways of the site when one holds it, else from the
+    #    central server; the checksum is computed while downloading and a
+    #    mismatch raises DownloadVerificationError and discards the file
+    sha = manifest["sha256"]
+    ns.status.update(file=artifact, bytes=0, total=manifest.get("size"))
+    if await asyncio.to_thread(blobs.link, sha, art_tmp):
+        print(f"[gateway] {ns.key}: {artifact} already cached (blob {sha[:12]}); not downloading", flush=True)
+    elif not await peers.fetch(client, sha, art_tmp, manifest.get("size"), blobs.dir, ns.download_progress):
+        await async_download_with_resume(
+            f"{ns.source_url}/{artifact}",
+            art_tmp,
+            timeout=60,
+            expected_size=manifest.get("size"),
+            expected_sha256=sha,
+            client=client,
+            on_progress=ns.download_progress,
         )
 
-        # 4) Verify checksum
-        actual_sha = sha256_file(art_path)
-        if actual_sha != expected_sha:
-            raise RuntimeError("gateway OTA sync: checksum mismatch")
-
-        # 5) Verify signature (gateway-side)
-        cosign_verify_blob(art_path, bun_path)
-
-        # 6) Write manifest atomically
-        cached_manifest_path = os.path.join(CACHE_DIR, "manifest.json")
-        man_tmp = cached_manifest_path + ".tmp"
-        with open(man_tmp, "w") as f:
-            json.dump(manifest, f)
-        os.replace(man_tmp, cached_manifest_path)
-
-        print(f"[gateway] OTA cache updated to version {new_version}", flush=True)
+    bundle_sha = manifest.get("bundle_sha256")
+    ns.status.update(file=bundle, bytes=0, total=None)
+    if not bundle_sha or not (await asyncio.to_thread(blobs.link, bundle_sha, bun_tmp)
+                              or await peers.fetch(client, bundle_sha, bun_tmp, tmp_dir=blobs.dir)):
+        bundle_sha, _ = await async_download_with_resume(
+            f"{ns.source_url}/{bundle}",
+            bun_tmp,
+            timeout=60,
+            expected_sha256=bundle_sha,
+            client=client,
+            on_progress=ns.download_progress,
+        )
 
-async def ota_poll_loop():
+    # 5) Verify signature (gateway-side)
+    ns.status.update(state="verifying", file=artifact)
+    try:
+        await cosign_verify_blob(art_tmp, bun_tmp, manifest["sha256"])
+    except subprocess.CalledProcessError:
+        os.remove(art_tmp)   # fetched again on the next attempt
+        raise
+    os.replace(bun_tmp, bun_path)
+    os.replace(art_tmp, art_path)
+    await asyncio.to_thread(blobs.adopt, art_path, sha)
+    await asyncio.to_thread(blobs.adopt, bun_path, bundle_sha)
+    ns.index.add(artifact, sha)
+    ns.index.add(bundle, bundle_sha)
+    # Every file in the served manifest is now addressable as /blobs/sha256/<digest>
+    manifest["bundle_sha256"] = bundle_sha
+    manifest["content_addressed"] = blobs.enabled
+
+def _adopt_cached(ns, manifest):
+    """Startup: put files of a cached manifest into the blob store (caches from before it existed)."""
+    files = [(manifest["artifact"], manifest.get("sha256")), (manifest["bundle"], manifest.get("bundle_sha256"))]
+    files += [(d["patch"], d["sha256"]) for d in manifest.get("deltas", [])]
+    for name, digest in files:
+        path = os.path.join(ns.dir, name)
+        if digest and os.path.exists(path):
+            blobs.adopt(path, digest)
+            ns.index.add(name, digest)
+
+async def ota_poll_loop(ns):
     while True:
         try:
-            await ota_sync_once()
+            await ota_sync_once(ns)
+            if ns.upstream["watch"]:
+                continue   # the long-poll itself paces the loop
         except Exception as e:
-            print("[gateway] OTA poll failed:", e, flush=True)
+            print(f"[gateway] OTA poll for {ns.key} failed:", e, flush=True)
         await asyncio.sleep(POLL_SECONDS)
 
 
 @app.on_event("startup")
 async def start_ota_poll():
-    asyncio.create_task(ota_poll_loop())
+    # Every worker serves the cached manifests; only the leader syncs and evicts
+    elected = leader.try_acquire()
+    if elected:
+        namespaces.migrate_legacy_layout(DEFAULT_NS)
+    for ns in NAMESPACES.values():
+        await asyncio.to_thread(ns.index.load)
+        for name in ("manifest.json", STABLE_MANIFEST):
+            cached_manifest_path = os.path.join(ns.dir, name)
+            if os.path.exists(cached_manifest_path):
+                try:
+                    manifest = json.load(open(cached_manifest_path))
+                    artifact_server.register_manifest(manifest, ns.dir)
+                    if elected:
+                        await asyncio.to_thread(_adopt_cached, ns, manifest)
+                except Exception as e:
+                    print("[gateway] could not read cached manifest:", e, flush=True)
+        ns.rollout.leader = elected
+        ns.rollout.load()
+    if elected:
+        await lead()
+    else:
+        asyncio.create_task(follow_loop())
+
+
+async def lead():
+    """Duties of the one leader process: OTA sync, rollout decisions, cache GC, peer discovery, flush."""
+    for ns in NAMESPACES.values():
+        ns.rollout.leader = True
+    artifact_server.clear_sync_markers()
+    await asyncio.to_thread(blobs.sweep)
+    peers.start()   # discover peers before the first sync needs them
+    for ns in NAMESPACES.values():
+        # Namespaces sync concurrently, each on its own loop
+        asyncio.create_task(ota_poll_loop(ns))
+    asyncio.create_task(rollout_loop())
+    asyncio.create_task(gc_loop())
+    if workers.GATEWAY_WORKERS > 1 and ROLLOUT_ENABLED:
+        asyncio.create_task(observe_loop())
+    if AUTO_FLUSH:
+        asyncio.create_task(auto_flush_loop())
+        print("[gateway] auto-flush enabled", flush=True)
 
 
-@app.on_event("startup")
-async def startup():
-    async def gc_loop():
-        while True:
+async def follow_loop():
+    """Other workers: pick up what the leader synced and decided; take over once it exits."""
+    while not leader.try_acquire():
+        for ns in NAMESPACES.values():
+            try:
+                if ns.rollout.refresh():
+                    await _follow_manifest(ns)
+            except Exception as e:
+                print(f"[gateway] following the leader for {ns.key} failed:", e, flush=True)
+        await asyncio.sleep(1)
+    print(f"[gateway] worker {SHARD + 1} (pid {os.getpid()}) took over as leader", flush=True)
+    await lead()
+
+async def _follow_manifest(ns):
+    for path in (ns.manifest_path, os.path.join(ns.dir, STABLE_MANIFEST)):
+        if os.path.exists(path):
+            artifact_server.register_manifest(json.load(open(path)), ns.dir)
+    version = (ns.rollout.target or {}).get("version")
+    if version != ns.status["cached_version"]:
+        ns.status.update(cached_version=version, last_update=time.time())
+        await asyncio.to_thread(ns.index.load)
+
+
+async def rollout_loop():
+    while True:
+        await asyncio.sleep(ROLLOUT_TICK_SECONDS)
+        for ns in NAMESPACES.values():
             try:
-                gc_cache_once()
+                async with ns.rollout.locked():
+                    ns.rollout.evaluate()
             except Exception as e:
-                print("[gateway] cache GC failed:", e, flush=True)
-            await asyncio.sleep(GC_INTERVAL)
+                print(f"[gateway] rollout evaluation for {ns.key} failed:", e, flush=True)
 
-    asyncio.create_task(gc_loop())
\ No newline at end of file
+
+async def gc_loop():
+    while True:
+        # Per-namespace quotas; off the event loop, files still being synced are left alone
+        for ns in NAMESPACES.values():
+            try:
+                await asyncio.to_thread(gc_cache_once, ns.index, ns.max_mb, ns.keep_last,
+                                        artifact_server.syncing(), blobs)
+            except Exception as e:
+                print(f"[gateway] cache GC for {ns.key} failed:", e, flush=True)
+        await asyncio.sleep(GC_INTERVAL)
+
+@app.on_event("shutdown")
+async def save_rollout_state():
+    for ns in NAMESPACES.values():
+        await ns.rollout.close()
+
+@app.on_event("shutdown")
+def save_cache_index():
+    if not leader.is_leader:
+        return   # the leader's index is the one GC works from
+    for ns in NAMESPACES.values():
+        ns.index.save()
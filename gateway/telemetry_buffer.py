@@ -0,0 +1,214 @@
+import os
+import time
+import shutil
+import asyncio
+import collections
+import samples
+
+# ---- Ingest write path ----
+INGEST_MODE = os.getenv("INGEST_MODE", "sync").lower()            # sync | buffered
+INGEST_COMMIT_MS = int(os.getenv("INGEST_COMMIT_MS", "200"))      # durability window (buffered)
+INGEST_COMMIT_ROWS = int(os.getenv("INGEST_COMMIT_ROWS", "500"))  # commit early at this many rows
+INGEST_RING_SIZE = int(os.getenv("INGEST_RING_SIZE", "50000"))    # max rows held in memory
+
+# ---- Buffer limits (disk safety while the uplink is down) ----
+BUFFER_HIGH_WATER_ROWS = int(os.getenv("BUFFER_HIGH_WATER_ROWS", "2000000"))  # full at this many rows...
+BUFFER_MIN_FREE_MB = int(os.getenv("BUFFER_MIN_FREE_MB", "256"))             # ...or this little free disk
+BUFFER_FULL_POLICY = os.getenv("BUFFER_FULL_POLICY", "reject").lower()       # reject | downsample
+BUFFER_DOWNSAMPLE_SECONDS = int(os.getenv("BUFFER_DOWNSAMPLE_SECONDS", "60"))  # keep one sample per robot per bucket
+BUFFER_DOWNSAMPLE_ROWS = int(os.getenv("BUFFER_DOWNSAMPLE_ROWS", "100000"))    # oldest rows thinned per pass
+BUFFER_LOW_WATER = 0.9   # once full, accept again below 90% of the high-water mark
+SHARED_RECOUNT_SECONDS = 0.5   # a full shard re-reads its count at most this often
+
+
+class TelemetryBuffer:
+    """
+    Front door for telemetry writes into the SQLite buffer.
+
+    sync:     every sample is committed before /metrics returns.
+    buffered: samples are appended to an in-memory ring and a single writer
+              task group-commits them with executemany every INGEST_COMMIT_MS
+              or INGEST_COMMIT_ROWS rows, whichever comes first. A crash can
+              lose at most one commit window of samples.
+
+    `count` is a running total (stored + queued), so handlers never have to
+    SELECT COUNT(*) over the whole table.
+
+    The buffer is full at `high_water` rows (BUFFER_HIGH_WATER_ROWS, split
+    between the shards of a multi-worker gateway) or when less than
+    BUFFER_MIN_FREE_MB is left on its disk; `accepting()` then turns ingest
+    away until the flush brings it under the low-water mark. With
+    BUFFER_FULL_POLICY=downsample the oldest healthy samples are thinned
+    first, so recent data keeps flowing in while older data loses resolution.
+
+    A `shared` buffer is flushed by another process (the leader of a
+    multi-worker gateway), which cannot call `removed()` here; while full it
+    re-reads its count from the table instead.
+    """
+
+    def __init__(self, db, mode=INGEST_MODE, table="samples", high_water=BUFFER_HIGH_WATER_ROWS, shared=False):
+        self._db = db
+        self.mode = mode
+        self.table = table
+        self.high_water = high_water
+        self.shared = shared
+        self._ring = collections.deque()
+        self._stored = 0
+        self._inflight = 0
+        self._lock = None
+        self._wake = None
+        self._writer = None
+        self.full = False
+        self.downsampled = 0
+        self._disk_low = False
+        self._disk_checked = 0.0
+        self._thinning = None
+        self._thin_after = 0.0
+        self._recounting = None
+        self._recounted = 0.0
+
+    @property
+    def count(self):
+        return self._stored + self._inflight + len(self._ring)
+
+    @property
+    def pending(self):
+        return self._inflight + len(self._ring)
+
+    async def start(self):
+        self._stored = await self._db.read("count", samples.count_rows, self.table)
+
+        if self.mode == "buffered":
+            self._lock = asyncio.Lock()
+            self._wake = asyncio.Event()
+            self._writer = asyncio.create_task(self._writer_loop())
+            print(
+                f"[gateway] write-behind ingest enabled ({self.table}) window={INGEST_COMMIT_MS}ms rows={INGEST_COMMIT_ROWS}",
+                flush=True,
+            )
+
+    async def stop(self):
+        if self._writer is None:
+            return
+        self._writer.cancel()
+        try:
+            await self._writer
+        except asyncio.CancelledError:
+            pass
+        self._writer = None
+        await self.commit()
+
+    async def add(self, row):
+        """Queue (or, in sync mode, commit) one encoded sample. Returns the buffered count."""
+        if self.mode != "buffered":
+            await self._db.write("ingest_insert", samples.insert_one, row, self.table)
+            self._stored += 1
+            return self.count
+
+        if len(self._ring) >= INGEST_RING_SIZE:
+            # Writer fell behind: make this request wait for a commit
+            await self.commit()
+        self._ring.append(row)
+        if len(self._ring) >= INGEST_COMMIT_ROWS:
+            self._wake.set()
+        return self.count
+
+    def removed(self, n):
+        """Account for rows deleted from the table after a flush."""
+        self._stored = max(0, self._stored - n)
+
+    async def recount(self):
+        """Re-read the stored count; another gateway worker may have flushed or added rows."""
+        if self._lock is None:
+            self._stored = await self._db.read("count", samples.count_rows, self.table)
+            return
+        async with self._lock:   # not while a group commit is in flight
+            self._stored = await self._db.read("count", samples.count_rows, self.table)
+
+    def accepting(self):
+        """False while ingest must be turned away (checked per request; the disk at most once a second)."""
+        now = time.monotonic()
+        if now - self._disk_checked >= 1:
+            self._disk_checked = now
+            try:
+                free = shutil.disk_usage(os.path.dirname(os.path.abspath(self._db.path))).free
+                self._disk_low = free < BUFFER_MIN_FREE_MB * 1024 * 1024
+            except OSError:
+                self._disk_low = False
+        limit = self.high_water * (BUFFER_LOW_WATER if self.full else 1)
+        full = self._disk_low or self.count >= limit
+        if full != self.full:
+            self.full = full
+            print(f"[gateway] telemetry buffer {'full' if full else 'accepting again'}: "
+                  f"{self.count} rows{', disk nearly full' if self._disk_low else ''}", flush=True)
+        if not full:
+            return True
+        if self.shared and self._recounting is None and now - self._recounted >= SHARED_RECOUNT_SECONDS:
+            # Rows the leader flushed from this shard show up only in the table
+            self._recounted = now
+            self._recounting = asyncio.create_task(self._recount_full())
+        if BUFFER_FULL_POLICY == "downsample" and not self._disk_low and now >= self._thin_after:
+            # Thinning makes room; reject only once the oldest rows cannot be thinned further
+            if self._thinning is None:
+                self._thinning = asyncio.create_task(self._downsample())
+            return True
+        return False
+
+    async def _recount_full(self):
+        try:
+            await self.recount()
+        except Exception as e:
+            print(f"[gateway] telemetry recount failed: {e}", flush=True)
+        finally:
+            self._recounting = None
+
+    async def _downsample(self):
+        try:
+            await self.commit()
+            n = await self._db.write("buffer_downsample", samples.downsample_oldest,
+                                     BUFFER_DOWNSAMPLE_ROWS, BUFFER_DOWNSAMPLE_SECONDS * 1000)
+            self.removed(n)
+            self.downsampled += n
+            print(f"[gateway] telemetry buffer full: thinned {n} old samples", flush=True)
+            if not n:
+                # Oldest rows are already at bucket resolution; wait for the flush
+                self._thin_after = time.monotonic() + 30
+        except Exception as e:
+            print(f"[gateway] telemetry downsampling failed: {e}", flush=True)
+        finally:
+            self._thinning = None
+
+    async def commit(self):
+        """Group-commit everything queued so far."""
+        if self.mode != "buffered":
+            return
+        async with self._lock:
+            if not self._ring:
+                return
+            batch = list(self._ring)
+            self._ring.clear()
+            self._inflight = len(batch)
+            try:
+                await self._db.write("ingest_commit", samples.insert_many, batch, self.table)
+            except Exception:
+                # Keep the samples queued (in order) for the next attempt
+                self._ring.extendleft(reversed(batch))
+                raise
+            else:
+                self._stored += len(batch)
+            finally:
+                self._inflight = 0
+
+    async def _writer_loop(self):
+        window = INGEST_COMMIT_MS / 1000
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=window)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.commit()
+            except Exception as e:
+                print(f"[gateway] telemetry commit failed: {e}", flush=True)
+                await asyncio.sleep(window)
@@ -0,0 +1,144 @@
+import os
+import re
+import time
+import fcntl
+import asyncio
+from db import Database
+from telemetry_buffer import TelemetryBuffer
+import samples
+
+# ---- Multi-process gateway ----
+# Worker processes serving the gateway port; must match `uvicorn --workers`
+# (the image starts GATEWAY_WORKERS workers, see gateway/Dockerfile)
+GATEWAY_WORKERS = max(1, int(os.getenv("GATEWAY_WORKERS", "1")))
+
+SHARD_RE = re.compile(r"^metrics(?:-(\d+))?\.db$")
+
+
+def shard_path(data_dir, index):
+    """Shard 0 keeps the single-process file name, so an existing buffer is picked up."""
+    return os.path.join(data_dir, "metrics.db" if index == 0 else f"metrics-{index}.db")
+
+
+def shard_paths(data_dir):
+    """{index: path} of every telemetry shard in data_dir, also those left by a larger worker count."""
+    out = {}
+    for name in os.listdir(data_dir):
+        m = SHARD_RE.match(name)
+        if m:
+            out[int(m.group(1) or 0)] = os.path.join(data_dir, name)
+    return out
+
+
+def _try_lock(path):
+    """fd holding an exclusive flock on `path`, or None if another process holds it."""
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+
+_held = []   # lock fds kept open for the life of the process
+
+
+def claim_shard(data_dir, workers=GATEWAY_WORKERS, wait=30):
+    """
+    Index of a free shard for this worker process, held until it exits. A
+    worker restarted by uvicorn gets the shard its predecessor released.
+    """
+    deadline = time.monotonic() + wait
+    while True:
+        for i in range(workers):
+            fd = _try_lock(os.path.join(data_dir, f".shard-{i}.lock"))
+            if fd is not None:
+                _held.append(fd)
+                return i
+        if time.monotonic() >= deadline:
+            raise RuntimeError(f"no free telemetry shard in {data_dir}: more than {workers} gateway "
+                               f"processes share it (GATEWAY_WORKERS={workers})")
+        time.sleep(0.2)
+
+
+class Leader:
+    """
+    One worker per gateway holds DATA_DIR/.leader.lock and runs the duties that
+    must not run once per worker: OTA sync, rollout decisions, cache GC, peer
+    discovery and the upstream flush. The kernel drops the lock when the holder
+    exits, and the next worker to try takes over.
+    """
+
+    def __init__(self, data_dir):
+        self.path = os.path.join(data_dir, ".leader.lock")
+        self._fd = None
+
+    @property
+    def is_leader(self):
+        return self._fd is not None
+
+    def try_acquire(self):
+        if self._fd is None:
+            self._fd = _try_lock(self.path)
+            if self._fd is not None:
+                os.ftruncate(self._fd, 0)
+                os.write(self._fd, f"{os.getpid()}\n".encode())
+        return self.is_leader
+
+
+class Shard:
+    """One worker's SQLite telemetry buffer."""
+
+    def __init__(self, index, db, telemetry, source=None):
+        self.index = index
+        self.db = db
+        self.telemetry = telemetry
+        self.source = source     # "<gateway id>/<stream id>", the central server's de-dup key
+        self.observed = None     # last row id fed to rollout decisions (leader, multi-worker)
+        self.observing = asyncio.Lock()   # held while rows after `observed` are read and fed
+        self.aggregated = None   # last raw sample id folded into windows (leader, multi-worker)
+
+
+class ShardSet:
+    """
+    This worker's shard plus, opened on first use, every other shard file in
+    DATA_DIR: the leader flushes them all, and any worker reads them all for
+    /telemetry/raw. Other shards are only read and deleted from here; their
+    owner keeps inserting, so their row counts are refreshed with `recount()`.
+    """
+
+    def __init__(self, data_dir, own, gateway_id):
+        self.data_dir = data_dir
+        self.own = own
+        self.gateway_id = gateway_id
+        self.shards = {own.index: own}
+
+    async def all(self):
+        """Shards in index order, this worker's included."""
+        for index, path in sorted(shard_paths(self.data_dir).items()):
+            if index in self.shards:
+                continue
+            db = Database(path)
+            db.start()
+            stream = await db.read("shard_stream", samples.shard_stream)
+            if stream is None:
+                db.stop()   # its worker has not created the schema yet
+                continue
+            telemetry = TelemetryBuffer(db, mode="sync")
+            await telemetry.start()
+            self.shards[index] = Shard(index, db, telemetry, f"{self.gateway_id}/{stream}")
+        return [self.shards[i] for i in sorted(self.shards)]
+
+    @property
+    def count(self):
+        return sum(s.telemetry.count for s in self.shards.values())
+
+    async def recount(self):
+        for shard in list(self.shards.values()):
+            await shard.telemetry.recount()
+
+    def close(self):
+        for shard in self.shards.values():
+            if shard is not self.own:
+                shard.db.stop()
@@ -11,12 +11,14 @@ SRC="$ROOT/ci/app"
 KEY="$ROOT/keys/cosign.key"
 #Whether to sign artifacts or not (default is true) 
 DO_SIGN="${DO_SIGN:-true}"
+# Product line the artifact belongs to (file name prefix)
+PRODUCT="${PRODUCT:-app}"
 
 mkdir -p "$OUT"
 
-ART="app-v${VER}.tar.gz"
-BUNDLE="app-v${VER}.tar.gz.bundle"
-SHA="app-v${VER}.sha256"
+ART="${PRODUCT}-v${VER}.tar.gz"
+BUNDLE="${PRODUCT}-v${VER}.tar.gz.bundle"
+SHA="${PRODUCT}-v${VER}.sha256"
 MANIFEST="manifest.json"
 
 if [[ ! -d "$SRC" ]]; then
@@ -52,13 +54,21 @@ else
   echo "[build_ota] DO_SIGN=false; skipping signing step."
 fi
 
+# Bundle digest lets gateways reuse a bundle they already hold (content-addressed cache)
+BUNDLE_SHA_LINE=""
+if [[ -f "$OUT/$BUNDLE" ]]; then
+  BUNDLE_SHA_LINE="\"bundle_sha256\": \"$(sha256sum "$OUT/$BUNDLE" | awk '{print $1}')\","
+fi
+
 # Manifest (what robot + gateway expect)
 cat > "$OUT/$MANIFEST" <<EOF
 {
   "version": "$VER",
   "artifact": "$ART",
   "bundle": "$BUNDLE",
-  "sha256": "$(cat "$OUT/$SHA")"
+  ${BUNDLE_SHA_LINE}
+  "sha256": "$(cat "$OUT/$SHA")",
+  "size": $(wc -c < "$OUT/$ART" | tr -d ' ')
 }
 EOF
 
@@ -4,6 +4,10 @@ set -euo pipefail
 ROOT="$(cd "$(dirname "${BASH_SOURCE[0]}")/.." && pwd)"
 OUT="$ROOT/ci/out"
 DEST="$ROOT/dashboard/ota"
+# Optional product/channel (e.g. OTA_NAMESPACE=mower/beta); unset = the default app line
+if [[ -n "${OTA_NAMESPACE:-}" ]]; then
+  DEST="$DEST/$OTA_NAMESPACE"
+fi
 
 if [[ ! -f "$OUT/manifest.json" ]]; then
   echo "ERROR: manifest.json not found in $OUT"
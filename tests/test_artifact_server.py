@@ -0,0 +1,77 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import artifact_server
+
+
+@pytest.fixture
+def markers(tmp_path, monkeypatch):
+    monkeypatch.setattr(artifact_server, "SYNC_MARKER_DIR", str(tmp_path / ".syncing"))
+    monkeypatch.setattr(artifact_server, "SYNC_POLL_SECONDS", 0.01)
+    return tmp_path
+
+
+def test_other_workers_wait_for_the_leaders_sync(markers):
+    path = str(markers / "app-v1.0.0.tar.gz")
+    artifact_server.begin_sync([path])
+    artifact_server._syncing.clear()   # as seen from a worker that is not syncing it
+
+    async def scenario():
+        waiting = asyncio.create_task(artifact_server._wait_synced(path))
+        await asyncio.sleep(0.05)
+        assert not waiting.done()
+        artifact_server.end_sync([path])
+        await asyncio.wait_for(waiting, 1)
+
+    asyncio.run(scenario())
+
+
+def test_sync_wait_times_out_with_503(markers, monkeypatch):
+    monkeypatch.setattr(artifact_server, "ARTIFACT_SYNC_WAIT", 0.05)
+    path = str(markers / "app-v1.0.0.tar.gz")
+    artifact_server.begin_sync([path])
+    artifact_server._syncing.clear()
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(artifact_server._wait_synced(path))
+    assert e.value.status_code == 503
+    artifact_server.clear_sync_markers()   # a new leader drops what its predecessor left
+    asyncio.run(artifact_server._wait_synced(path))
+
+
+def test_staging_files_are_never_served(markers):
+    class Index:
+        dir = str(markers)
+
+    (markers / "app-v1.0.0.tar.gz.unverified").write_bytes(b"x")
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(artifact_server.serve(None, "app-v1.0.0.tar.gz.unverified", Index()))
+    assert e.value.status_code == 404
+
+
+def test_gc_keeps_staging_files_of_syncs_in_progress(markers):
+    path = str(markers / "app-v1.0.0.tar.gz")
+    artifact_server.begin_sync([path])
+    try:
+        assert artifact_server.staging_path(path) in artifact_server.syncing()
+    finally:
+        artifact_server.end_sync([path])
+    assert artifact_server.syncing() == []
+
+
+def test_only_files_requested_again_are_memory_mapped(tmp_path, monkeypatch):
+    monkeypatch.setattr(artifact_server, "_hot", type(artifact_server._hot)())
+    monkeypatch.setattr(artifact_server, "_hits", type(artifact_server._hits)())
+    monkeypatch.setattr(artifact_server, "_hot_bytes", 0)
+    path = tmp_path / "app-v1.0.0.tar.gz"
+    path.write_bytes(b"v1" * 1000)
+    st = path.stat()
+    assert artifact_server._hot_file(str(path), st) is None   # cold: threaded reads
+    hf = artifact_server._hot_file(str(path), st)
+    assert hf is not None and hf.map[:2] == b"v1"
+    assert artifact_server._hot_file(str(path), st) is hf
+
+    path.write_bytes(b"v2" * 2000)   # replaced: cold again
+    assert artifact_server._hot_file(str(path), path.stat()) is None
+    assert str(path) not in artifact_server._hot and artifact_server._hot_bytes == 0
@@ -0,0 +1,74 @@
+import hashlib
+import json
+import os
+
+import pytest
+
+from blob_store import BlobStore
+from cache_manager import CacheIndex, gc_cache_once
+
+V1, V2 = b"app 1.0.0" * 100, b"app 1.0.1" * 100
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+@pytest.fixture
+def blobs(tmp_path):
+    return BlobStore(str(tmp_path / ".blobs" / "sha256"))
+
+
+def namespace(tmp_path, blobs, name, versions, active):
+    """A cache directory whose files were verified and adopted, with `active` in its manifest."""
+    d = tmp_path / name
+    d.mkdir()
+    index = CacheIndex(str(d))
+    for version, data in versions.items():
+        art = f"app-v{version}.tar.gz"
+        (d / art).write_bytes(data)
+        blobs.adopt(str(d / art), sha256(data))
+        index.add(art, sha256(data))
+    (d / "manifest.json").write_text(json.dumps({"version": active, "artifact": f"app-v{active}.tar.gz"}))
+    return index
+
+
+def test_adopted_copies_share_one_blob(tmp_path, blobs):
+    a = namespace(tmp_path, blobs, "a", {"1.0.0": V1}, "1.0.0")
+    b = namespace(tmp_path, blobs, "b", {"1.0.0": V1}, "1.0.0")
+    digest = sha256(V1)
+    assert blobs.refs(digest) == 2
+    assert os.path.samefile(os.path.join(a.dir, "app-v1.0.0.tar.gz"), os.path.join(b.dir, "app-v1.0.0.tar.gz"))
+    assert blobs.stats()["blobs"] == 1
+
+    assert blobs.link(digest, str(tmp_path / "linked.tar.gz"))
+    assert blobs.refs(digest) == 3
+    assert not blobs.link(sha256(b"missing"), str(tmp_path / "missing.tar.gz"))
+
+
+def test_release_deletes_only_unreferenced_blobs(tmp_path, blobs):
+    namespace(tmp_path, blobs, "a", {"1.0.0": V1, "1.0.1": V2}, "1.0.1")
+    os.remove(tmp_path / "a" / "app-v1.0.0.tar.gz")
+    assert blobs.release([sha256(V1), sha256(V2)]) == [sha256(V1)]
+    assert not blobs.has(sha256(V1)) and blobs.has(sha256(V2))
+
+
+def test_gc_frees_a_blob_once_no_namespace_keeps_it(tmp_path, blobs):
+    a = namespace(tmp_path, blobs, "a", {"1.0.0": V1, "1.0.1": V2}, "1.0.1")
+    b = namespace(tmp_path, blobs, "b", {"1.0.0": V1, "1.0.1": V2}, "1.0.1")
+
+    gc_cache_once(a, keep_last=0, blobs=blobs)
+    assert not os.path.exists(os.path.join(a.dir, "app-v1.0.0.tar.gz"))
+    assert blobs.has(sha256(V1)) and blobs.refs(sha256(V1)) == 1   # still linked from b
+
+    gc_cache_once(b, keep_last=0, blobs=blobs)
+    assert not blobs.has(sha256(V1))
+    assert blobs.refs(sha256(V2)) == 2   # the active version is kept in both
+
+
+def test_sweep_drops_orphans_and_temp_links(blobs):
+    orphan = blobs.path(sha256(b"orphan"))
+    open(orphan, "wb").write(b"orphan")
+    open(os.path.join(blobs.dir, "left.tmp"), "wb").write(b"")
+    assert blobs.sweep() == [sha256(b"orphan")]
+    assert os.listdir(blobs.dir) == []
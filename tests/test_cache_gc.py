@@ -0,0 +1,67 @@
+import json
+import os
+
+import pytest
+
+import cache_manager
+from cache_manager import STABLE_MANIFEST, CacheIndex, gc_cache_once
+
+
+def fill(d, versions, size=1024):
+    for v in versions:
+        (d / f"app-v{v}.tar.gz").write_bytes(b"a" * size)
+        (d / f"app-v{v}.tar.gz.bundle").write_bytes(b"{}")
+
+
+def publish(d, version, name="manifest.json"):
+    (d / name).write_text(json.dumps({"version": version, "artifact": f"app-v{version}.tar.gz"}))
+
+
+def cached_versions(d):
+    return sorted(n[len("app-v"):-len(".tar.gz")] for n in os.listdir(d) if n.endswith(".tar.gz"))
+
+
+@pytest.fixture
+def index(tmp_path):
+    fill(tmp_path, ["1.0.0", "1.0.1", "1.0.2", "1.0.3", "1.0.4"])
+    idx = CacheIndex(str(tmp_path))
+    idx.load()
+    return idx
+
+
+def test_index_survives_a_restart_and_reconciles_with_the_directory(tmp_path, index):
+    index.touch("app-v1.0.1.tar.gz")
+    index.save()
+    os.remove(tmp_path / "app-v1.0.0.tar.gz")          # removed behind the index's back
+    (tmp_path / "app-v2.0.0.tar.gz").write_bytes(b"b")   # and one added
+
+    again = CacheIndex(str(tmp_path))
+    again.load()
+    assert again.entries["app-v1.0.1.tar.gz"]["hits"] == 1
+    assert "app-v1.0.0.tar.gz" not in again.entries and "app-v2.0.0.tar.gz" in again.entries
+    assert again.total_bytes == sum(os.path.getsize(tmp_path / n) for n in again.entries)
+
+
+def test_gc_keeps_the_manifest_versions_and_the_newest_others(tmp_path, index):
+    publish(tmp_path, "1.0.2")
+    publish(tmp_path, "1.0.0", STABLE_MANIFEST)
+    (tmp_path / "app-v0.9.0-to-1.0.3.tar.gz.zst").write_bytes(b"p")
+    (tmp_path / "app-v1.0.4.tar.gz.part").write_bytes(b"")
+    (tmp_path / "app-v1.0.5.tar.gz.part").write_bytes(b"")   # being synced
+    index.add("app-v0.9.0-to-1.0.3.tar.gz.zst")
+
+    res = gc_cache_once(index, keep_last=3, skip=[str(tmp_path / "app-v1.0.5.tar.gz")])
+    assert cached_versions(tmp_path) == ["1.0.0", "1.0.2", "1.0.4"]   # two pinned + the newest other
+    assert "app-v1.0.1.tar.gz.bundle" in res["deleted"]
+    assert not (tmp_path / "app-v0.9.0-to-1.0.3.tar.gz.zst").exists()
+    assert not (tmp_path / "app-v1.0.4.tar.gz.part").exists()
+    assert (tmp_path / "app-v1.0.5.tar.gz.part").exists()
+    assert set(index.entries) == {n for n in os.listdir(tmp_path) if CacheIndex.describe(n)[0]}
+
+
+def test_size_cap_evicts_by_the_configured_order(tmp_path, index, monkeypatch):
+    monkeypatch.setattr(cache_manager, "CACHE_EVICTION", "lru")
+    publish(tmp_path, "1.0.4")
+    index.touch("app-v1.0.0.tar.gz")   # served recently: outlives newer versions under LRU
+    gc_cache_once(index, max_mb=2.5 * 1026 / (1024 * 1024), keep_last=10)
+    assert cached_versions(tmp_path) == ["1.0.0", "1.0.4"]
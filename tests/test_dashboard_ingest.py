@@ -0,0 +1,34 @@
+import importlib.util
+import os
+
+import pytest
+from fastapi.testclient import TestClient
+
+from conftest import ROOT
+
+
+@pytest.fixture(scope="module")
+def dashboard():
+    # Loaded by path: the gateway's server module owns the name `server`
+    spec = importlib.util.spec_from_file_location("dashboard_server", os.path.join(ROOT, "dashboard", "server.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module, TestClient(module.app)
+
+
+def test_batch_reports_malformed_rows_as_rejected(dashboard):
+    server, client = dashboard
+    before = server.STORE.total
+    headers = {"x-ingest-source": "gw/a"}
+    rows = [{"robot_id": "r1", "_seq": 1}, 7, "x", None, {"robot_id": "r1", "_seq": 2}]
+    assert client.post("/ingest/batch", json=rows, headers=headers).json() == {
+        "ok": True, "accepted": 2, "duplicates": 0, "rejected": 3, "count": before + 2}
+    res = client.post("/ingest/batch", json=[{"robot_id": "r1", "_seq": 2}, [1]], headers=headers).json()
+    assert (res["accepted"], res["duplicates"], res["rejected"]) == (1, 1, 1)
+
+
+def test_single_ingest_refuses_a_non_object(dashboard):
+    server, client = dashboard
+    before = server.STORE.total
+    assert client.post("/ingest", json=[{"robot_id": "r1"}]).status_code == 400
+    assert client.post("/ingest", json={"robot_id": "r1"}).json()["count"] == before + 1
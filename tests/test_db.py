@@ -0,0 +1,73 @@
+import asyncio
+import sqlite3
+import threading
+
+import pytest
+
+import db
+
+
+def create(conn):
+    conn.execute("CREATE TABLE IF NOT EXISTS t (v INTEGER)")
+
+
+def insert(conn, *values):
+    conn.executemany("INSERT INTO t VALUES (?)", [(v,) for v in values])
+    return threading.current_thread().name
+
+
+def insert_then_fail(conn):
+    insert(conn, 99)
+    raise RuntimeError("boom")
+
+
+def select(conn):
+    return [v for (v,) in conn.execute("SELECT v FROM t ORDER BY v")], threading.current_thread().name
+
+
+def run(path, main):
+    async def wrapper():
+        database = db.Database(path, readers=2)
+        database.start()
+        try:
+            return await main(database)
+        finally:
+            database.stop()
+    return asyncio.run(wrapper())
+
+
+def test_writes_commit_on_the_writer_thread_and_readers_see_them(tmp_path):
+    async def main(database):
+        await database.write("create", create)
+        writers = await asyncio.gather(*(database.write("insert", insert, v) for v in range(5)))
+        rows, reader = await database.read("select", select)
+        return writers, rows, reader
+
+    writers, rows, reader = run(str(tmp_path / "gw.db"), main)
+    assert set(writers) == {"sqlite-writer"}
+    assert rows == [0, 1, 2, 3, 4]
+    assert reader.startswith("sqlite-reader")
+
+
+def test_a_failing_write_rolls_back_and_raises(tmp_path):
+    async def main(database):
+        await database.write("create", create)
+        with pytest.raises(RuntimeError):
+            await database.write("insert", insert_then_fail)
+        await database.write("insert", insert, 1)   # the writer thread keeps going
+        return (await database.read("select", select))[0]
+
+    assert run(str(tmp_path / "gw.db"), main) == [1]
+    conn = sqlite3.connect(str(tmp_path / "gw.db"))
+    assert conn.execute("SELECT count(*) FROM t").fetchone() == (1,)
+
+
+def test_latency_stats_cover_every_op(tmp_path):
+    async def main(database):
+        await database.write("create", create)
+        await database.read("select", select)
+
+    run(str(tmp_path / "gw.db"), main)
+    stats = db.latency_stats(transaction=db.TRANSACTION_SECONDS)
+    assert {"create", "select", "transaction"} <= set(stats)
+    assert stats["select"]["count"] >= 1 and stats["select"]["p99_ms"] >= stats["select"]["p50_ms"]
@@ -0,0 +1,97 @@
+import pytest
+
+from dedup import SeenWindow, SeenWindows
+from tsdb import TimeSeriesStore
+
+
+def added(window, seqs):
+    return [window.add(s) for s in seqs]
+
+
+def test_in_order_delivery_only_moves_the_floor():
+    w = SeenWindow()
+    assert added(w, range(1, 101)) == [True] * 100
+    assert (w.floor, w.mask, w.settled) == (100, 0, 100)
+    assert added(w, [1, 50, 100]) == [False] * 3
+
+
+def test_out_of_order_rows_close_the_gap():
+    w = SeenWindow()
+    assert added(w, [1, 2, 5, 6, 3]) == [True] * 5
+    assert (w.floor, w.settled) == (3, 3) and w.mask
+    assert added(w, [5, 6, 3]) == [False] * 3
+    assert w.add(4)
+    assert (w.floor, w.mask, w.settled) == (6, 0, 6)
+
+
+def test_retried_chunk_is_dropped_as_duplicate():
+    w = SeenWindow()
+    first = list(range(1, 11))
+    second = list(range(11, 21))
+    assert added(w, second + first) == [True] * 20
+    assert added(w, first + second) == [False] * 20
+    assert w.floor == 20 and not w.mask
+
+
+def test_rows_passed_over_by_a_slide_are_accepted_not_lost():
+    w = SeenWindow(size=8)
+    assert added(w, [1, 3]) == [True, True]       # 2 is missing
+    assert w.add(20)                              # slides the floor past 2
+    assert w.floor > 2 and w.settled == 1
+    assert w.add(2)                               # late retry: unknown, so kept
+    assert not w.add(1)                           # below `settled`: a real duplicate
+
+
+def test_low_water_closes_gaps_that_never_fill():
+    w = SeenWindow()
+    # rows 4..9 were thinned at the gateway and will never arrive
+    assert added(w, [1, 2, 3, 10, 11]) == [True] * 5
+    assert w.floor == 3 and w.mask
+    w.settle(9)
+    assert (w.floor, w.mask, w.settled) == (11, 0, 11)
+    assert added(w, [5, 10, 11]) == [False] * 3
+    assert w.add(12)
+
+
+def test_low_water_below_the_floor_settles_a_slid_window():
+    w = SeenWindow(size=4)
+    assert added(w, [1, 10]) == [True, True]
+    assert w.settled == 1 and w.floor == 6
+    w.settle(6)
+    assert w.settled == 6
+    assert not w.add(4)
+
+
+def test_low_water_for_a_new_source_skips_ahead():
+    seen = SeenWindows()
+    seen.settle("gw/a", 1000)
+    assert not seen.add("gw/a", 999)
+    assert seen.add("gw/a", 1001)
+
+
+def test_snapshot_roundtrip_keeps_unknown_region():
+    seen = SeenWindows()
+    w = seen.sources["gw/a"] = SeenWindow(size=4)
+    added(w, [1, 10])
+    restored = SeenWindows()
+    restored.restore(seen.snapshot())
+    r = restored.sources["gw/a"]
+    assert (r.floor, r.mask, r.settled) == (w.floor, w.mask, w.settled)
+
+
+def test_old_snapshot_treats_the_floor_as_settled():
+    seen = SeenWindows()
+    seen.restore({"gw/a": [5, "2"]})
+    assert not seen.add("gw/a", 5)
+    assert not seen.add("gw/a", 7)
+    assert seen.add("gw/a", 6)
+
+
+@pytest.mark.parametrize("order", [[1, 2, 3], [3, 1, 2], [2, 3, 1]])
+def test_store_keeps_each_sample_once(order):
+    store = TimeSeriesStore(path="")
+    rows = {seq: {"robot_id": "r1", "cpu": seq, "ts": 1_700_000_000 + seq} for seq in (1, 2, 3)}
+    for _ in range(2):   # the whole flush retried
+        store.add_many([dict(rows[s], _seq=s) for s in order], "gw/a")
+    assert store.total == 3
+    assert sorted(p["cpu"] for p in store.query("r1")["r1"]) == [1, 2, 3]
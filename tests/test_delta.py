@@ -0,0 +1,95 @@
+import asyncio
+import hashlib
+import os
+import random
+import shutil
+
+import httpx
+import pytest
+
+import delta
+from cache_manager import CacheIndex
+
+pytestmark = pytest.mark.skipif(shutil.which("zstd") is None, reason="zstd not installed")
+
+V1 = random.Random(1).randbytes(200_000)
+V2 = V1[:100_000] + b"patched" + V1[100_000:]
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+@pytest.fixture
+def index(tmp_path):
+    (tmp_path / "app-v1.0.0.tar.gz").write_bytes(V1)
+    (tmp_path / "app-v1.0.1.tar.gz").write_bytes(V2)
+    idx = CacheIndex(str(tmp_path))
+    idx.load()
+    return idx
+
+
+def build(index):
+    manifest = {"version": "1.0.1", "artifact": "app-v1.0.1.tar.gz", "sha256": sha256(V2)}
+    return asyncio.run(delta.build_deltas(manifest, index))
+
+
+def test_gateway_builds_a_small_patch_from_the_older_version(index):
+    (entry,) = build(index)
+    assert entry["from"] == "1.0.0" and entry["patch"] == "app-v1.0.0-to-1.0.1.tar.gz.zst"
+    patch = open(os.path.join(index.dir, entry["patch"]), "rb").read()
+    assert entry["sha256"] == sha256(patch) and entry["size"] == len(patch) < len(V2) // 10
+    assert index.entries[entry["patch"]]["kind"] == "patch"
+
+
+def test_patches_not_much_smaller_than_the_artifact_are_dropped(index, monkeypatch):
+    monkeypatch.setattr(delta, "DELTA_MAX_RATIO", 0.0001)
+    assert build(index) == []
+    assert not os.path.exists(os.path.join(index.dir, "app-v1.0.0-to-1.0.1.tar.gz.zst"))
+
+
+@pytest.fixture
+def robot(tmp_path, monkeypatch):
+    from client import robot
+    state = tmp_path / "robot"
+    state.mkdir()
+    monkeypatch.setattr(robot, "STATE", str(state))
+    monkeypatch.setattr(robot, "current_version", lambda: "1.0.0")
+    return robot
+
+
+def try_delta(robot, index, base=V1):
+    (entry,) = build(index)
+    patch = open(os.path.join(index.dir, entry["patch"]), "rb").read()
+    if base is not None:
+        open(os.path.join(robot.STATE, "app-v1.0.0.tar.gz"), "wb").write(base)
+    m = {"version": "1.0.1", "artifact": "app-v1.0.1.tar.gz", "sha256": sha256(V2), "deltas": [entry]}
+    requests = []
+
+    def gateway(request):
+        requests.append(request.url.path)
+        return httpx.Response(200, content=patch)
+
+    async def main():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(gateway)) as client:
+            return await robot.try_delta(client, m, os.path.join(robot.STATE, m["artifact"]))
+
+    return asyncio.run(main()), requests
+
+
+def test_robot_rebuilds_the_artifact_from_its_installed_tarball(robot, index):
+    ok, requests = try_delta(robot, index)
+    assert ok and requests and all(p.endswith(".zst") for p in requests)
+    assert open(os.path.join(robot.STATE, "app-v1.0.1.tar.gz"), "rb").read() == V2
+    assert sorted(os.listdir(robot.STATE)) == ["app-v1.0.0.tar.gz", "app-v1.0.1.tar.gz"]
+
+
+def test_robot_falls_back_when_the_rebuilt_file_does_not_match(robot, index):
+    ok, _ = try_delta(robot, index, base=V1[::-1])   # installed tarball is not the patch's base
+    assert not ok
+    assert sorted(os.listdir(robot.STATE)) == ["app-v1.0.0.tar.gz"]   # patch and partial rebuild removed
+
+
+def test_robot_without_the_base_tarball_skips_the_delta(robot, index):
+    ok, requests = try_delta(robot, index, base=None)
+    assert not ok and requests == []
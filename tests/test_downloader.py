@@ -0,0 +1,110 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+
+import httpx
+import pytest
+
+from common import downloader
+
+BODY = bytes(range(256)) * 256   # 64 KiB
+DIGEST = hashlib.sha256(BODY).hexdigest()
+
+
+@pytest.fixture(autouse=True)
+def small_segments(monkeypatch):
+    monkeypatch.setattr(downloader, "DOWNLOAD_MIN_SEGMENT_BYTES", 1024)
+    monkeypatch.setattr(downloader, "DOWNLOAD_CHECKPOINT_BYTES", 1024)
+
+
+class Origin:
+    """GET-only file server like the OTA routes: 405 for HEAD, ranges when `ranges` is set."""
+
+    def __init__(self, ranges=True):
+        self.ranges = ranges
+        self.requests = []    # Range header of each GET (None for a full read)
+        self.cut = set()      # range starts answered with half their bytes, once
+
+    def __call__(self, request):
+        if request.method != "GET":
+            return httpx.Response(405)
+        rng = request.headers.get("range")
+        self.requests.append(rng)
+        if not rng or not self.ranges:
+            return httpx.Response(200, content=BODY, headers={"etag": '"v1"'})
+        start, end = re.fullmatch(r"bytes=(\d+)-(\d*)", rng).groups()
+        start, end = int(start), int(end or len(BODY) - 1)
+        body = BODY[start:end + 1]
+        if start in self.cut:
+            self.cut.discard(start)
+            body = body[:len(body) // 2]   # connection dropped mid-range
+        return httpx.Response(206, content=body, headers={
+            "content-range": f"bytes {start}-{end}/{len(BODY)}", "etag": '"v1"'})
+
+
+def download(origin, dest, segments=4, **kw):
+    async def main():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(origin)) as client:
+            return await downloader.async_download_with_resume(
+                "http://origin/ota/app.tar.gz", dest, segments=segments, client=client, **kw)
+    return asyncio.run(main())
+
+
+def test_segmented_download_probes_with_a_ranged_get(tmp_path):
+    origin = Origin()
+    dest = str(tmp_path / "app.tar.gz")
+    assert download(origin, dest, expected_sha256=DIGEST) == (DIGEST, len(BODY))
+    assert origin.requests[0] == "bytes=0-0"
+    assert sorted(origin.requests[1:]) == sorted(
+        f"bytes={s}-{s + 16383}" for s in range(0, len(BODY), 16384))
+    assert open(dest, "rb").read() == BODY
+    assert not os.path.exists(dest + ".part.json")
+
+
+def test_interrupted_segment_resumes_from_the_sidecar(tmp_path):
+    origin = Origin()
+    origin.cut.add(32768)
+    dest = str(tmp_path / "app.tar.gz")
+    with pytest.raises(RuntimeError, match="ended early"):
+        download(origin, dest)
+    plan = json.load(open(dest + ".part.json"))
+    assert [done for _, _, done in plan["segments"]] == [16384, 16384, 8192, 16384]
+
+    origin.requests.clear()
+    assert download(origin, dest, expected_sha256=DIGEST) == (DIGEST, len(BODY))
+    assert origin.requests == ["bytes=40960-49151"]   # only the missing half of one range
+    assert open(dest, "rb").read() == BODY
+
+
+def test_server_without_ranges_uses_a_single_stream(tmp_path):
+    origin = Origin(ranges=False)
+    dest = str(tmp_path / "app.tar.gz")
+    assert download(origin, dest, expected_sha256=DIGEST) == (DIGEST, len(BODY))
+    assert origin.requests == ["bytes=0-0", None]
+
+
+def test_resumed_stream_hashes_the_prefix_already_on_disk(tmp_path):
+    origin = Origin()
+    dest = str(tmp_path / "app.tar.gz")
+    open(dest + ".part", "wb").write(BODY[:10000])
+    assert download(origin, dest, segments=1, expected_sha256=DIGEST) == (DIGEST, len(BODY))
+    assert origin.requests == ["bytes=10000-"]
+    assert open(dest, "rb").read() == BODY
+
+
+@pytest.mark.parametrize("segments", [1, 4])
+def test_digest_mismatch_discards_the_download(tmp_path, segments):
+    dest = str(tmp_path / "app.tar.gz")
+    with pytest.raises(downloader.DownloadVerificationError, match="sha256 mismatch"):
+        download(Origin(), dest, segments=segments, expected_sha256="0" * 64)
+    assert os.listdir(tmp_path) == []
+
+
+def test_size_mismatch_is_refused_before_the_transfer(tmp_path):
+    origin = Origin()
+    dest = str(tmp_path / "app.tar.gz")
+    with pytest.raises(downloader.DownloadVerificationError, match="size mismatch"):
+        download(origin, dest, expected_size=len(BODY) - 1)
+    assert origin.requests == ["bytes=0-0"]
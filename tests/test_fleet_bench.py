@@ -0,0 +1,25 @@
+import json
+import os
+import subprocess
+import sys
+
+from conftest import ROOT, SERVICE_ENV
+
+
+def test_small_fleet_run_reports_every_section(tmp_path):
+    out = tmp_path / "report.json"
+    env = {k: v for k, v in os.environ.items() if k not in SERVICE_ENV}   # the bench sets up its own gateway
+    subprocess.run(
+        [sys.executable, os.path.join(ROOT, "bench", "fleet_bench.py"), "--robots", "5", "--duration", "1",
+         "--ramp", "0.2", "--spread", "0.5", "--artifact-mb", "0.25", "--fanout-timeout", "30",
+         "--drain-timeout", "30", "--gateway-log", str(tmp_path / "gateway.log"), "--out", str(out)],
+        env=env, check=True, capture_output=True, timeout=120,
+    )
+    report = json.loads(out.read_text())
+    assert report["errors"] == {}
+    assert report["ingest"]["requests"] > 0 and report["ingest"]["gateway_p99_ms"] is not None
+    assert report["flush"]["rows_received"] == report["ingest"]["requests"]
+    assert report["ota"]["gateway_sync_seconds"] is not None
+    assert report["ota"]["robots_updated"] == 5
+    assert report["ota"]["served_mb"] >= 5 * 0.25 - 0.05
+    assert report["gateway"]["rss_peak_mb"] > 0
@@ -0,0 +1,69 @@
+import pytest
+
+import forwarder
+from forwarder import FlushPacer
+
+
+@pytest.fixture
+def pacer(monkeypatch):
+    monkeypatch.setattr(forwarder, "FLUSH_BATCH_SIZE", 100)
+    monkeypatch.setattr(forwarder, "FLUSH_BATCH_MAX", 800)
+    monkeypatch.setattr(forwarder, "FLUSH_MAX_INFLIGHT", 3)
+    monkeypatch.setattr(forwarder, "FLUSH_INTERVAL_SECONDS", 5)
+    monkeypatch.setattr(forwarder, "FLUSH_TARGET_SECONDS", 2)
+    monkeypatch.setattr(forwarder, "FLUSH_BACKOFF_MAX_SECONDS", 40)
+    return FlushPacer()
+
+
+def flushed(pacer, ok=True, slowest=0.1, full=True, **extra):
+    batch = pacer.batch
+    res = {"ok": ok, "sent": batch if ok else 0, "selected": batch if full else batch // 2,
+           "seconds": 0.5, "slowest": slowest, **extra}
+    return pacer.update(res, batch)
+
+
+def test_backlog_grows_batch_and_inflight_up_to_their_caps(pacer):
+    delays = [flushed(pacer) for _ in range(5)]
+    assert delays == [0] * 5
+    assert (pacer.batch, pacer.inflight) == (800, 3)
+
+
+def test_caught_up_returns_to_the_interval_and_keeps_the_size(pacer):
+    flushed(pacer)
+    assert flushed(pacer, full=False) == 5
+    assert (pacer.batch, pacer.inflight) == (200, 2)
+
+
+def test_slow_flush_halves_but_not_below_the_minimum(pacer):
+    for _ in range(3):
+        flushed(pacer)
+    assert (pacer.batch, pacer.inflight) == (800, 3)
+    assert flushed(pacer, slowest=3) == 0
+    assert (pacer.batch, pacer.inflight) == (400, 1)
+    for _ in range(5):
+        flushed(pacer, slowest=3)
+    assert (pacer.batch, pacer.inflight) == (100, 1)
+
+
+def test_failures_back_off_exponentially_with_jitter(pacer, monkeypatch):
+    monkeypatch.setattr(forwarder.random, "uniform", lambda lo, hi: hi)
+    flushed(pacer)
+    assert [flushed(pacer, ok=False) for _ in range(5)] == [5, 10, 20, 40, 40]
+    assert (pacer.batch, pacer.inflight) == (100, 1)
+    flushed(pacer)   # one success resets the backoff
+    assert pacer.backoff == 5
+
+
+def test_failure_waits_at_least_retry_after(pacer, monkeypatch):
+    monkeypatch.setattr(forwarder.random, "uniform", lambda lo, hi: lo)
+    assert flushed(pacer, ok=False, retry_after=30) == 30
+    assert flushed(pacer, ok=False, retry_after=None) == 2.5
+
+
+def test_rate_is_an_ewma_of_delivered_rows(pacer):
+    pacer.update({"ok": True, "sent": 100, "selected": 100, "seconds": 1, "slowest": 0.1}, 100)
+    assert pacer.rate == 100
+    pacer.update({"ok": True, "sent": 600, "selected": 200, "seconds": 1, "slowest": 0.1}, 200)
+    assert pacer.rate == pytest.approx(200)
+    pacer.update({"ok": True, "sent": 0, "selected": 0, "seconds": 0}, 400)
+    assert pacer.rate == pytest.approx(200)
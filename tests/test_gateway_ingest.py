@@ -0,0 +1,59 @@
+import pytest
+
+
+@pytest.mark.parametrize("body", [
+    b'{"robot_id": "r1", "cpu": NaN}',
+    b'{"robot_id": "r1", "mem": Infinity}',
+    b'{"robot_id": "r1", "cpu": 1e999}',
+    b'{"robot_id": "r1", "extra": {"temp": -Infinity}}',
+])
+def test_non_finite_samples_are_refused_and_the_buffer_still_flushes(gateway, upstream, body):
+    _, client = gateway
+    r = client.post("/metrics", content=body, headers={"Content-Type": "application/json"})
+    assert r.status_code == 422
+    assert client.post("/metrics", json={"robot_id": "r1", "cpu": 3.5}).status_code == 200
+
+    res = client.post("/flush").json()
+    assert res["ok"] and res["sent"] == 1 and res["remaining"] == 0
+    assert '"cpu":3.5' in upstream[-1]
+
+
+def test_db_stats_come_from_the_prometheus_histograms(gateway):
+    server, client = gateway
+    before = client.get("/db/stats").json().get("http_metrics", {}).get("count", 0)
+    assert client.post("/metrics", json={"robot_id": "r1", "cpu": 1}).status_code == 200
+    stats = client.get("/db/stats").json()
+    assert stats["http_metrics"]["count"] == before + 1 == sum(server.INGEST_SECONDS.counts)
+    assert 0 < stats["http_metrics"]["p50_ms"] <= stats["http_metrics"]["p99_ms"]
+    assert stats["init"]["count"] >= 1
+
+
+@pytest.mark.parametrize("rollout_enabled", [False, True])
+@pytest.mark.parametrize("body", [[1, 2], "x", {"robot_id": 123}, {"robot_id": "r1", "failed_versions": 7}])
+def test_samples_of_any_shape_are_stored(gateway, upstream, monkeypatch, rollout_enabled, body):
+    server, client = gateway
+    monkeypatch.setattr(server, "ROLLOUT_ENABLED", rollout_enabled)
+    client.post("/flush")
+    assert client.post("/metrics", json=body).status_code == 200
+
+    res = client.post("/flush").json()
+    assert res["ok"] and res["sent"] == 1
+
+
+def test_concurrent_observers_feed_each_sample_once(gateway, upstream, monkeypatch):
+    import asyncio
+    import workers
+    server, client = gateway
+    client.post("/flush")
+    for i in range(3):
+        client.post("/metrics", json={"robot_id": f"r{i}", "version": "1.0.0", "healthy": True})
+    seen = []
+    monkeypatch.setattr(server.DEFAULT_NS.rollout, "observe", seen.append)
+    shard = workers.Shard(0, server.db, server.telemetry)
+    shard.observed = 0
+
+    async def both():   # the flush and observe_loop() on the leader
+        await asyncio.gather(server._observe(shard), server._observe(shard))
+
+    asyncio.run(both())
+    assert sorted(d["robot_id"] for d in seen) == ["r0", "r1", "r2"]
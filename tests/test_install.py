@@ -0,0 +1,86 @@
+import hashlib
+import io
+import os
+import subprocess
+import tarfile
+
+import pytest
+
+
+def tarball(path, files):
+    with tarfile.open(path, "w:gz") as t:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mode = 0o755
+            t.addfile(info, io.BytesIO(data))
+    return str(path), hashlib.sha256(open(path, "rb").read()).hexdigest()
+
+
+def app(version, exit_code=0):
+    return {"version.txt": version.encode(), "app.sh": f"exit {exit_code}\n".encode()}
+
+
+@pytest.fixture
+def robot(tmp_path, monkeypatch):
+    from client import robot
+    state = tmp_path / "state"
+    monkeypatch.setattr(robot, "STATE", str(state))
+    for name in ("CUR", "NEW", "OLD"):
+        monkeypatch.setattr(robot, name, str(state / name.lower()))
+    monkeypatch.setattr(robot, "FAILED_VERSIONS", set())
+    os.makedirs(robot.CUR)
+    open(os.path.join(robot.CUR, "version.txt"), "w").write("1.0.0")
+    return robot
+
+
+def installed(robot):
+    return open(os.path.join(robot.CUR, "version.txt")).read()
+
+
+def test_stage_hashes_the_whole_file_while_extracting(robot, tmp_path):
+    path, digest = tarball(tmp_path / "app.tar.gz", app("1.0.1"))
+    assert robot.stage_tarball(path, digest) == digest
+    assert open(os.path.join(robot.NEW, "version.txt")).read() == "1.0.1"
+
+    with pytest.raises(RuntimeError, match="checksum mismatch"):
+        robot.stage_tarball(path, "0" * 64)
+    assert not os.path.exists(robot.NEW)
+
+
+def test_stage_refuses_members_outside_the_staging_dir(robot, tmp_path):
+    path, digest = tarball(tmp_path / "evil.tar.gz", {"../escaped": b"x"})
+    with pytest.raises(tarfile.TarError):
+        robot.stage_tarball(path, digest)
+    assert not os.path.exists(tmp_path / "state" / "escaped")
+
+
+def test_install_activates_after_staging_and_verification(robot, tmp_path, monkeypatch):
+    verified = []
+    monkeypatch.setattr(robot, "verify_blob", lambda *args: verified.append(args))
+    path, digest = tarball(tmp_path / "app.tar.gz", app("1.0.1"))
+    timings = {}
+    robot.install_tarball(path, "app.bundle", digest, timings, "1.0.1")
+    assert verified == [(path, "app.bundle", digest)]
+    assert installed(robot) == "1.0.1"
+    assert open(os.path.join(robot.OLD, "version.txt")).read() == "1.0.0"
+    assert {"stage", "verify", "extract", "activate", "self_test"} <= set(timings)
+
+
+def test_bad_signature_leaves_the_current_version_alone(robot, tmp_path, monkeypatch):
+    def reject(*args):
+        raise subprocess.CalledProcessError(1, "cosign")
+    monkeypatch.setattr(robot, "verify_blob", reject)
+    path, digest = tarball(tmp_path / "app.tar.gz", app("1.0.1"))
+    with pytest.raises(subprocess.CalledProcessError):
+        robot.install_tarball(path, "app.bundle", digest)
+    assert installed(robot) == "1.0.0"
+    assert not os.path.exists(robot.NEW) and not os.path.exists(robot.OLD)
+
+
+def test_failed_self_test_rolls_back(robot, tmp_path):
+    path, digest = tarball(tmp_path / "app.tar.gz", app("1.0.1", exit_code=1))
+    with pytest.raises(RuntimeError, match="rolled back"):
+        robot.install_tarball(path, expected_sha256=digest, version="1.0.1")
+    assert installed(robot) == "1.0.0"
+    assert robot.FAILED_VERSIONS == {"1.0.1"}
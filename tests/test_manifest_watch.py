@@ -0,0 +1,53 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+from fastapi import HTTPException
+
+from common.manifest_watch import ManifestWatch
+
+
+class _Request:
+    def __init__(self, etag=None):
+        self.headers = {"if-none-match": etag} if etag else {}
+
+
+def test_watch_waits_for_the_first_manifest(tmp_path):
+    path = tmp_path / "manifest.json"
+    watch = ManifestWatch(str(path))
+
+    async def scenario():
+        pending = asyncio.create_task(watch.watch(_Request(), timeout=5))
+        await asyncio.sleep(0.05)
+        assert not pending.done()
+        path.write_text(json.dumps({"version": "1.0.0"}))
+        watch.refresh()
+        return await asyncio.wait_for(pending, 1)
+
+    r = asyncio.run(scenario())
+    assert r.status_code == 200
+    assert json.loads(r.body)["version"] == "1.0.0"
+
+
+def test_watch_without_manifest_times_out_with_not_found(tmp_path):
+    watch = ManifestWatch(str(tmp_path / "manifest.json"))
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(watch.watch(_Request(), timeout=0.05))
+    assert e.value.status_code == 404
+    assert e.value.detail == "manifest not found"
+
+
+@pytest.mark.parametrize("status, body, unsupported", [
+    (405, {"detail": "Method Not Allowed"}, True),
+    (404, {"detail": "Not Found"}, True),             # no such route
+    (404, {"detail": "manifest not found"}, False),   # watch exists, nothing published yet
+    (200, {"version": "1.0.0"}, False),
+    (304, None, False),
+])
+def test_watch_fallback_only_for_missing_endpoint(status, body, unsupported):
+    import server
+    from client import robot
+    r = httpx.Response(status, json=body) if body is not None else httpx.Response(status)
+    assert server._watch_unsupported(r) is unsupported
+    assert robot.watch_unsupported(r) is unsupported
@@ -0,0 +1,55 @@
+import os
+
+import pytest
+
+import namespaces
+
+
+@pytest.fixture
+def dirs(tmp_path, monkeypatch):
+    monkeypatch.setattr(namespaces, "CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(namespaces, "DATA_DIR", str(tmp_path / "data"))
+    monkeypatch.setattr(namespaces, "OTA_SOURCE_URL", "http://central/ota")
+    monkeypatch.setattr(namespaces, "OTA_SUBSCRIPTIONS", [])
+    monkeypatch.setattr(namespaces, "OTA_SOURCES", {})
+    monkeypatch.setattr(namespaces, "CACHE_QUOTAS", {})
+    os.makedirs(tmp_path / "cache")
+    os.makedirs(tmp_path / "data")
+    return tmp_path
+
+
+def test_default_is_the_legacy_single_line(dirs):
+    (ns,) = namespaces.load(watch=True).values()
+    assert (ns.key, ns.source_url) == ("app/stable", "http://central/ota")
+    assert ns.dir == str(dirs / "cache" / "app" / "stable") and os.path.isdir(ns.dir)
+
+
+def test_subscriptions_get_their_own_directory_source_and_quota(dirs, monkeypatch):
+    monkeypatch.setattr(namespaces, "OTA_SUBSCRIPTIONS", ["app/stable", "app/beta", "arm/stable"])
+    monkeypatch.setattr(namespaces, "OTA_SOURCES", {"arm/stable": "http://arm-central/ota/"})
+    monkeypatch.setattr(namespaces, "CACHE_QUOTAS", {"app/beta": "50"})
+    loaded = namespaces.load(watch=False)
+    assert list(loaded) == ["app/stable", "app/beta", "arm/stable"]   # the first one is the default
+    assert loaded["app/beta"].source_url == "http://central/ota/app/beta"
+    assert loaded["arm/stable"].source_url == "http://arm-central/ota"
+    assert loaded["app/beta"].max_mb == 50
+    assert loaded["app/beta"].rollout.state_path == str(dirs / "data" / "rollout-app-beta.json")
+
+
+@pytest.mark.parametrize("key", ["app", "app/", "../x/stable", "app/sta ble"])
+def test_bad_subscriptions_are_refused(dirs, monkeypatch, key):
+    monkeypatch.setattr(namespaces, "OTA_SUBSCRIPTIONS", [key])
+    with pytest.raises(ValueError):
+        namespaces.load(watch=True)
+
+
+def test_legacy_cache_moves_into_the_default_namespace(dirs):
+    cache = dirs / "cache"
+    for name in ("manifest.json", "app-v1.0.0.tar.gz", "app-v1.0.0.tar.gz.bundle", "notes.txt"):
+        (cache / name).write_text(name)
+    (dirs / "data" / "rollout.json").write_text("{}")
+    (ns,) = namespaces.load(watch=True).values()
+    namespaces.migrate_legacy_layout(ns)
+    assert sorted(os.listdir(ns.dir)) == ["app-v1.0.0.tar.gz", "app-v1.0.0.tar.gz.bundle", "manifest.json"]
+    assert (cache / "notes.txt").exists()
+    assert os.path.exists(ns.rollout.state_path)
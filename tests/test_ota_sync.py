@@ -0,0 +1,84 @@
+import asyncio
+import hashlib
+import os
+import subprocess
+import threading
+import time
+
+import httpx
+import pytest
+
+
+def release(version):
+    artifact, bundle = f"app-v{version}.tar.gz", f"app-v{version}.tar.gz.bundle"
+    files = {artifact: version.encode() * 4096, bundle: b'{"bundle": "%s"}' % version.encode()}
+    manifest = {"version": version, "artifact": artifact, "bundle": bundle,
+                "sha256": hashlib.sha256(files[artifact]).hexdigest(), "size": len(files[artifact])}
+    return manifest, files
+
+
+def start_sync(gateway, manifest, files):
+    """Run _sync_manifest on the app's event loop against a stand-in central server."""
+    server, client = gateway
+
+    def central(request):
+        return httpx.Response(200, content=files[request.url.path.rsplit("/", 1)[-1]])
+
+    async def main():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(central)) as central_client:
+            await server._sync_manifest(central_client, server.DEFAULT_NS, manifest)
+
+    return client.portal.start_task_soon(main)
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_gateway_keeps_serving_while_a_sync_verifies(gateway, upstream, monkeypatch):
+    server, client = gateway
+    manifest, files = release("2.0.0")
+    checked, verified = [], threading.Event()
+
+    async def cosign_verify_blob(artifact_path, bundle_path, artifact_sha256=None):
+        checked.append(os.path.basename(artifact_path))
+        while not verified.is_set():   # a slow cosign run
+            await asyncio.sleep(0.01)
+
+    monkeypatch.setattr(server, "cosign_verify_blob", cosign_verify_blob)
+    client.post("/flush")
+    sync = start_sync(gateway, manifest, files)
+    try:
+        wait_for(lambda: client.get("/ota/status").json()["state"] == "verifying")
+        assert client.post("/metrics", json={"robot_id": "r1"}).status_code == 200
+        assert client.post("/flush").json()["sent"] == 1
+    finally:
+        verified.set()
+    sync.result(timeout=5)
+
+    assert checked == ["app-v2.0.0.tar.gz.unverified"]   # verified before it is renamed into place
+    assert client.get("/ota/status").json()["cached_version"] == "2.0.0"
+    assert client.get("/manifest").json()["version"] == "2.0.0"
+    assert client.get("/artifact/app-v2.0.0.tar.gz").content == files["app-v2.0.0.tar.gz"]
+
+
+def test_bad_signature_publishes_nothing(gateway, monkeypatch):
+    server, client = gateway
+    manifest, files = release("2.0.1")
+    before = client.get("/ota/status").json()["cached_version"]
+
+    async def cosign_verify_blob(artifact_path, bundle_path, artifact_sha256=None):
+        raise subprocess.CalledProcessError(1, "cosign")
+
+    monkeypatch.setattr(server, "cosign_verify_blob", cosign_verify_blob)
+    with pytest.raises(subprocess.CalledProcessError):
+        start_sync(gateway, manifest, files).result(timeout=5)
+
+    art_path = os.path.join(server.DEFAULT_NS.dir, "app-v2.0.1.tar.gz")
+    assert not os.path.exists(art_path) and not os.path.exists(art_path + ".unverified")
+    assert client.get("/ota/status").json()["cached_version"] == before
+    assert server.artifact_server.syncing() == []
+    assert client.get("/artifact/app-v2.0.1.tar.gz").status_code == 404
@@ -0,0 +1,68 @@
+import asyncio
+import hashlib
+import os
+import re
+
+import httpx
+import pytest
+
+import peers
+
+BLOB = bytes(range(256)) * 64   # 16 KiB
+DIGEST = hashlib.sha256(BLOB).hexdigest()
+
+
+@pytest.fixture(autouse=True)
+def site(monkeypatch):
+    monkeypatch.setattr(peers, "GATEWAY_PEERS", ["http://gw2", "http://gw3"])
+    monkeypatch.setattr(peers, "_discovered", {})
+    monkeypatch.setattr(peers, "PEER_MIN_SEGMENT_BYTES", 1024)
+
+
+def peer_site(holds, broken=(), body=BLOB):
+    """Mock transport for the peers: `holds` have the blob, `broken` drop every range request."""
+    ranges = []
+
+    def handler(request):
+        host = request.url.host
+        if host not in holds:
+            return httpx.Response(404)
+        if request.method == "HEAD":
+            return httpx.Response(200, headers={"content-length": str(len(body))})
+        if host in broken:
+            return httpx.Response(500)
+        start, end = map(int, re.fullmatch(r"bytes=(\d+)-(\d+)", request.headers["range"]).groups())
+        ranges.append((host, start))
+        return httpx.Response(206, content=body[start:end + 1])
+
+    return httpx.MockTransport(handler), ranges
+
+
+def fetch(transport, dest):
+    async def main():
+        async with httpx.AsyncClient(transport=transport) as client:
+            return await peers.fetch(client, DIGEST, str(dest))
+    return asyncio.run(main())
+
+
+def test_blob_is_pulled_in_ranges_from_every_holder(tmp_path):
+    transport, ranges = peer_site({"gw2", "gw3"})
+    assert fetch(transport, tmp_path / DIGEST)
+    assert (tmp_path / DIGEST).read_bytes() == BLOB
+    assert {host for host, _ in ranges} == {"gw2", "gw3"}
+    assert sorted(start for _, start in ranges) == list(range(0, len(BLOB), 4096))
+
+
+def test_ranges_of_a_failing_peer_go_to_the_others(tmp_path):
+    transport, ranges = peer_site({"gw2", "gw3"}, broken={"gw3"})
+    assert fetch(transport, tmp_path / DIGEST)
+    assert (tmp_path / DIGEST).read_bytes() == BLOB
+    assert {host for host, _ in ranges} == {"gw2"}
+
+
+def test_bad_copy_or_no_holder_leaves_nothing_behind(tmp_path):
+    transport, _ = peer_site({"gw2"}, body=BLOB[::-1])
+    assert not fetch(transport, tmp_path / DIGEST)
+    transport, _ = peer_site(set())
+    assert not fetch(transport, tmp_path / DIGEST)
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,17 @@
+from common.prom import Histogram
+
+
+def test_quantile_interpolates_within_the_bucket():
+    h = Histogram("t_seconds", "", {}, (1, 2, 4))
+    assert h.quantile(0.5) is None
+    for v in (0.5, 1.5, 1.5, 3):
+        h.observe(v)
+    assert h.quantile(0.25) == 1
+    assert h.quantile(0.5) == 1.5
+    assert h.quantile(1.0) == 4
+
+
+def test_quantile_above_every_bound_is_the_highest_bound():
+    h = Histogram("t_seconds", "", {}, (1, 2))
+    h.observe(10)
+    assert h.quantile(0.99) == 2
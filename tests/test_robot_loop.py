@@ -0,0 +1,66 @@
+import asyncio
+
+import httpx
+import pytest
+
+from client import robot
+
+
+def run_schedule(monkeypatch, outcomes, interval=10):
+    """Drive run_every through `outcomes` (None = success, else raised); returns the sleeps it asked for."""
+    sleeps, real_sleep = [], asyncio.sleep
+    outcomes = list(outcomes)
+
+    async def sleep(seconds):
+        sleeps.append(seconds)
+        if len(sleeps) > len(outcomes):
+            raise asyncio.CancelledError
+        await real_sleep(0)
+
+    async def fn():
+        outcome = outcomes[len(sleeps) - 1]
+        if outcome is not None:
+            raise outcome
+
+    monkeypatch.setattr(robot.asyncio, "sleep", sleep)
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(robot.run_every("test", interval, fn))
+    return sleeps
+
+
+def test_schedule_jitters_backs_off_and_honors_retry_after(monkeypatch):
+    monkeypatch.setattr(robot, "POLL_JITTER", 0.2)
+    start, ok, fail1, fail2, busy, ok_again, fail3 = run_schedule(
+        monkeypatch, [None, RuntimeError(), RuntimeError(), robot.RetryLater(30), None, RuntimeError()])
+    assert 0 <= start <= 10                      # robots started together spread out
+    assert 8 <= ok <= 12 and 8 <= ok_again <= 12
+    assert 1 <= fail1 <= 2 and 1 <= fail2 <= 4   # exponential, full jitter
+    assert 24 <= busy <= 36                      # at least what the gateway asked for
+    assert 1 <= fail3 <= 2                       # a success resets the backoff
+
+
+def test_retry_after_is_read_from_429_only():
+    assert robot.raise_for_retry_after(httpx.Response(200)) is None
+    with pytest.raises(robot.RetryLater) as e:
+        robot.raise_for_retry_after(httpx.Response(429, headers={"retry-after": "7"}))
+    assert e.value.seconds == 7
+    with pytest.raises(robot.RetryLater) as e:
+        robot.raise_for_retry_after(httpx.Response(429))
+    assert e.value.seconds == robot.BACKOFF_MAX_SECONDS
+
+
+def test_health_check_runs_the_self_test_unless_installing(tmp_path, monkeypatch):
+    monkeypatch.setattr(robot, "CUR", str(tmp_path))
+    monkeypatch.setitem(robot.AGENT, "healthy", True)
+    (tmp_path / "app.sh").write_text("exit 1\n")
+
+    monkeypatch.setitem(robot.AGENT, "installing", True)
+    asyncio.run(robot.health_once(None))
+    assert robot.AGENT["healthy"]                # the install runs its own self-test
+
+    monkeypatch.setitem(robot.AGENT, "installing", False)
+    asyncio.run(robot.health_once(None))
+    assert not robot.AGENT["healthy"]
+    (tmp_path / "app.sh").write_text("exit 0\n")
+    asyncio.run(robot.health_once(None))
+    assert robot.AGENT["healthy"]
@@ -0,0 +1,143 @@
+import asyncio
+import json
+
+import pytest
+
+import rollout
+from cache_manager import STABLE_MANIFEST
+
+ROBOTS = [f"r{i:02d}" for i in range(20)]
+
+
+@pytest.fixture
+def ro(tmp_path, monkeypatch):
+    monkeypatch.setattr(rollout, "ROLLOUT_ENABLED", True)
+    monkeypatch.setattr(rollout, "ROLLOUT_WAVES", [10, 50, 100])
+    monkeypatch.setattr(rollout, "ROLLOUT_MAX_INSTALLING", 5)
+    monkeypatch.setattr(rollout, "ROLLOUT_SOAK_SECONDS", 0)
+    (tmp_path / STABLE_MANIFEST).write_text(json.dumps({"version": "1.0.0"}))
+    (tmp_path / "manifest.json").write_text(json.dumps({"version": "1.0.1"}))
+    r = rollout.Rollout(str(tmp_path), str(tmp_path / "rollout.json"))
+    r.load()
+    for rid in ROBOTS:
+        r.observe({"robot_id": rid, "version": "1.0.0", "healthy": True})
+    return r
+
+
+def admitted(r):
+    return [rid for rid in ROBOTS if r.watch_for(rid) is r.target_watch]
+
+
+def canaries(n):
+    return sorted(ROBOTS, key=rollout._rank_key)[:n]
+
+
+def report(r, robots, **sample):
+    for rid in robots:
+        r.observe({"robot_id": rid, **sample})
+
+
+def test_first_wave_admits_the_lowest_ranked_robots(ro):
+    assert sorted(admitted(ro)) == sorted(canaries(2))   # 10% of 20
+    assert sorted(admitted(ro)) == sorted(canaries(2))   # stable across requests
+    assert ro.status()["installing"] == sorted(canaries(2))
+
+
+def test_wave_advances_after_its_robots_succeed(ro):
+    first = admitted(ro)
+    report(ro, first, version="1.0.1", healthy=True)
+    ro.evaluate()   # soak (0s) passed
+    assert ro.state["wave"] == 1
+    # The wave's 10 robots, but at most ROLLOUT_MAX_INSTALLING at once
+    now = admitted(ro)
+    assert len(now) == 7 and set(first) < set(now) <= set(canaries(10))
+    assert len(ro.status()["installing"]) == 5
+
+
+def test_last_wave_makes_the_target_stable(ro, tmp_path):
+    for _ in range(10):
+        report(ro, admitted(ro), version="1.0.1", healthy=True)
+        ro.evaluate()
+        if ro.state["done"]:
+            break
+    assert ro.status()["state"] == "done"
+    assert json.loads((tmp_path / STABLE_MANIFEST).read_text())["version"] == "1.0.1"
+
+
+def test_failures_halt_and_roll_back(ro):
+    first = admitted(ro)
+    report(ro, first[:1], version="1.0.1", healthy=False)
+    assert ro.state["halted"]
+    assert ro.watch_for(first[0]) is ro.stable_watch
+    # halted: nobody new is admitted
+    assert admitted(ro) == first[1:]
+
+
+def test_resume_forgives_earlier_failures(ro):
+    first = admitted(ro)
+    report(ro, first[:1], version="1.0.1", healthy=False)
+    ro.resume()
+    report(ro, first[1:], version="1.0.1", healthy=True)
+    ro.evaluate()
+    assert ro.state["halted"] is None and ro.state["wave"] == 1
+
+
+def test_stuck_install_times_out(ro, monkeypatch):
+    first = admitted(ro)
+    monkeypatch.setattr(rollout, "ROLLOUT_INSTALL_TIMEOUT", -1)
+    ro.evaluate()
+    assert set(ro.state["failed"]) == set(first)
+    assert all(reason == "timeout" for reason in ro.state["failed"].values())
+
+
+def test_new_robots_join_the_wave_order(ro):
+    ro.observe({"robot_id": "zz", "version": "1.0.0", "healthy": True})
+    assert ro._ranked == sorted((rollout._rank_key(rid), rid) for rid in ROBOTS + ["zz"])
+
+
+def test_disabled_offers_the_target_to_everyone(ro, monkeypatch):
+    monkeypatch.setattr(rollout, "ROLLOUT_ENABLED", False)
+    ro.begin({"version": "1.0.1"}, {"version": "1.0.2"})
+    assert ro.state["done"]
+    assert admitted(ro) == ROBOTS
+
+
+def test_state_is_written_off_the_loop_and_coalesced(ro, tmp_path, monkeypatch):
+    writes = []
+    write_text = rollout._write_text
+    monkeypatch.setattr(rollout, "_write_text", lambda path, text: (writes.append(text), write_text(path, text)))
+
+    async def scenario():
+        admitted(ro)   # two admissions, two _save() calls
+        ro.halt("test")
+        await ro.close()
+
+    asyncio.run(scenario())
+    assert 1 <= len(writes) < 3
+    saved = json.loads((tmp_path / "rollout.json").read_text())
+    assert saved["halted"] == "test" and len(saved["admitted"]) == 2
+
+
+def test_shared_leader_admits_and_writes_under_the_lock(ro, tmp_path):
+    ro.shared = True
+
+    async def scenario():
+        async with ro.locked():
+            ro.evaluate()
+
+    asyncio.run(scenario())
+    follower = rollout.Rollout(str(tmp_path), str(tmp_path / "rollout.json"), shared=True)
+    follower.load()
+    assert sorted(follower.state["admitted"]) == sorted(canaries(2))
+
+
+def test_succeeded_is_a_set_in_memory_and_a_list_on_disk(ro, tmp_path):
+    first = admitted(ro)
+    report(ro, first, version="1.0.1", healthy=True)
+    assert ro.state["succeeded"] == set(first)
+    saved = json.loads((tmp_path / "rollout.json").read_text())
+    assert saved["succeeded"] == sorted(first)
+
+    again = rollout.Rollout(str(tmp_path), str(tmp_path / "rollout.json"))
+    again.load()
+    assert again.state["succeeded"] == set(first) and again.status()["succeeded"] == 2
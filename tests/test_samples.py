@@ -0,0 +1,105 @@
+import json
+import math
+import sqlite3
+
+import pytest
+
+import samples
+
+
+def _forget_interned():
+    # name -> id caches belong to one database; tests each use a fresh one
+    for cache in samples._interned.values():
+        cache.clear()
+
+
+@pytest.fixture
+def conn():
+    _forget_interned()
+    c = sqlite3.connect(":memory:")
+    samples.init_schema(c)
+    yield c
+    c.close()
+    _forget_interned()
+
+
+def roundtrip(conn, data, ts_ms=1_700_000_000_123):
+    samples.insert_many(conn, [samples.encode(data, ts_ms)])
+    (rid, line), = samples.select_lines(conn, 10)
+    return rid, json.loads(line)
+
+
+def test_roundtrip_rebuilds_the_robot_payload(conn):
+    data = {"robot_id": "r1", "version": "1.2.3", "cpu": 12.5, "mem": 40, "healthy": False,
+            "failed_versions": ["1.2.2"], "temp": {"board": 51}}
+    rid, out = roundtrip(conn, data)
+    assert out.pop("_seq") == rid
+    assert out.pop("ts") == 1_700_000_000.123
+    assert out == data
+
+
+def test_absent_fields_stay_absent(conn):
+    _, out = roundtrip(conn, {"robot_id": "r1", "cpu": "n/a"})
+    assert set(out) == {"_seq", "ts", "robot_id", "cpu"}
+    assert out["cpu"] == "n/a"   # unexpected type kept verbatim in extra
+
+
+@pytest.mark.parametrize("data", [
+    {"robot_id": "r1", "cpu": math.nan},
+    {"robot_id": "r1", "mem": math.inf},
+    {"robot_id": "r1", "cpu": -math.inf},
+    {"robot_id": "r1", "cpu": 10 ** 400},
+    {"robot_id": "r1", "temp": math.nan},
+    {"robot_id": "r1", "nested": {"values": [1, math.inf]}},
+])
+def test_non_finite_numbers_are_rejected(data):
+    with pytest.raises(ValueError):
+        samples.encode(data, 0)
+
+
+def test_rows_buffered_before_the_check_are_repaired(conn):
+    # As stored by a gateway that did not reject them yet
+    conn.execute(samples.INSERT_SQL["samples"], (1000, None, None, math.inf, 1.0, 1, '{"temp":NaN}'))
+    conn.execute(samples.INSERT_SQL["samples"], (2000, None, None, 5.0, None, None, '{"ok":1}'))
+    with pytest.raises(sqlite3.OperationalError):
+        samples.select_lines(conn, 10)
+    samples.init_schema(conn)   # startup
+    lines = [json.loads(line) for _, line in samples.select_lines(conn, 10)]
+    assert lines == [{"_seq": 1, "ts": 1.0, "mem": 1.0, "healthy": True},
+                     {"_seq": 2, "ts": 2.0, "cpu": 5.0, "ok": 1}]
+
+
+def test_select_lines_is_oldest_first_and_delete_drains(conn):
+    samples.insert_many(conn, [samples.encode({"robot_id": f"r{i}"}, i) for i in range(5)])
+    first = samples.select_lines(conn, 3)
+    assert [json.loads(line)["robot_id"] for _, line in first] == ["r0", "r1", "r2"]
+    samples.delete_ids(conn, [rid for rid, _ in first])
+    assert [json.loads(line)["robot_id"] for _, line in samples.select_lines(conn, 10)] == ["r3", "r4"]
+    assert samples.count_rows(conn) == 2
+
+
+def test_select_raw_after_reads_raw_samples_in_insert_order(conn):
+    samples.insert_many(conn, [samples.encode({"robot_id": f"r{i}", "cpu": i}, 1000 + i) for i in range(5)],
+                        "raw_samples")
+    first = samples.select_raw_after(conn, 0, 2)
+    assert [(ts, json.loads(line)["robot_id"]) for _, ts, line in first] == [(1000, "r0"), (1001, "r1")]
+    rest = samples.select_raw_after(conn, first[-1][0], 10)
+    assert [json.loads(line)["cpu"] for _, _, line in rest] == [2, 3, 4]
+
+
+def test_downsample_thins_plain_samples_but_keeps_aggregates(conn):
+    from aggregation import WindowAggregator
+    t0 = 1_700_000_000_000
+    plain = [samples.encode({"robot_id": "r1", "cpu": i, "healthy": True}, t0 + i) for i in range(5)]
+    sick = samples.encode({"robot_id": "r1", "cpu": 9, "healthy": False}, t0 + 5)
+    agg = WindowAggregator(seconds=1)
+    closed = []
+    for i in range(3):   # three 1s windows, all inside one 60s downsampling bucket
+        closed += agg.add({"robot_id": "r2", "cpu": i, "healthy": True}, t0 + 1000 * i)
+    windows = [samples.encode(payload, ts) for payload, ts in closed + agg.drain()]
+    samples.insert_many(conn, plain + [sick] + windows)
+
+    assert samples.downsample_oldest(conn, 100, 60_000) == 4
+    kept = [json.loads(line) for _, line in samples.select_lines(conn, 100)]
+    assert [(s["robot_id"], s["cpu"]) for s in kept if "agg" not in s] == [("r1", 0), ("r1", 9)]
+    assert [s["agg"]["count"] for s in kept if "agg" in s] == [1, 1, 1]
@@ -0,0 +1,164 @@
+import asyncio
+import json
+
+import pytest
+
+import samples
+import telemetry_buffer
+from db import Database
+from telemetry_buffer import TelemetryBuffer
+
+
+@pytest.fixture
+def run(tmp_path):
+    """Runs `scenario(buffer, db)` against a fresh SQLite buffer on an event loop."""
+    for cache in samples._interned.values():
+        cache.clear()
+
+    def run(scenario, **kw):
+        async def main():
+            db = Database(str(tmp_path / "metrics.db"))
+            db.start()
+            try:
+                await db.write("init", samples.init_schema)
+                buf = TelemetryBuffer(db, **kw)
+                await buf.start()
+                try:
+                    return await scenario(buf, db)
+                finally:
+                    await buf.stop()
+            finally:
+                db.stop()
+        return asyncio.run(main())
+
+    yield run
+    for cache in samples._interned.values():
+        cache.clear()
+
+
+async def fill(buf, n, robot="r1", t0=1_700_000_000_000, step=1):
+    for i in range(n):
+        await buf.add(samples.encode({"robot_id": robot, "cpu": i, "healthy": True}, t0 + i * step))
+
+
+async def drain(buf, db, n):
+    rows = await db.read("select", samples.select_lines, n)
+    await db.write("delete", samples.delete_ids, [rid for rid, _ in rows])
+    buf.removed(len(rows))
+
+
+def test_full_at_high_water_and_accepting_again_below_low_water(run):
+    async def scenario(buf, db):
+        await fill(buf, 9)
+        assert buf.accepting()
+        await fill(buf, 1)
+        assert not buf.accepting() and buf.full
+        await drain(buf, db, 1)          # 9 rows: under high water, not yet under 90%
+        assert not buf.accepting()
+        await drain(buf, db, 1)          # 8 rows
+        assert buf.accepting() and not buf.full
+        await fill(buf, 1)               # 9 rows: accepted until high water again
+        assert buf.accepting()
+
+    run(scenario, mode="sync", high_water=10)
+
+
+def test_buffered_mode_counts_rows_not_yet_committed(run):
+    async def scenario(buf, db):
+        await fill(buf, 10)
+        assert buf.pending and buf.count == 10
+        assert not buf.accepting()
+        await buf.commit()
+        assert buf.pending == 0 and buf.count == 10
+        assert await db.read("count", samples.count_rows) == 10
+
+    run(scenario, mode="buffered", high_water=10)
+
+
+def test_recount_picks_up_rows_deleted_elsewhere(run):
+    async def scenario(buf, db):
+        await fill(buf, 10)
+        assert not buf.accepting()
+        rows = await db.read("select", samples.select_lines, 5)
+        await db.write("delete", samples.delete_ids, [rid for rid, _ in rows])   # not via removed()
+        assert buf.count == 10
+        await buf.recount()
+        assert buf.count == 5 and buf.accepting()
+
+    run(scenario, mode="sync", high_water=10)
+
+
+def test_shared_buffer_recounts_itself_while_full(run):
+    async def scenario(buf, db):
+        await fill(buf, 10)
+        rows = await db.read("select", samples.select_lines, 5)
+        await db.write("delete", samples.delete_ids, [rid for rid, _ in rows])   # the leader's flush
+        assert not buf.accepting()       # stale count; re-read in the background
+        await buf._recounting
+        assert buf.count == 5 and buf.accepting()
+
+    run(scenario, mode="sync", high_water=10, shared=True)
+
+
+def test_downsample_policy_thins_instead_of_rejecting(run, monkeypatch):
+    monkeypatch.setattr(telemetry_buffer, "BUFFER_FULL_POLICY", "downsample")
+    monkeypatch.setattr(telemetry_buffer, "BUFFER_DOWNSAMPLE_SECONDS", 60)
+
+    async def scenario(buf, db):
+        await fill(buf, 10, step=1000)   # all within one 60s bucket
+        assert buf.accepting()           # full, but thinning makes room
+        await buf._thinning
+        assert buf.count == 1 and buf.downsampled == 9
+        assert buf.accepting() and not buf.full
+
+    run(scenario, mode="sync", high_water=10)
+
+
+def test_writer_group_commits_at_the_row_threshold(run, monkeypatch):
+    monkeypatch.setattr(telemetry_buffer, "INGEST_COMMIT_MS", 60_000)
+    monkeypatch.setattr(telemetry_buffer, "INGEST_COMMIT_ROWS", 5)
+
+    async def scenario(buf, db):
+        await fill(buf, 4)
+        await asyncio.sleep(0.05)
+        assert buf.pending == 4              # under the threshold: waits for the window
+        await fill(buf, 1)
+        for _ in range(100):
+            if not buf.pending:
+                break
+            await asyncio.sleep(0.01)
+        assert await db.read("count", samples.count_rows) == 5
+
+    run(scenario, mode="buffered")
+
+
+def test_writer_commits_each_window(run, monkeypatch):
+    monkeypatch.setattr(telemetry_buffer, "INGEST_COMMIT_MS", 10)
+
+    async def scenario(buf, db):
+        await fill(buf, 1)
+        await asyncio.sleep(0.2)
+        assert buf.pending == 0 and await db.read("count", samples.count_rows) == 1
+
+    run(scenario, mode="buffered")
+
+
+def test_failed_commit_keeps_the_rows_in_order(run, monkeypatch):
+    insert_many = samples.insert_many
+
+    def fail(conn, rows, table="samples"):
+        raise RuntimeError("disk I/O error")
+
+    async def scenario(buf, db):
+        await fill(buf, 3)
+        monkeypatch.setattr(samples, "insert_many", fail)
+        with pytest.raises(RuntimeError):
+            await buf.commit()
+        assert buf.pending == 3 and buf.count == 3
+        await fill(buf, 1, t0=1_700_000_000_003)
+        monkeypatch.setattr(samples, "insert_many", insert_many)
+        await buf.stop()                 # commits what is still queued
+        rows = await db.read("select", samples.select_lines, 10)
+        assert [json.loads(line)["cpu"] for _, line in rows] == [0, 1, 2, 0]
+
+    run(scenario, mode="buffered")
@@ -0,0 +1,66 @@
+import pytest
+
+import tsdb
+from tsdb import Rollup, TimeSeriesStore
+
+
+def sample(ts, cpu, robot_id="r1", healthy=True, version="1.0.0", **kw):
+    return {"robot_id": robot_id, "ts": ts, "cpu": cpu, "mem": cpu * 2, "healthy": healthy, "version": version, **kw}
+
+
+def test_raw_and_rollup_queries():
+    store = TimeSeriesStore(path="")
+    for ts, cpu in [(0, 10), (30, 20), (59, 30), (60, 40)]:
+        store.add(sample(ts, cpu, healthy=ts != 30))
+    assert [p["cpu"] for p in store.query("r1", start=30, end=59)["r1"]] == [20, 30]
+
+    first, second = store.query("r1", agg="1m")["r1"]
+    assert (first["ts"], first["count"], first["unhealthy"]) == (0, 3, 1)
+    assert first["cpu"] == {"mean": 20.0, "min": 10, "max": 30}
+    assert (second["ts"], second["count"]) == (60, 1)
+    assert [b["ts"] for b in store.query("r1", start=60, agg="1s")["r1"]] == [60]
+    with pytest.raises(ValueError):
+        store.query(agg="5m")
+
+
+def test_rollup_keeps_the_newest_buckets():
+    r = Rollup(step=10, capacity=3)
+    for ts in (0, 10, 20, 30):
+        r.add(ts, 1.0, None, None, None)
+    assert r.keys == [10, 20, 30]
+    r.add(5, 1.0, None, None, None)   # older than everything retained
+    assert r.keys == [10, 20, 30]
+    r.add(25, 1.0, None, None, None)  # into a retained bucket
+    assert r.buckets[20][tsdb.COUNT] == 2
+
+
+def test_gateway_windows_count_every_sample():
+    store = TimeSeriesStore(path="")
+    agg = {"count": 4, "cpu": {"min": 1, "max": 9, "mean": 5, "count": 4}, "mem": {"min": 2}}
+    store.add({"robot_id": "r1", "ts": 120, "healthy": False, "agg": agg})
+    (bucket,) = store.query("r1", agg="1h")["r1"]
+    assert (bucket["count"], bucket["unhealthy"], bucket["mem"]) == (4, 4, None)   # malformed mem stats ignored
+    assert bucket["cpu"] == {"mean": 5.0, "min": 1, "max": 9}
+    assert store.total == 4
+
+
+def test_least_recently_seen_robots_are_evicted(monkeypatch):
+    monkeypatch.setattr(tsdb, "TSDB_MAX_ROBOTS", 2)
+    store = TimeSeriesStore(path="")
+    for rid in ("a", "b", "a", "c"):
+        store.add(sample(1, 1, robot_id=rid))
+    assert list(store.robots) == ["a", "c"]
+
+
+def test_snapshot_roundtrip_keeps_series_and_dedup_state(tmp_path):
+    path = str(tmp_path / "tsdb.json.gz")
+    store = TimeSeriesStore(path=path)
+    store.add_many([sample(0, 10, _seq=1), sample(61, 20, _seq=2)], source="gw/a")
+    store.save()
+
+    again = TimeSeriesStore(path=path)
+    again.load()
+    assert again.query(agg="1m") == store.query(agg="1m")
+    assert again.query("r1") == store.query("r1")
+    assert again.total == 2
+    assert again.add_many([sample(61, 20, _seq=2), sample(62, 30, _seq=3)], source="gw/a") == 1   # retry dropped
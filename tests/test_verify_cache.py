@@ -0,0 +1,72 @@
+import base64
+import hashlib
+import json
+
+import pytest
+
+from common import verify_cache
+from common.verify_cache import VerifyCache, already_verified, verify_inprocess
+
+ec = pytest.importorskip("cryptography.hazmat.primitives.asymmetric.ec")
+from cryptography.hazmat.primitives import hashes, serialization   # noqa: E402
+from cryptography.hazmat.primitives.asymmetric.utils import Prehashed   # noqa: E402
+
+ARTIFACT = b"app 1.0.1"
+DIGEST = hashlib.sha256(ARTIFACT).digest()
+
+
+def write_key(path, key):
+    path.write_bytes(key.public_key().public_bytes(
+        serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo))
+    return str(path)
+
+
+def write_bundle(path, key, digest=DIGEST):
+    # The parts of a cosign bundle the in-process check reads
+    signature = key.sign(digest, ec.ECDSA(Prehashed(hashes.SHA256())))
+    path.write_text(json.dumps({"messageSignature": {
+        "messageDigest": {"algorithm": "SHA2_256", "digest": base64.b64encode(digest).decode()},
+        "signature": base64.b64encode(signature).decode(),
+    }}))
+    return str(path)
+
+
+@pytest.fixture
+def signed(tmp_path):
+    key = ec.generate_private_key(ec.SECP256R1())
+    return key, write_key(tmp_path / "cosign.pub", key), write_bundle(tmp_path / "app.bundle", key)
+
+
+def test_inprocess_accepts_the_signers_bundle_only(tmp_path, signed):
+    _, pub, bundle = signed
+    assert verify_inprocess(pub, bundle, DIGEST.hex())
+    assert not verify_inprocess(pub, bundle, hashlib.sha256(b"other").hexdigest())
+    other = write_key(tmp_path / "other.pub", ec.generate_private_key(ec.SECP256R1()))
+    assert not verify_inprocess(other, bundle, DIGEST.hex())
+    (tmp_path / "broken.bundle").write_text("{}")
+    assert not verify_inprocess(pub, str(tmp_path / "broken.bundle"), DIGEST.hex())
+
+
+def test_cache_hits_after_a_recorded_verification(tmp_path, signed):
+    _, pub, bundle = signed
+    cache = VerifyCache(str(tmp_path / "verify-cache.json"), pub)
+    assert not cache.hit(DIGEST.hex(), bundle)
+    cache.record(DIGEST.hex(), bundle)
+    assert VerifyCache(str(tmp_path / "verify-cache.json"), pub).hit(DIGEST.hex(), bundle)   # persisted
+
+
+def test_key_rotation_clears_the_cache(tmp_path, signed):
+    _, pub, bundle = signed
+    cache = VerifyCache(str(tmp_path / "verify-cache.json"), pub)
+    cache.record(DIGEST.hex(), bundle)
+    write_key(tmp_path / "cosign.pub", ec.generate_private_key(ec.SECP256R1()))
+    assert not cache.hit(DIGEST.hex(), bundle)
+
+
+def test_already_verified_prefers_the_cache_then_inprocess(tmp_path, signed, monkeypatch):
+    _, pub, bundle = signed
+    cache = VerifyCache(str(tmp_path / "verify-cache.json"), pub)
+    assert already_verified(cache, pub, DIGEST.hex(), bundle) is None   # opt-in: cosign decides
+    monkeypatch.setattr(verify_cache, "VERIFY_INPROCESS", True)
+    assert already_verified(cache, pub, DIGEST.hex(), bundle) == "inprocess"
+    assert already_verified(cache, pub, DIGEST.hex(), bundle) == "cache"